@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 from .client import *
+from .errors import *
 from .schema import *
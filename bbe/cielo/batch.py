@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""Captures and cancels many transactions at once, e.g. at the end of
+the day::
+
+    >>> summary = capture_many(client, tids, checkpoint='captures.log',
+    ...                        max_workers=20, rate=50)
+    >>> print summary
+
+Every finished operation is written to the ``checkpoint`` file, so
+running the same batch again (after a crash, say) skips the
+transactions it already handled.
+"""
+import os
+import collections
+from bbe.cielo import schema as schemas
+from bbe.cielo.errors import CommunicationError, Error, CaptureNotAllowedError, \
+    CancelNotAllowedError
+from bbe.cielo.executor import imap_unordered
+from bbe.cielo.ratelimit import RateLimiter
+
+
+#: The checkpoint outcome of operations that failed without telling
+#: whether they took effect (communication errors).
+UNKNOWN = 'unknown'
+
+
+class Checkpoint(object):
+    """A journal of the transactions handled by a batch: one line per
+    tid, with ``ok`` or the code of the error it failed with. Tids
+    whose operation may or may not have taken effect are written with
+    :data:`UNKNOWN`; they are not :attr:`done`, but kept in
+    :attr:`ambiguous` until a later line settles them.
+
+    Lines are flushed as they are written, so they survive a crash of
+    the process; :meth:`close` also syncs them to the disk. A line cut
+    short by a crash is discarded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self.ambiguous = set()
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            end = data.rfind('\n') + 1
+            for line in data[:end].splitlines():
+                tid, outcome = line.split('\t')
+                self._settle(tid, outcome)
+            if end < len(data):
+                # drop the line cut short, or the next one would be
+                # appended to it
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+        self._file = open(path, 'ab')
+
+    def record(self, tid, outcome):
+        self._file.write('%s\t%s\n' % (tid, outcome))
+        self._file.flush()
+        self._settle(tid, outcome)
+
+    def _settle(self, tid, outcome):
+        if outcome == UNKNOWN:
+            self.ambiguous.add(tid)
+        else:
+            self.done[tid] = outcome
+            self.ambiguous.discard(tid)
+
+    def close(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def __contains__(self, tid):
+        return tid in self.done
+
+
+class Summary(object):
+    """The outcome of a batch.
+
+    .. attribute:: succeeded
+
+        How many operations succeeded.
+
+    .. attribute:: skipped
+
+        How many transactions were skipped, as the checkpoint had
+        them.
+
+    .. attribute:: failures
+
+        How many operations failed, by error code (``None`` for
+        communication errors, and the name of the exception class
+        for unexpected errors, like a bug in the operation).
+
+    .. attribute:: errors
+
+        The errors, by tid.
+    """
+    def __init__(self):
+        self.succeeded = 0
+        self.skipped = 0
+        self.failures = collections.Counter()
+        self.errors = {}
+
+    @property
+    def failed(self):
+        return sum(self.failures.itervalues())
+
+    def __str__(self):
+        lines = ['succeeded: %d' % self.succeeded,
+                 'skipped: %d' % self.skipped,
+                 'failed: %d' % self.failed]
+        for code, count in sorted(self.failures.iteritems()):
+            if code is None:
+                reason = 'communication errors'
+            elif isinstance(code, basestring):
+                reason = '%s errors' % code
+            else:
+                reason = 'error %s (%s)' % (code, Error.get_error_class(code).description)
+            lines.append('  %s: %d' % (reason.encode('utf-8'), count))
+        return '\n'.join(lines)
+
+
+def capture_many(client, captures, checkpoint=None, max_workers=10,
+                 rate=None, limiter=None):
+    """Capture many transactions and return a :class:`Summary`.
+
+    ``captures`` are tids, to capture the whole authorized value, or
+    ``(tid, value, attachment)`` tuples, whose ``value`` and
+    ``attachment`` may be ``None`` (see
+    :meth:`~bbe.cielo.client.Client.capture_transaction`).
+
+    At most ``max_workers`` captures run at once, and no more than
+    ``rate`` per second (or as many as ``limiter`` allows). Finished
+    tids are recorded to the ``checkpoint`` file, if given, and
+    skipped when it is used again. Captures that may succeed if tried
+    again (communication errors and retryable service errors) are
+    not recorded as done, so the next run tries them again.
+
+    A capture that failed with a communication error may have taken
+    effect anyway, so its transaction is queried: if it is captured,
+    the capture succeeded. The same goes for captures refused with
+    error 30 after such a failure, in this run or a previous one.
+    """
+    def capture(item):
+        if isinstance(item, basestring):
+            return client.capture_transaction(item)
+        return client.capture_transaction(*item)
+
+    return _run(client, capture, captures, checkpoint, max_workers, rate,
+                limiter, schemas.ST_CAPTURED, CaptureNotAllowedError)
+
+
+def cancel_many(client, tids, checkpoint=None, max_workers=10, rate=None,
+                limiter=None):
+    """Cancel many transactions and return a :class:`Summary`, like
+    :func:`capture_many` does.
+
+    Transactions can only be cancelled on the day they were
+    authorized, so run it before midnight: later cancels fail with
+    error 40. Cancels whose outcome is unknown are checked like
+    captures are, error 41 standing for error 30.
+    """
+    return _run(client, client.cancel_transaction, tids, checkpoint,
+                max_workers, rate, limiter, schemas.ST_CANCELLED,
+                CancelNotAllowedError)
+
+
+def _tid(item):
+    if isinstance(item, basestring):
+        return item
+    return item[0]
+
+
+def _run(client, operation, items, checkpoint, max_workers, rate, limiter,
+         status, not_allowed):
+    """Run ``operation`` on each item. Operations whose outcome is
+    unknown count as succeeded if the transaction is in ``status``,
+    and so do those refused with ``not_allowed`` after an unknown
+    outcome."""
+    if limiter is None and rate is not None:
+        limiter = RateLimiter(rate)
+    if checkpoint is not None:
+        checkpoint = Checkpoint(checkpoint)
+        ambiguous = checkpoint.ambiguous
+    else:
+        ambiguous = set()
+    summary = Summary()
+
+    def pending():
+        for item in items:
+            if checkpoint is not None and _tid(item) in checkpoint:
+                summary.skipped += 1
+            else:
+                yield item
+
+    def call(item):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return operation(item)
+        except (CommunicationError, not_allowed), e:
+            tid = _tid(item)
+            if isinstance(e, not_allowed) and tid not in ambiguous:
+                raise
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                transaction = client.query_by_tid(tid)
+            except (CommunicationError, Error):
+                raise e
+            if transaction.status != status:
+                raise e
+            return transaction
+
+    try:
+        for item, future in imap_unordered(call, pending(), max_workers):
+            tid = _tid(item)
+            error = future.exception()
+            if error is None:
+                summary.succeeded += 1
+                outcome = 'ok'
+            elif isinstance(error, (CommunicationError, Error)):
+                code = getattr(error, 'code', None)
+                summary.failures[code] += 1
+                summary.errors[tid] = error
+                if code is None:
+                    outcome = UNKNOWN
+                elif error.retryable:
+                    continue
+                else:
+                    outcome = code
+            elif isinstance(error, Exception):
+                # not recorded, so that the next run tries it again
+                summary.failures[type(error).__name__] += 1
+                summary.errors[tid] = error
+                continue
+            else:
+                future.result()
+            if checkpoint is not None:
+                checkpoint.record(tid, outcome)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+    return summary
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""Micro benchmarks for the hot paths of the client.
+
+Each benchmark compares the reference implementation of a path with
+its optimized counterpart. Run them with::
+
+    $ python -m bbe.cielo.benchmark [name-filter]
+
+To catch regressions, save the results of a known good tree and
+compare later runs (on the same machine) against them::
+
+    $ python -m bbe.cielo.benchmark --save baseline.json
+    $ python -m bbe.cielo.benchmark --baseline baseline.json --threshold 0.15
+
+The second command exits with status 1 if any optimized path got
+slower than the threshold allows, or retains more objects per call.
+"""
+import gc
+import re
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+from decimal import Decimal
+from bbe.cielo import message
+from bbe.cielo import schema as schemas
+
+
+def measure(fn, repeat=5, min_time=0.1):
+    """Return the best time, in seconds, of a single call to ``fn``."""
+    number = 1
+    while True:
+        started = time.time()
+        for i in xrange(number):
+            fn()
+        elapsed = time.time() - started
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed
+    for i in range(repeat - 1):
+        started = time.time()
+        for i in xrange(number):
+            fn()
+        best = min(best, time.time() - started)
+    return best / number
+
+
+def retained(fn, number=1000):
+    """Return how many objects tracked by the garbage collector are
+    kept alive, per call, by the results of ``fn``."""
+    gc.collect()
+    before = len(gc.get_objects())
+    results = [fn() for i in xrange(number)]
+    gc.collect()
+    after = len(gc.get_objects())
+    del results
+    # the results list itself
+    return float(after - before - 1) / number
+
+
+def request_fixtures():
+    """Realistic appstructs for each request tag."""
+    common = {
+        'id': 'f71e286f-21f6-4abe-8999-cc200e585454',
+        'version': schemas.SERVICE_VERSION,
+        'establishment': {
+            'number': '1006993069',
+            'key': '25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+        },
+    }
+
+    def fixture(**kwargs):
+        kwargs.update(common)
+        return kwargs
+
+    return {
+        'requisicao-transacao': fixture(
+            order={
+                'number': '2a7e6dc5b0c8e1f3a9d2',
+                'value': Decimal('200.00'),
+                'currency': schemas.DEFAULT_CURRENCY,
+                'datetime': datetime.datetime(2012, 8, 11, 8, 48, 23),
+                'description': u'Pedido de teste',
+                'language': schemas.LANG_PT,
+            },
+            payment={
+                'brand': schemas.VISA,
+                'product': schemas.CREDITO_A_VISTA,
+                'installments': 1,
+            },
+            holder={
+                'number': '4551870000000183',
+                'holder_name': 'Joao da Silva',
+                'expiration_date': datetime.date(2020, 12, 1),
+                'security_code': '123',
+                'security_code_indicator': schemas.SC_INFORMADO,
+            },
+            bin='455187',
+            return_url='http://example.com',
+            authorize=3,
+            capture=False,
+        ),
+        'requisicao-consulta': fixture(tid='100699306905227C1001'),
+        'requisicao-consulta-chsec': fixture(order_number='2a7e6dc5b0c8e1f3a9d2'),
+        'requisicao-captura': fixture(tid='100699306905227C1001',
+                                      value=Decimal('150.00'),
+                                      attachment=u'Captura parcial'),
+        'requisicao-cancelamento': fixture(tid='100699306905227C1001'),
+    }
+
+
+TRANSACTION_RESPONSE = u"""<?xml version="1.0" encoding="ISO-8859-1"?>
+<transacao versao="1.1.1" id="f71e286f-21f6-4abe-8999-cc200e585454" xmlns="http://ecommerce.cbmp.com.br">
+  <tid>100699306905227C1001</tid>
+  <pan>uv9yI5tkhX9jpuCt+dfrtoSVM4U3gIjvrcwMBfZcadE=</pan>
+  <dados-pedido>
+    <numero>2a7e6dc5b0c8e1f3a9d2</numero>
+    <valor>20000</valor>
+    <moeda>986</moeda>
+    <data-hora>2012-08-11T08:48:23.659-03:00</data-hora>
+    <descricao>Pedido de teste</descricao>
+    <idioma>PT</idioma>
+  </dados-pedido>
+  <forma-pagamento>
+    <bandeira>visa</bandeira>
+    <produto>1</produto>
+    <parcelas>1</parcelas>
+  </forma-pagamento>
+  <status>%(status)s</status>%(nodes)s
+</transacao>"""
+
+AUTHENTICATION_NODE = u"""
+  <autenticacao>
+    <codigo>6</codigo>
+    <mensagem>Transacao autenticada</mensagem>
+    <data-hora>2012-08-11T08:48:23.695-03:00</data-hora>
+    <valor>20000</valor>
+    <eci>5</eci>
+  </autenticacao>"""
+
+AUTHORIZATION_NODE = u"""
+  <autorizacao>
+    <codigo>4</codigo>
+    <mensagem>Transação autorizada</mensagem>
+    <data-hora>2012-08-11T08:48:43.708-03:00</data-hora>
+    <valor>20000</valor>
+    <lr>00</lr>
+    <arp>123456</arp>
+    <nsu>336508</nsu>
+  </autorizacao>"""
+
+CAPTURE_NODE = u"""
+  <captura>
+    <codigo>6</codigo>
+    <mensagem>Transacao capturada com sucesso</mensagem>
+    <data-hora>2012-08-11T09:01:02.113-03:00</data-hora>
+    <valor>20000</valor>
+  </captura>"""
+
+CANCEL_NODE = u"""
+  <cancelamento>
+    <codigo>9</codigo>
+    <mensagem>Transacao cancelada com sucesso</mensagem>
+    <data-hora>2012-08-11T10:15:44.921-03:00</data-hora>
+    <valor>20000</valor>
+  </cancelamento>"""
+
+ERROR_RESPONSE = u"""<?xml version="1.0" encoding="ISO-8859-1"?>
+<erro xmlns="http://ecommerce.cbmp.com.br">
+  <codigo>032</codigo>
+  <mensagem>Valor de captura inválido</mensagem>
+</erro>"""
+
+
+def response_fixtures():
+    """Responses from a bare error to a transaction with every
+    optional node, through the nodes of an authorized one."""
+    def transaction(status, *nodes):
+        return (TRANSACTION_RESPONSE % {
+            'status': status,
+            'nodes': ''.join(nodes),
+        }).encode('iso-8859-1')
+
+    return {
+        'erro': ERROR_RESPONSE.encode('iso-8859-1'),
+        'transacao-minimal': transaction(schemas.ST_CREATED),
+        'transacao-authorized': transaction(schemas.ST_AUTHORIZED, AUTHENTICATION_NODE,
+                                            AUTHORIZATION_NODE),
+        'transacao-full': transaction(schemas.ST_CANCELLED, AUTHENTICATION_NODE,
+                                      AUTHORIZATION_NODE, CAPTURE_NODE, CANCEL_NODE),
+    }
+
+
+def request_serialization():
+    """message.serialize + dumps against compile_encoder, per tag."""
+    request_schemas = schemas._compile_request_schemas()
+    for tag, appstruct in sorted(request_fixtures().items()):
+        schema = request_schemas[tag]
+        encoder = message.compile_encoder(schema, 'ISO-8859-1')
+
+        def reference(schema=schema, appstruct=appstruct):
+            tree = message.serialize(schema, schema.serialize(appstruct))
+            return message.dumps(tree, encoding='ISO-8859-1')
+
+        yield tag, reference, lambda encoder=encoder, appstruct=appstruct: encoder(appstruct)
+
+
+def request_templates():
+    """compile_encoder + encode_message against the pre-rendered
+    templates of a client, per fixed-shape tag."""
+    from bbe.cielo import client as clients
+    from bbe.cielo import transport as transports
+    request_schemas = schemas._compile_request_schemas()
+    fixtures = request_fixtures()
+    establishment = fixtures['requisicao-consulta']['establishment']
+    client = clients.Client(establishment['number'], establishment['key'],
+                            schemas.PARCELADO_ADMINISTRADORA)
+    # don't measure uuid4
+    client.generate_request_id = lambda: fixtures['requisicao-consulta']['id']
+    for tag in clients.Client._template_tags:
+        encoder = message.compile_encoder(request_schemas[tag], 'ISO-8859-1')
+        appstruct = fixtures[tag]
+        variables = dict((name, value) for name, value in appstruct.items()
+                         if name not in ('version', 'establishment'))
+
+        def reference(encoder=encoder, appstruct=appstruct):
+            return transports.encode_message(encoder(dict(appstruct)))
+
+        def optimized(tag=tag, variables=variables):
+            return client._build_message(tag, dict(variables))
+
+        yield tag, reference, optimized
+
+
+def response_deserialization():
+    """message.deserialize + schema.deserialize against
+    compile_decoder, per response."""
+    response_schemas = {
+        'erro': schemas.ErrorSchema(),
+        'transacao': schemas.TransactionSchema(),
+    }
+    for name, response in sorted(response_fixtures().items()):
+        tree = message.loads(response)
+        schema = response_schemas[message.get_root_tag(tree)]
+        decoder = message.compile_decoder(schema)
+
+        def reference(schema=schema, tree=tree):
+            return schema.deserialize(message.deserialize(schema, tree))
+
+        yield name, reference, lambda decoder=decoder, tree=tree: decoder(tree.getroot())
+
+
+def trusted_responses():
+    """compile_decoder with and without validation, per response."""
+    response_schemas = {
+        'erro': schemas.ErrorSchema(),
+        'transacao': schemas.TransactionSchema(),
+    }
+    for name, response in sorted(response_fixtures().items()):
+        root = message.loads(response).getroot()
+        schema = response_schemas[root.tag]
+        decoder = message.compile_decoder(schema)
+        trusted = message.compile_decoder(schema, validate=False)
+        yield name, lambda decoder=decoder, root=root: decoder(root), \
+            lambda trusted=trusted, root=root: trusted(root)
+
+
+def transactions():
+    """Client.process_response with every node decoded right away
+    against the lazy nodes of Transaction, per response, reading
+    the tid and the status only."""
+    from bbe.cielo import client as clients
+    eager = clients.Client('1006993069', 'key', schemas.PARCELADO_ADMINISTRADORA)
+    eager._response_decoder_map, eager._node_decoder_map = \
+        eager._get_response_decoders(False, True, False)
+    lazy = clients.Client('1006993069', 'key', schemas.PARCELADO_ADMINISTRADORA)
+    for name, response in sorted(response_fixtures().items()):
+        if not name.startswith('transacao'):
+            continue
+
+        def reference(response=response):
+            transaction = eager.process_response(response)
+            transaction.tid, transaction.status
+            return transaction
+
+        def optimized(response=response):
+            transaction = lazy.process_response(response)
+            transaction.tid, transaction.status
+            return transaction
+
+        yield name, reference, optimized
+
+
+def observers():
+    """Client queries through a loopback transport timed by a
+    HistogramObserver against the same queries without observer."""
+    from bbe.cielo import client as clients
+    from bbe.cielo import metrics
+    from bbe.cielo import transport as transports
+    for name, response in sorted(response_fixtures().items()):
+        if not name.startswith('transacao'):
+            continue
+        transport = transports.LoopbackTransport(lambda request, response=response: response)
+        observed = clients.Client('1006993069', 'key', schemas.PARCELADO_ADMINISTRADORA,
+                                  transport=transport, coalesce=False,
+                                  observer=metrics.HistogramObserver())
+        plain = clients.Client('1006993069', 'key', schemas.PARCELADO_ADMINISTRADORA,
+                               transport=transport, coalesce=False)
+        for client in (observed, plain):
+            client.generate_request_id = lambda: 'f71e286f-21f6-4abe-8999-cc200e585454'
+        yield (name, lambda observed=observed: observed.query_by_tid('1'),
+               lambda plain=plain: plain.query_by_tid('1'))
+
+
+def order_numbers():
+    """sha1 of a uuid4 against the time-ordered generator."""
+    import uuid
+    import hashlib
+    from bbe.cielo import orders
+    generator = orders.OrderNumberGenerator()
+    yield ('generate', lambda: hashlib.sha1(str(uuid.uuid4())).hexdigest()[:20],
+           generator)
+
+
+def money():
+    """Money against CentsMoney, both ways, and the decoding of whole
+    responses with each of them."""
+    import colander
+    node = colander.SchemaNode(schemas.Money())
+    cents_node = colander.SchemaNode(schemas.CentsMoney())
+    value = Decimal('1234.50')
+    cents = schemas.Cents.from_decimal(value)
+    yield 'serialize', lambda: node.serialize(value), lambda: cents_node.serialize(cents)
+    yield 'deserialize', lambda: node.deserialize('123450'), lambda: cents_node.deserialize('123450')
+
+    decoder = message.compile_decoder(schemas.TransactionSchema())
+    cents_decoder = message.compile_decoder(
+        schemas._cents_schema(schemas.TransactionSchema()))
+    root = message.loads(response_fixtures()['transacao-full']).getroot()
+    yield 'transacao-full', lambda: decoder(root), lambda: cents_decoder(root)
+
+
+def datetimes():
+    """colander's ISO8601 DateTime against InconsistentDateTime, both
+    ways, and Month."""
+    import colander
+    node = colander.SchemaNode(colander.DateTime(None))
+    fast_node = colander.SchemaNode(schemas.InconsistentDateTime())
+    value = datetime.datetime(2012, 8, 11, 8, 48, 23)
+    cstruct = '2012-08-11T08:48:43.708-03:00'
+    yield 'serialize', lambda: node.serialize(value), lambda: fast_node.serialize(value)
+    yield 'deserialize', lambda: node.deserialize(cstruct), lambda: fast_node.deserialize(cstruct)
+
+    month = colander.SchemaNode(schemas.Month())
+    yield ('month-deserialize',
+           lambda: datetime.datetime.strptime('202012', '%Y%m').date(),
+           lambda: month.deserialize('202012'))
+
+
+def response_parsing():
+    """fromstring and a regex pass to drop namespaces against
+    message.loads, per response."""
+    element_tree = message.etree
+    for name, response in sorted(response_fixtures().items()):
+        def reference(response=response):
+            root = element_tree.fromstring(response)
+            for element in root.getiterator():
+                element.tag = re.sub(r'^\{[^\}]+\}', '', element.tag)
+            return root
+
+        yield name, reference, lambda response=response: message.loads(response)
+
+
+BENCHMARKS = [
+    request_serialization,
+    request_templates,
+    money,
+    datetimes,
+    response_parsing,
+    response_deserialization,
+    trusted_responses,
+    transactions,
+    observers,
+    order_numbers,
+]
+
+
+def run(pattern='', out=sys.stdout, repeat=5, min_time=0.1):
+    """Run the benchmarks whose names contain ``pattern``, writing
+    a line per benchmark to ``out``, and return their results, by
+    name."""
+    results = {}
+    for benchmark in BENCHMARKS:
+        for name, reference, optimized in benchmark():
+            name = '%s: %s' % (benchmark.__name__, name)
+            if pattern not in name:
+                continue
+            before = measure(reference, repeat, min_time)
+            after = measure(optimized, repeat, min_time)
+            result = results[name] = {
+                'reference': 1 / before,
+                'optimized': 1 / after,
+                'reference_retained': retained(reference),
+                'optimized_retained': retained(optimized),
+            }
+            out.write('%-55s %10.0f -> %10.0f ops/s  %5.2fx  %5.1f -> %5.1f objects\n'
+                      % (name, result['reference'], result['optimized'], before / after,
+                         result['reference_retained'], result['optimized_retained']))
+    return results
+
+
+def compare(results, baseline, threshold=0.15, out=sys.stdout):
+    """Compare ``results`` with those of a ``baseline`` run, and
+    return the names of the optimized paths that regressed: got
+    more than ``threshold`` (a fraction) slower, or retain more
+    objects per call."""
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = result['optimized'] / base['optimized']
+        slower = ratio < 1 - threshold
+        # retained objects are averaged, so allow for some noise
+        leaky = result['optimized_retained'] > base['optimized_retained'] + 0.5
+        if slower or leaky:
+            regressions.append(name)
+            out.write('REGRESSION %-44s %10.0f -> %10.0f ops/s  %+6.1f%%  %5.1f -> %5.1f objects\n'
+                      % (name, base['optimized'], result['optimized'], (ratio - 1) * 100,
+                         base['optimized_retained'], result['optimized_retained']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('pattern', nargs='?', default='',
+                        help='run only the benchmarks whose names contain it')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='compare with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='slowdown, as a fraction, taken as a regression')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='minimum seconds of each measurement')
+    args = parser.parse_args(argv)
+
+    results = run(args.pattern, repeat=args.repeat, min_time=args.min_time)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'implementation': platform.python_implementation(),
+                       'results': results}, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import collections
+from bbe.cielo import schema as schemas
+
+
+class StatusCache(object):
+    """Keeps the last known :class:`~bbe.cielo.client.Transaction` of
+    each tid and order number, so that repeated queries don't go to
+    the service.
+
+    How long a transaction is kept depends on its status: final
+    statuses are kept for ``final_ttl`` seconds, transitional ones
+    for ``transitional_ttl`` and the others (like authorized
+    transactions waiting to be captured) for ``ttl``. Set ``ttls``,
+    a ``{status: seconds}`` dict, to override any of them.
+
+    At most ``maxsize`` entries (each transaction takes one for its
+    tid and one for its order number) are kept, the least recently
+    used being evicted first. Entries are keyed by store too, so a
+    cache may be shared by the clients of many stores.
+
+    Cached transactions are shared by every caller that gets them, so
+    don't change them.
+
+    A response may be older than an invalidation that happened while
+    it was on its way (say, a query answered before a concurrent
+    capture). To keep it from replacing the fresh transaction, take
+    the :meth:`generation` before sending a request and pass it to
+    :meth:`put`, which ignores transactions invalidated since then.
+    """
+    def __init__(self, maxsize=10000, ttl=30, final_ttl=3600,
+                 transitional_ttl=2, ttls=None, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.ttls = collections.defaultdict(lambda: ttl)
+        for status in schemas.FINAL_STATUS:
+            self.ttls[status] = final_ttl
+        for status in schemas.TRANSITIONAL_STATUS:
+            self.ttls[status] = transitional_ttl
+        self.ttls.update(ttls or {})
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        # the generation each key was last invalidated at, for the
+        # last `maxsize` invalidations; puts older than `_floor` (the
+        # newest forgotten invalidation) are ignored
+        self._generation = 0
+        self._floor = 0
+        self._invalidated = collections.OrderedDict()
+
+    def generation(self):
+        """Return the current generation, to be given to :meth:`put`."""
+        return self._generation
+
+    def get_by_tid(self, store, tid):
+        return self._get(('tid', store, tid))
+
+    def get_by_order_number(self, store, order_number):
+        return self._get(('order', store, order_number))
+
+    def put(self, transaction, generation=None):
+        """Cache ``transaction``, unless it was invalidated since
+        ``generation``."""
+        expires_at = self.clock() + self.ttls[transaction.status]
+        entry = (expires_at, transaction)
+        keys = [('tid', transaction.store, transaction.tid)]
+        if transaction.order:
+            keys.append(('order', transaction.store, transaction.order))
+
+        with self._lock:
+            if generation is not None and self._stale(keys, generation):
+                return
+            for key in keys:
+                self._entries.pop(key, None)
+                self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, store, tid=None, order_number=None):
+        """Forget the transaction of ``tid`` or ``order_number``, by
+        both of its keys."""
+        with self._lock:
+            self._generation += 1
+            for key in (('tid', store, tid), ('order', store, order_number)):
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._discard(entry[1])
+                if key[2] is not None:
+                    self._invalidated.pop(key, None)
+                    self._invalidated[key] = self._generation
+            while len(self._invalidated) > self.maxsize:
+                self._floor = self._invalidated.popitem(last=False)[1]
+
+    def _stale(self, keys, generation):
+        if generation < self._floor:
+            return True
+        return any(self._invalidated.get(key, 0) > generation for key in keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                expires_at, transaction = entry
+                if expires_at > self.clock():
+                    # most recently used
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return transaction
+                self._discard(transaction)
+            self.misses += 1
+
+    def _discard(self, transaction):
+        # the other key of the transaction
+        for key in (('tid', transaction.store, transaction.tid),
+                    ('order', transaction.store, transaction.order)):
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is transaction:
+                del self._entries[key]
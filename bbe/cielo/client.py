@@ -1,47 +1,27 @@
 # -*- coding: utf-8 -*-
 import datetime
+import time
 import uuid
-import hashlib
-import urllib2
-import contextlib
+import Queue
+import logging
+import itertools
+import threading
+import colander
 from colander import null
 from bbe.cielo import message
+from bbe.cielo import metrics
+from bbe.cielo import orders
+from bbe.cielo import transport as transports
+from bbe.cielo.errors import CommunicationError, DeadlineExceededError, Error, \
+    TimeoutError, TransactionNotFoundError, TransactionNotCreatedError, UnresolvedTransactionError
+from bbe.cielo.executor import Executor, Future, SingleFlight, Timeout, imap_unordered
 from bbe.cielo import schema as schemas
 
-
-class CommunicationError(urllib2.URLError):
-    """This exception is raised when the communication between
-    our client and the remote service fail.
-
-    .. attribute:: reason
-
-        The error reason. It can be a message or an instance of
-        another exception.
-    """
-
-
-class Error(Exception):
-    code = None
-
-    def __init__(self, message, code):
-        self.code = code
-        self.message = message
-        super(Error, self).__init__(self.message)
-
-    @staticmethod
-    def get_error_class(code):
-        for cls in Error.__subclasses__():
-            if getattr(cls, 'code', None) == code:
-                return cls
-        return Error
-
-
-class TimeoutError(Error):
-    code = 98
+log = logging.getLogger(__name__)
 
 
 def get_object_like(appstruct, key, default=None):
-    value = appstruct.get(key, default)
+    value = appstruct.get(key, null)
     if value is null:
         value = default
     else:
@@ -57,7 +37,46 @@ class ObjectLikeDict(dict):
             raise AttributeError(name)
 
 
+# marks the nodes of a transaction that were not decoded yet
+_pending = object()
+
+
+class _LazyNode(object):
+    """A :class:`Transaction` attribute decoded on first access, and
+    then kept in ``slot``."""
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def __get__(self, transaction, cls):
+        if transaction is None:
+            return self
+        value = self.slot.__get__(transaction, cls)
+        if value is _pending:
+            transaction._decode_nodes()
+            value = self.slot.__get__(transaction, cls)
+        return value
+
+    def __set__(self, transaction, value):
+        self.slot.__set__(transaction, value)
+
+
 class Transaction(object):
+    """A transaction, as returned by the service.
+
+    The ``authentication``, ``authorization``, ``capture`` and
+    ``cancel`` nodes of responses are only decoded when one of them
+    is first accessed, so reading just the ``tid`` and the ``status``
+    of a transaction is cheap. Until then, only the raw response is
+    kept, which is smaller than the decoded nodes and much smaller
+    than its element tree. Thus, an invalid node is only reported (by
+    raising :class:`colander.Invalid`) when accessed.
+    """
+    __slots__ = ('tid', 'order', 'store', 'value', 'currency', 'datetime',
+                 'language', 'brand', 'installments', 'product', 'status',
+                 'pan', 'description', 'authentication_url', '_authentication',
+                 '_authorization', '_capture', '_cancel', '_nodes')
+
     def __init__(self, tid, order, store, value, currency, datetime,
                  language, brand, installments, product, status, pan,
                  description=None, authentication=None, authorization=None,
@@ -75,11 +94,56 @@ class Transaction(object):
         self.product = product
         self.status = status
         self.pan = pan
+        self.description = description
         self.authorization = authorization
         self.authentication = authentication
         self.cancel = cancel
         self.capture = capture
         self.authentication_url = authentication_url
+        self._nodes = None
+
+    def _defer(self, response, nodes):
+        """Decode the ``nodes`` of ``response``, a ``{name: (tag,
+        decoder)}`` dict, on demand."""
+        if nodes:
+            self._nodes = (response, nodes)
+            for name in nodes:
+                setattr(self, name, _pending)
+
+    def _decode_nodes(self):
+        # transactions may be shared between threads (by caches and
+        # coalesced queries), and decoding the same nodes twice is
+        # harmless. `_nodes` is only cleared once every node is set.
+        pending = self._nodes
+        if pending is None:
+            return
+        response, nodes = pending
+        root = message.loads(response).getroot()
+        values = [(name, get_object_like({name: decode(root.find(tag))}, name))
+                  for name, (tag, decode) in nodes.iteritems()]
+        for name, value in values:
+            setattr(self, name, value)
+        self._nodes = None
+
+    def __getstate__(self):
+        # pickles never keep elements: pending nodes are decoded
+        return dict((name.lstrip('_'), getattr(self, name.lstrip('_')))
+                    for name in self.__slots__ if name != '_nodes')
+
+    def __setstate__(self, state):
+        self._nodes = None
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+
+for name in ('authentication', 'authorization', 'capture', 'cancel'):
+    setattr(Transaction, name, _LazyNode(Transaction.__dict__['_' + name]))
+del name
+
+
+#: The executor of the hedged queries of every client that doesn't
+#: get one of its own. Its threads are only started as needed.
+default_hedge_executor = Executor(100)
 
 
 class Card(object):
@@ -93,48 +157,194 @@ class Card(object):
 
 class Client(object):
     _request_schema_map = schemas._compile_request_schemas()
+    # requests that differ only by a few short fields, rendered
+    # straight into form bodies
+    _template_tags = (
+        'requisicao-consulta',
+        'requisicao-consulta-chsec',
+        'requisicao-captura',
+        'requisicao-cancelamento',
+    )
+    # response decoders by (cents, validate, lazy)
+    _response_decoder_maps = {}
+    # transaction nodes decoded on demand
+    _lazy_nodes = ('authentication', 'authorization', 'capture', 'cancel')
+    # the key of each query, by tag
+    _query_keys = {
+        'requisicao-consulta': 'tid',
+        'requisicao-consulta-chsec': 'order_number',
+    }
 
     def __init__(self, store_id, store_key, default_installment_type,
                  service_url=schemas.SERVICE_URL,
                  default_currency=schemas.DEFAULT_CURRENCY,
-                 default_language=schemas.DEFAULT_LANGUAGE):
+                 default_language=schemas.DEFAULT_LANGUAGE,
+                 transport=None, pool=None, cents=False,
+                 trust_responses=False, sample_validation=None,
+                 order_number_generator=None, cache=None, coalesce=False,
+                 observer=None, timeout=None, timeouts=None, hedge=None,
+                 reconcile=False, reconcile_delays=(0.5, 1, 2, 4),
+                 limiter=None, hedge_executor=None):
         self.store_id = store_id
         self.store_key = store_key
         self.service_url = service_url
         self.default_installment_type = default_installment_type
         self.default_currency = default_currency
         self.default_language = default_language
+        # all clients share the same connections unless told otherwise
+        self.transport = transport or transports.PooledTransport(service_url, pool)
+        # monetary values are always accepted as Cents, but are only
+        # returned as Cents if asked to
+        self.cents = cents
+        # responses of a trusted transport are converted, but not
+        # validated, except for one in every `sample_validation`.
+        self.trust_responses = trust_responses
+        self.sample_validation = sample_validation
+        self._responses = itertools.count()
+        self.order_number_generator = order_number_generator or orders.default_generator
+        # a StatusCache for queries, refreshed by every transaction
+        # the service returns
+        self.cache = cache
+        # if asked to, concurrent identical queries share a single
+        # call; clients may share a SingleFlight too. a query joining
+        # one in flight gets its answer, which may predate a capture
+        # or cancel made meanwhile, so it is off by default
+        if isinstance(coalesce, SingleFlight):
+            self.single_flight = coalesce
+        else:
+            self.single_flight = SingleFlight() if coalesce else None
+        # a metrics.Observer of the timings of each request
+        self.observer = observer
+        # requests without a timeout of their own get this one, or
+        # the one of the AdaptiveTimeouts, whichever is shorter
+        self.timeout = timeout
+        self.timeouts = timeouts
+        # queries slower than `hedge` seconds (or, if True, than 95%
+        # of the queries seen by `timeouts`) are sent again. hedged
+        # queries run in `hedge_executor`, by default one shared by
+        # every client in the process
+        self.hedge = hedge
+        self.hedged = 0
+        if hedge:
+            self._hedge_lock = threading.Lock()
+            self._hedges = hedge_executor or default_hedge_executor
+        # transaction requests whose outcome is unknown are resolved
+        # by querying their order number after each of the delays
+        self.reconcile = reconcile
+        self.reconcile_delays = reconcile_delays
+        # a ratelimit.RateLimiter every request waits for
+        self.limiter = limiter
+        self._response_decoder_map, self._node_decoder_map = \
+            self._get_response_decoders(cents, not trust_responses, True)
+        self._validating_decoder_map = self._get_response_decoders(cents, True, False)[0]
+        self._compile_requests()
+
+    @classmethod
+    def _get_response_decoders(cls, cents, validate, lazy):
+        """Return the response decoders, by root tag, and the decoders
+        of the lazy transaction nodes, by name."""
+        decoders = cls._response_decoder_maps.get((cents, validate, lazy))
+        if decoders is None:
+            transaction = schemas.TransactionSchema()
+            if cents:
+                transaction = schemas._cents_schema(transaction)
+            node_decoders = {}
+            if lazy:
+                for name in cls._lazy_nodes:
+                    node = transaction[name]
+                    node_decoders[name] = (schemas.gettag(node),
+                                           message.compile_decoder(node, validate))
+                    del transaction[name]
+            decoders = cls._response_decoder_maps[cents, validate, lazy] = ({
+                'erro': message.compile_decoder(schemas.ErrorSchema(), validate),
+                'transacao': message.compile_decoder(transaction, validate),
+            }, node_decoders)
+        return decoders
+
+    def _compile_requests(self):
+        # the version and the establishment are the same in every
+        # request, so they are rendered just once
+        self._request_constants = {
+            'version': schemas.SERVICE_VERSION,
+            'establishment': {
+                'number': self.store_id,
+                'key': self.store_key,
+            },
+        }
+        # encoders are compiled as each tag is first used, which keeps
+        # clients cheap to create (see registry.ClientRegistry)
+        self._request_encoder_map = {}
+        self._request_template_map = {}
+
+    def _compile_request(self, tag, template=False):
+        """Compile the encoder of ``tag`` (or its template) and return
+        it, or ``None`` if there is no such request."""
+        if tag not in self._request_schema_map:
+            return None
+        if template:
+            if tag not in self._template_tags:
+                return None
+            encoders, quote = self._request_template_map, transports.quote
+        else:
+            encoders, quote = self._request_encoder_map, None
+        encoder = encoders[tag] = message.compile_encoder(
+            self._request_schema_map[tag], 'ISO-8859-1',
+            self._request_constants, quote)
+        return encoder
 
     def generate_request_id(self):
         return str(uuid.uuid4())
 
     def generate_order_number(self):
-        return hashlib.sha1(str(uuid.uuid4())).hexdigest()[:20]
+        return self.order_number_generator()
 
-    def query_by_tid(self, tid):
+    def query_by_tid(self, tid, timeout=None):
         return self._do_request('requisicao-consulta', {
             'tid': tid,
-        })
+        }, timeout)
 
-    def query_by_order_number(self, order_number):
+    def query_by_order_number(self, order_number, timeout=None):
         return self._do_request('requisicao-consulta-chsec', {
             'order_number': order_number,
-        })
-
-    def cancel_transaction(self, tid):
+        }, timeout)
+
+    def query_many(self, tids, max_workers=10):
+        """Query many transactions by tid, ``max_workers`` at a time.
+
+        Yields ``(tid, result)`` pairs as soon as each query finishes,
+        in no particular order. ``result`` is either the
+        :class:`Transaction` or the exception raised while querying
+        it (an :class:`Error`, a :class:`CommunicationError`, or even
+        a ``ValueError`` for a response that is not a document of
+        the service), so a failure doesn't abort the other queries.
+        """
+        return self._query_many('requisicao-consulta', 'tid', tids, max_workers)
+
+    def query_many_by_order_number(self, order_numbers, max_workers=10):
+        """Same as :meth:`query_many`, but for order numbers."""
+        return self._query_many('requisicao-consulta-chsec', 'order_number',
+                                order_numbers, max_workers)
+
+    def cancel_transaction(self, tid, timeout=None):
         return self._do_request('requisicao-cancelamento', {
             'tid': tid,
-        })
+        }, timeout)
 
-    def capture_transaction(self, tid):
+    def capture_transaction(self, tid, value=None, attachment=None, timeout=None):
+        """Capture ``value`` (by default, the whole authorized value)
+        of a transaction. ``attachment`` is a note, of up to 1024
+        characters, about the capture."""
         return self._do_request('requisicao-captura', {
             'tid': tid,
-        })
+            'value': null if value is None else value,
+            'attachment': attachment or null,
+        }, timeout)
 
     def create_transaction(self, value, card, installments, authorize,
                            capture, created_at=None, description=None,
                            currency=None, language=None, installment_type=None,
-                           return_url=None, product=None, order_number=None):
+                           return_url=None, product=None, order_number=None,
+                           timeout=None):
         currency = currency or self.default_currency
         language = language or self.default_language
 
@@ -199,6 +409,10 @@ class Client(object):
             }
             appstruct['bin'] =  card.number[:6]
 
+        data, timings, deadline = self._prepare('requisicao-transacao', appstruct, timeout)
+        return self._post_transaction_request(data, order_number, timings, deadline)
+
+    def _post_transaction_request(self, data, order_number, timings=None, deadline=None):
         # XXX as the order_number can be automatically generated by the us, if
         # something goes wrong during `process_response`, we must inform our
         # client what was the order number of the request. i coundn't figure
@@ -207,37 +421,194 @@ class Client(object):
         # possible, but that will require a rework of this API, and that is
         # something I can't do right now.
         try:
-            return self._do_request('requisicao-transacao', appstruct)
+            return self._send(data, timings, deadline)
         except (CommunicationError, Error), e:
             e.order_number = order_number
+            if isinstance(e, DeadlineExceededError) and not e.sent:
+                # the service never got it
+                raise e
+            if self.reconcile and (isinstance(e, CommunicationError)
+                                   or not e.idempotent_safe):
+                return self._reconcile(order_number, e, deadline)
             raise e
 
-    def post_request(self, request):
-        data = 'mensagem=' + request
-
+    def _reconcile(self, order_number, error, deadline=None):
+        """Find out whether a failed transaction request created the
+        transaction of ``order_number``, and return it. Gives up at
+        ``deadline``."""
+        log.warning("reconciling order %s after %r", order_number, error)
+        # whether the last query found no transaction, and its error
+        missing = False
+        query_error = None
+        for delay in self.reconcile_delays:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - metrics.timer() - delay
+                if timeout <= 0:
+                    break
+            time.sleep(delay)
+            try:
+                return self._call('requisicao-consulta-chsec', {
+                    'order_number': order_number,
+                }, timeout)
+            except TransactionNotFoundError:
+                # the request may still be on its way, so keep looking
+                missing = True
+                query_error = None
+            except (CommunicationError, Error), e:
+                missing = False
+                query_error = e
+                if isinstance(e, Error) and e.client_fault:
+                    # asking again won't help
+                    break
+
+        if missing:
+            e = TransactionNotCreatedError(error)
+        else:
+            e = UnresolvedTransactionError(error, query_error)
+        e.order_number = order_number
+        raise e
+
+    def post_request(self, request, timeout=None):
+        return self._send(transports.encode_message(request), None,
+                          self._deadline(None, timeout))
+
+    def _send(self, data, timings=None, deadline=None):
+        if self.observer is not None or self.timeouts is not None:
+            return self._observed_send(data, timings, deadline)
+        if self.limiter is not None:
+            self._throttle(deadline)
+        generation = self._generation()
+        if deadline is None:
+            response = self.transport.send(data)
+        else:
+            response = self.transport.send(data, self._remaining(deadline))
+        root_tag, root = self._parse_response(response)
+        return self._decode_response(response, root_tag, root, generation)
+
+    def _observed_send(self, data, timings, deadline):
+        """Same as :meth:`_send`, timing each phase."""
+        timer = metrics.timer
+        if timings is None:
+            timings = metrics.Timings(None, self.store_id)
+        timings.request_size = len(data)
         try:
-            request = urllib2.urlopen(self.service_url, data)
-            with contextlib.closing(request) as response:
-                response = response.read()
-        except urllib2.URLError, e:
-            raise CommunicationError(e.reason)
-
-        return self.process_response(response)
+            if self.limiter is not None:
+                self._throttle(deadline)
+            generation = self._generation()
+            started = timer()
+            try:
+                if deadline is None:
+                    response = self.transport.send(data)
+                else:
+                    response = self.transport.send(data, self._remaining(deadline))
+            finally:
+                timings.network = timer() - started
+            timings.response_size = len(response)
+
+            started = timer()
+            root_tag, root = self._parse_response(response)
+            parsed = timer()
+            timings.parse = parsed - started
+            timings.root_tag = root_tag
+            try:
+                return self._decode_response(response, root_tag, root, generation)
+            finally:
+                timings.decode = timer() - parsed
+        except Exception, e:
+            timings.error = e
+            if isinstance(e, Error):
+                timings.error_code = e.code
+            raise
+        finally:
+            for observer in (self.observer, self.timeouts):
+                if observer is not None:
+                    try:
+                        observer.observe(timings)
+                    except Exception:
+                        log.exception("observer failed")
+
+    def _throttle(self, deadline):
+        """Wait for the limiter, but not past ``deadline``."""
+        if deadline is None:
+            self.limiter.acquire()
+        elif not self.limiter.acquire(self._remaining(deadline)):
+            raise DeadlineExceededError()
+
+    def _deadline(self, tag, timeout):
+        """Return when a request must be answered by, as a
+        :func:`metrics.timer` time, or ``None``."""
+        if timeout is None:
+            timeout = self.timeout
+        if self.timeouts is not None:
+            adaptive = self.timeouts.timeout(tag)
+            if timeout is None or adaptive < timeout:
+                timeout = adaptive
+        if timeout is not None:
+            return metrics.timer() + timeout
+
+    def _remaining(self, deadline):
+        remaining = deadline - metrics.timer()
+        if remaining <= 0:
+            raise DeadlineExceededError()
+        return remaining
+
+    def _hedged_send(self, data, timings, deadline, delay):
+        """Send a query and, if it takes longer than ``delay`` seconds,
+        send it again, returning whichever answer comes first."""
+        first = self._hedges.submit(self._send, data, timings, deadline)
+        try:
+            return first.result(delay)
+        except Timeout:
+            pass
+
+        with self._hedge_lock:
+            self.hedged += 1
+        if timings is not None:
+            timings = metrics.Timings(timings.tag, timings.store)
+        second = self._hedges.submit(self._send, data, timings, deadline)
+        answers = Queue.Queue()
+        first.add_done_callback(answers.put)
+        second.add_done_callback(answers.put)
+
+        for attempt in first, second:
+            timeout = None if deadline is None else max(0, deadline - metrics.timer())
+            try:
+                answer = answers.get(timeout=timeout)
+            except Queue.Empty:
+                raise DeadlineExceededError(sent=True)
+            error = answer.exception()
+            if not (isinstance(error, CommunicationError)
+                    or isinstance(error, Error) and error.retryable):
+                break
+            # the other attempt may still succeed
+        return answer.result()
 
     def process_response(self, response):
+        root_tag, root = self._parse_response(response)
+        return self._decode_response(response, root_tag, root)
+
+    def _parse_response(self, response):
         etree = message.loads(response)
         root_tag = message.get_root_tag(etree)
-
-        if root_tag == 'erro':
-            schema = schemas.ErrorSchema()
-        elif root_tag == 'transacao':
-            schema = schemas.TransactionSchema()
-        else:
+        if root_tag not in self._response_decoder_map:
             # the service only returns errors or transactions.
             raise ValueError("Invalid response: %s" % root_tag)
-
-        cstruct = message.deserialize(schema, etree)
-        appstruct = schema.deserialize(cstruct)
+        return root_tag, etree.getroot()
+
+    def _generation(self):
+        """Return the cache generation a request is sent at, so that
+        its response doesn't overwrite a later invalidation."""
+        if self.cache is not None:
+            return self.cache.generation()
+
+    def _decode_response(self, response, root_tag, root, generation=None):
+        decoder = self._response_decoder_map[root_tag]
+        if (self.trust_responses and self.sample_validation
+                and next(self._responses) % self.sample_validation == 0):
+            appstruct = self._validate_response(root_tag, root, response)
+        else:
+            appstruct = decoder(root)
 
         if root_tag == 'erro':
             error_class = Error.get_error_class(appstruct['code'])
@@ -246,7 +617,7 @@ class Client(object):
         order = appstruct['order']
         payment = appstruct['payment']
         status = appstruct['status']
-        return Transaction(
+        transaction = Transaction(
             tid=appstruct['tid'],
             store=self.store_id,
             datetime=order['datetime'],
@@ -267,24 +638,159 @@ class Client(object):
             cancel=get_object_like(appstruct, 'cancel'),
         )
 
-    def _do_request(self, tag, data):
-        request = self._build_request(tag, data)
-        return self.post_request(request)
+        # nodes missing from the appstruct are decoded on demand
+        nodes = {}
+        for name, node in self._node_decoder_map.iteritems():
+            if name not in appstruct and root.find(node[0]) is not None:
+                nodes[name] = node
+        transaction._defer(response, nodes)
 
-    def _build_request(self, tag, appstruct):
-        appstruct.update({
-            'id': self.generate_request_id(),
-            'version': schemas.SERVICE_VERSION,
-            'establishment': {
-                'number': self.store_id,
-                'key': self.store_key,
-            },
-        })
+        if self.cache is not None:
+            self.cache.put(transaction, generation)
+        return transaction
+
+    def _validate_response(self, root_tag, element, response):
+        try:
+            return self._validating_decoder_map[root_tag](element)
+        except colander.Invalid, e:
+            self.report_validation_error(response, e)
+        return self._response_decoder_map[root_tag](element)
+
+    def report_validation_error(self, response, error):
+        """Called when a sampled response of a trusted transport fails
+        validation. ``error`` is the :class:`colander.Invalid` raised,
+        and ``response`` the raw response body."""
+        log.warning("trusted response failed validation: %r", error.asdict())
+
+    def _cached(self, tag, data):
+        """Return the cached transaction of a query, or ``None``."""
+        if self.cache is None:
+            return None
+        if tag == 'requisicao-consulta':
+            return self.cache.get_by_tid(self.store_id, data['tid'])
+        if tag == 'requisicao-consulta-chsec':
+            return self.cache.get_by_order_number(self.store_id, data['order_number'])
+        # whatever the outcome of captures and cancels, the cached
+        # transaction is stale
+        self.cache.invalidate(self.store_id, tid=data.get('tid'))
+
+    def _flight_key(self, tag, data):
+        """Return the key under which a query is coalesced, or ``None``
+        if the request must be sent on its own."""
+        key = self._query_keys.get(tag)
+        if key is None or self.single_flight is None:
+            return None
+        return (self.store_id, tag, data[key])
+
+    def _request(self, tag, data, timeout=None):
+        transaction = self._cached(tag, data)
+        if transaction is not None:
+            return transaction
+        key = self._flight_key(tag, data)
+        if key is None:
+            return self._call(tag, data, timeout)
+        return self.single_flight.do(key, self._call, tag, data, timeout)
+
+    def _call(self, tag, data, timeout=None):
+        """Build a request and send it."""
+        return self._dispatch(tag, *self._prepare(tag, data, timeout))
+
+    def _prepare(self, tag, appstruct, timeout):
+        """Build the form body of a request, and return it with the
+        timings and the deadline to send it with."""
+        if self.observer is None and self.timeouts is None:
+            return self._build_message(tag, appstruct), None, self._deadline(tag, timeout)
+        started = metrics.timer()
+        data = self._build_message(tag, appstruct)
+        timings = metrics.Timings(tag, self.store_id, metrics.timer() - started)
+        return data, timings, self._deadline(tag, timeout)
+
+    def _dispatch(self, tag, data, timings, deadline):
+        """Send a request, hedging it if it is a query."""
+        if self.hedge and tag in self._query_keys:
+            if self.hedge is not True:
+                delay = self.hedge
+            elif self.timeouts is not None:
+                delay = self.timeouts.latency(tag, 95)
+            else:
+                delay = None
+            if delay is not None:
+                return self._hedged_send(data, timings, deadline, delay)
+        return self._send(data, timings, deadline)
+
+    def _do_request(self, tag, data, timeout=None):
+        return self._request(tag, data, timeout)
+
+    def _query_many(self, tag, key, values, max_workers):
+        def query(value):
+            return self._request(tag, {key: value})
+
+        for value, future in imap_unordered(query, values, max_workers):
+            error = future.exception()
+            if error is None:
+                yield value, future.result()
+            elif isinstance(error, Exception):
+                yield value, error
+            else:
+                future.result()
 
-        schema = self._request_schema_map.get(tag)
-        if schema is None:
+    def _build_request(self, tag, appstruct):
+        encoder = self._request_encoder_map.get(tag)
+        if encoder is None:
+            encoder = self._compile_request(tag)
+        if encoder is None:
             raise ValueError(u"invalid request tag: `%s'" % tag)
 
-        cstruct = schema.serialize(appstruct)
-        etree = message.serialize(schema, cstruct)
-        return message.dumps(etree, encoding='ISO-8859-1')
+        appstruct['id'] = self.generate_request_id()
+        return encoder(appstruct)
+
+    def _build_message(self, tag, appstruct):
+        """Build the form body of a request."""
+        template = self._request_template_map.get(tag)
+        if template is None:
+            template = self._compile_request(tag, template=True)
+        if template is None:
+            return transports.encode_message(self._build_request(tag, appstruct))
+
+        appstruct['id'] = self.generate_request_id()
+        return transports.encode_message(template(appstruct), quoted=True)
+
+
+class AsyncClient(Client):
+    """A :class:`Client` whose requests don't block the caller.
+
+    Every request method takes the same arguments of its
+    :class:`Client` counterpart, but returns a
+    :class:`~bbe.cielo.executor.Future` of its result instead.
+    Requests are built in the calling thread, so invalid arguments
+    are raised right away. The network call and the response
+    processing run in the ``executor`` threads, which share the
+    connection pool, so many calls can be in flight at once.
+
+    ::
+
+        >>> future = client.query_by_tid(tid)
+        >>> transaction = future.result()
+    """
+    def __init__(self, store_id, store_key, default_installment_type,
+                 executor=None, max_workers=100, **kwargs):
+        super(AsyncClient, self).__init__(store_id, store_key,
+                                          default_installment_type, **kwargs)
+        self.executor = executor or Executor(max_workers)
+
+    def _post_transaction_request(self, data, order_number, timings=None, deadline=None):
+        post = super(AsyncClient, self)._post_transaction_request
+        return self.executor.submit(post, data, order_number, timings, deadline)
+
+    def _do_request(self, tag, data, timeout=None):
+        transaction = self._cached(tag, data)
+        if transaction is not None:
+            future = Future()
+            future.set_result(transaction)
+            return future
+        key = self._flight_key(tag, data)
+        args = (tag,) + self._prepare(tag, data, timeout)
+        if key is None:
+            return self.executor.submit(self._dispatch, *args)
+        return self.single_flight.submit(
+            key, lambda: self.executor.submit(self._dispatch, *args))
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+import urllib2
+
+
+class CommunicationError(urllib2.URLError):
+    """This exception is raised when the communication between
+    our client and the remote service fail.
+
+    .. attribute:: reason
+
+        The error reason. It can be a message or an instance of
+        another exception.
+    """
+
+
+class DeadlineExceededError(CommunicationError):
+    """The deadline of a request passed.
+
+    .. attribute:: sent
+
+        Whether the request had been sent by then. If not, the
+        service never got it.
+    """
+    def __init__(self, sent=False):
+        super(DeadlineExceededError, self).__init__('deadline exceeded')
+        self.sent = sent
+
+
+class ReconciliationError(CommunicationError):
+    """Raised by clients that reconcile transaction requests (see the
+    ``reconcile`` option of :class:`~bbe.cielo.client.Client`) when
+    a request failed and no transaction was found for its order
+    number.
+
+    .. attribute:: reason
+
+        The failure of the transaction request.
+
+    .. attribute:: order_number
+
+        The order number of the transaction request.
+
+    .. attribute:: query_error
+
+        The error of the last query of the order number, or ``None``
+        if it told that there is no transaction.
+    """
+    idempotent_safe = False
+
+    def __init__(self, reason, query_error=None):
+        super(ReconciliationError, self).__init__(reason)
+        self.query_error = query_error
+
+
+class TransactionNotCreatedError(ReconciliationError):
+    """Every query of the order number told that it has no
+    transaction, so the request had no effect and may be sent
+    again."""
+    idempotent_safe = True
+
+
+class UnresolvedTransactionError(ReconciliationError):
+    """The queries of the order number failed too, so whether the
+    transaction was created is still unknown."""
+
+
+# error classes, by code
+_error_classes = {}
+
+
+class ErrorType(type):
+    """Indexes every :class:`Error` subclass that defines a ``code``,
+    so that :meth:`Error.get_error_class` is a single lookup."""
+
+    def __init__(cls, name, bases, attrs):
+        super(ErrorType, cls).__init__(name, bases, attrs)
+        if attrs.get('code') is not None:
+            _error_classes[attrs['code']] = cls
+
+
+class Error(Exception):
+    """An error returned by the service.
+
+    Besides its ``code``, each error class tells what can be done
+    about it:
+
+    .. attribute:: retryable
+
+        Sending the same request again may succeed.
+
+    .. attribute:: idempotent_safe
+
+        The request certainly had no effect, so it is safe to send it
+        again. When false, the outcome of the request is unknown and
+        should be checked (by querying the transaction) before
+        retrying.
+
+    .. attribute:: client_fault
+
+        The request itself is wrong (or not allowed in the current
+        state of the transaction), and will fail again as is.
+
+    .. attribute:: gateway_fault
+
+        The service failed to process the request.
+
+    Errors with unknown codes are neither retryable nor safe.
+    """
+    __metaclass__ = ErrorType
+
+    code = None
+    description = None
+    retryable = False
+    idempotent_safe = False
+    client_fault = False
+    gateway_fault = False
+
+    def __init__(self, message, code):
+        self.code = code
+        self.message = message
+        super(Error, self).__init__(self.message)
+
+    @staticmethod
+    def get_error_class(code):
+        return _error_classes.get(code, Error)
+
+
+class ClientError(Error):
+    """The request was refused and had no effect."""
+    idempotent_safe = True
+    client_fault = True
+
+
+class GatewayError(Error):
+    """The service failed; trying again later may work."""
+    retryable = True
+    idempotent_safe = True
+    gateway_fault = True
+
+
+class InvalidMessageError(ClientError):
+    code = 1
+    description = u'Mensagem inválida'
+
+
+class InvalidCredentialsError(ClientError):
+    code = 2
+    description = u'Credenciais inválidas'
+
+
+class TransactionNotFoundError(ClientError):
+    code = 3
+    description = u'Transação inexistente'
+
+
+class InconsistentCardError(ClientError):
+    code = 10
+    description = u'Inconsistência no envio do cartão'
+
+
+class PaymentMethodNotEnabledError(ClientError):
+    code = 11
+    description = u'Modalidade não habilitada'
+
+
+class InvalidInstallmentsError(ClientError):
+    code = 12
+    description = u'Número de parcelas inválido'
+
+
+class InvalidAuthorizeFlagError(ClientError):
+    code = 13
+    description = u'Flag de autorização automática inválida'
+
+
+class InvalidDirectAuthorizationError(ClientError):
+    code = 14
+    description = u'Autorização Direta inválida'
+
+
+class DirectAuthorizationWithoutCardError(ClientError):
+    code = 15
+    description = u'Autorização Direta sem Cartão'
+
+
+class InvalidTidError(ClientError):
+    code = 16
+    description = u'Identificador, TID, inválido'
+
+
+class SecurityCodeMissingError(ClientError):
+    code = 17
+    description = u'Código de segurança ausente'
+
+
+class InconsistentSecurityCodeIndicatorError(ClientError):
+    code = 18
+    description = u'Indicador de código de segurança inconsistente'
+
+
+class ReturnUrlMissingError(ClientError):
+    code = 19
+    description = u'URL de Retorno não fornecida'
+
+
+class AuthorizationNotAllowedError(ClientError):
+    code = 20
+    description = u'Status não permite autorização'
+
+
+class AuthorizationExpiredError(ClientError):
+    code = 21
+    description = u'Prazo de autorização vencido'
+
+
+class InstallmentsNotAllowedError(ClientError):
+    code = 22
+    description = u'Número de parcelas inválido'
+
+
+class AuthorizationForwardingNotAllowedError(ClientError):
+    code = 25
+    description = u'Encaminhamento a autorização não permitido'
+
+
+class CaptureNotAllowedError(ClientError):
+    code = 30
+    description = u'Status inválido para captura'
+
+
+class CaptureExpiredError(ClientError):
+    code = 31
+    description = u'Prazo de captura vencido'
+
+
+class InvalidCaptureValueError(ClientError):
+    code = 32
+    description = u'Valor de captura inválido'
+
+
+class CaptureFailedError(GatewayError):
+    code = 33
+    description = u'Falha ao capturar'
+
+
+class BoardingFeeRequiredError(ClientError):
+    code = 34
+    description = u'Valor da taxa de embarque obrigatório'
+
+
+class BoardingFeeBrandError(ClientError):
+    code = 35
+    description = u'Bandeira inválida para utilização da Taxa de Embarque'
+
+
+class BoardingFeeProductError(ClientError):
+    code = 36
+    description = u'Produto inválido para utilização da Taxa de Embarque'
+
+
+class CancelExpiredError(ClientError):
+    code = 40
+    description = u'Prazo de cancelamento vencido'
+
+
+class CancelNotAllowedError(ClientError):
+    code = 41
+    description = u'Status não permite cancelamento'
+
+
+class CancelFailedError(GatewayError):
+    code = 42
+    description = u'Falha ao cancelar'
+
+
+class InvalidCancelValueError(ClientError):
+    code = 43
+    description = u'Valor de cancelamento é maior que valor autorizado'
+
+
+class InvalidRecurrenceError(ClientError):
+    code = 51
+    description = u'Recorrência Inválida'
+
+
+class InvalidTokenError(ClientError):
+    code = 52
+    description = u'Token Inválido'
+
+
+class RecurrenceNotEnabledError(ClientError):
+    code = 53
+    description = u'Recorrência não habilitada'
+
+
+class InvalidTokenTransactionError(ClientError):
+    code = 54
+    description = u'Transação com Token inválida'
+
+
+class CardNumberMissingError(ClientError):
+    code = 55
+    description = u'Número do cartão não fornecido'
+
+
+class ExpirationDateMissingError(ClientError):
+    code = 56
+    description = u'Validade do cartão não fornecida'
+
+
+class TokenGenerationError(GatewayError):
+    code = 57
+    description = u'Erro inesperado gerando Token'
+
+
+class InvalidRecurringTransactionError(ClientError):
+    code = 61
+    description = u'Transação Recorrente Inválida'
+
+
+class XidMissingError(ClientError):
+    code = 77
+    description = u'XID não fornecido'
+
+
+class CavvMissingError(ClientError):
+    code = 78
+    description = u'CAVV não fornecido'
+
+
+class XidAndCavvMissingError(ClientError):
+    code = 86
+    description = u'XID e CAVV não fornecidos'
+
+
+class InvalidCavvLengthError(ClientError):
+    code = 87
+    description = u'CAVV com tamanho divergente'
+
+
+class InvalidXidLengthError(ClientError):
+    code = 88
+    description = u'XID com tamanho divergente'
+
+
+class InvalidEciLengthError(ClientError):
+    code = 89
+    description = u'ECI com tamanho divergente'
+
+
+class InvalidEciError(ClientError):
+    code = 90
+    description = u'ECI inválido'
+
+
+class AuthenticationInternalError(GatewayError):
+    code = 95
+    description = u'Erro interno de autenticação'
+
+
+class UnavailableError(GatewayError):
+    code = 97
+    description = u'Sistema indisponível'
+
+
+class TimeoutError(GatewayError):
+    """The service didn't answer in time, so the request may or may
+    not have been processed."""
+    code = 98
+    description = u'Timeout'
+    idempotent_safe = False
+
+
+class UnexpectedError(GatewayError):
+    """The outcome of the request is unknown."""
+    code = 99
+    description = u'Erro inesperado'
+    idempotent_safe = False
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import Queue
+import threading
+
+
+class Timeout(Exception):
+    """Raised when waiting for a :class:`Future` takes too long."""
+
+
+class Cancelled(Exception):
+    """Raised by a :class:`Future` whose call was given up on."""
+
+
+class Future(object):
+    """The result of a call running in an :class:`Executor`.
+
+    This is a tiny subset of the ``concurrent.futures.Future`` API,
+    which is not available in our python.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        """Wait for the call to finish and return its result, or raise
+        its exception."""
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for the call to finish and return the exception it
+        raised, or ``None``."""
+        self._wait(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        """Call ``fn(future)`` once the call finishes. If it is already
+        finished, ``fn`` is called right away."""
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, exception, traceback=None):
+        self._set(None, (type(exception), exception, traceback))
+
+    def _set(self, result, exc_info):
+        with self._condition:
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            self._condition.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise Timeout()
+
+
+class Executor(object):
+    """Runs calls in a pool of at most ``max_workers`` daemon threads.
+
+    Threads are started on demand, so an idle executor costs nothing.
+    """
+    def __init__(self, max_workers=10):
+        self.max_workers = max_workers
+        self._shutdown = False
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._idle = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule ``fn(*args, **kwargs)`` and return its
+        :class:`Future`."""
+        if self._pid != os.getpid():
+            # threads don't survive a fork
+            self._reset()
+
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            self._queue.put((future, fn, args, kwargs))
+            if not self._idle and len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            else:
+                self._idle -= 1
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop the worker threads once the pending calls finish. No
+        calls may be submitted afterwards."""
+        with self._lock:
+            self._shutdown = True
+            threads, self._threads = self._threads, []
+            for thread in threads:
+                self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+            except:
+                future.set_exception(*sys.exc_info()[1:])
+            else:
+                future.set_result(result)
+            del future, fn, args, kwargs, item
+
+            with self._lock:
+                self._idle += 1
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls with the same key: while a call is
+    in flight, the calls with its key wait for it and share its
+    result (or exception) instead of making their own.
+
+    .. attribute:: calls
+
+        How many calls were actually made.
+
+    .. attribute:: saved
+
+        How many calls were spared by joining one in flight.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.saved = 0
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """Call ``fn(*args, **kwargs)``, unless a call with ``key`` is
+        in flight, and return its result."""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                self.saved += 1
+                leader = False
+            else:
+                future = self._futures[key] = Future()
+                self.calls += 1
+                leader = True
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except:
+            exc_info = sys.exc_info()
+            self._finish(key)
+            future.set_exception(*exc_info[1:])
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._finish(key)
+        future.set_result(result)
+        return result
+
+    def submit(self, key, start):
+        """Return the :class:`Future` of the call with ``key`` in
+        flight or, if there is none, the one returned by
+        ``start()``."""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                self.saved += 1
+                return future
+            future = self._futures[key] = start()
+            self.calls += 1
+        future.add_done_callback(lambda future: self._finish(key, future))
+        return future
+
+    def _finish(self, key, future=None):
+        with self._lock:
+            if future is None or self._futures.get(key) is future:
+                del self._futures[key]
+
+
+def imap_unordered(fn, iterable, max_workers=10):
+    """Call ``fn`` for each item of ``iterable`` in at most
+    ``max_workers`` threads, and yield ``(item, future)`` pairs as
+    soon as each call finishes.
+
+    Items are consumed lazily, so ``iterable`` may be a long (or
+    endless) generator. Closing the returned generator stops the
+    workers once their current calls finish.
+    """
+    items = iter(iterable)
+    lock = threading.Lock()
+    results = Queue.Queue()
+    done = object()
+    stopped = []
+
+    def work():
+        while not stopped:
+            with lock:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                except:
+                    future = Future()
+                    future.set_exception(*sys.exc_info()[1:])
+                    results.put((done, future))
+                    return
+
+            future = Future()
+            try:
+                future.set_result(fn(item))
+            except:
+                future.set_exception(*sys.exc_info()[1:])
+            results.put((item, future))
+
+        results.put((done, None))
+
+    threads = []
+    for i in range(max_workers):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        running = len(threads)
+        while running:
+            item, future = results.get()
+            if item is done:
+                running -= 1
+                if future is not None:
+                    # iterating over the items failed
+                    future.result()
+            else:
+                yield item, future
+    finally:
+        stopped.append(True)
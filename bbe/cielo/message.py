@@ -1,11 +1,56 @@
+import os
 import re
 import colander
+import importlib
+import threading
+from cStringIO import StringIO
 from .schema import gettag, isattrib
 
-try:
-    import xml.etree.cElementTree as etree
-except ImportError:
-    import xml.etree.ElementTree as etree
+#: The supported ElementTree implementations, by order of preference.
+BACKENDS = (
+    ('lxml', 'lxml.etree'),
+    ('cElementTree', 'xml.etree.cElementTree'),
+    ('ElementTree', 'xml.etree.ElementTree'),
+)
+
+#: The ElementTree implementation in use, and its name.
+etree = None
+backend = None
+
+
+def use_backend(name=None):
+    """Use the ``name`` ElementTree implementation, one of
+    :data:`BACKENDS`, and return the name of the previous one.
+
+    By default, the first available implementation is used. Set the
+    ``BBE_CIELO_XML_BACKEND`` environment variable to force one.
+    """
+    global etree, backend
+    for candidate, module in BACKENDS:
+        if name is not None and name != candidate:
+            continue
+        try:
+            etree = importlib.import_module(module)
+        except ImportError:
+            if name is None:
+                continue
+            raise
+        previous, backend = backend, candidate
+        return previous
+    raise ValueError("unknown xml backend: `%s'" % name)
+
+
+def available_backends():
+    """Return the names of the ElementTree implementations that can
+    be imported."""
+    available = []
+    for name, module in BACKENDS:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            continue
+        available.append(name)
+    return available
 
 
 def _build_element(node):
@@ -25,12 +70,14 @@ def _serialize(schema, cstruct):
         return _serialize_mapping(schema, cstruct)
     else:
         element = _build_element(schema)
-        element.text = cstruct
+        # lxml writes empty texts as <tag></tag>
+        element.text = cstruct or None
         return element
 
 
 def _serialize_mapping(schema, cstruct):
     element = _build_element(schema)
+    attributes = []
 
     for child in schema:
         subtag = gettag(child)
@@ -41,15 +88,227 @@ def _serialize_mapping(schema, cstruct):
             continue
 
         if isattrib(child):
-            element.attrib[subtag] = subvalue
+            attributes.append((subtag, subvalue))
         else:
             subelement = _serialize(child, subvalue)
             if subelement is not None:
                 element.append(subelement)
 
+    # ElementTree sorts attributes, lxml keeps them in insertion order
+    for subtag, subvalue in sorted(attributes):
+        element.attrib[subtag] = subvalue
+
     return element
 
 
+def compile_encoder(schema, encoding=None, constants=None, quote=None):
+    """Compile ``schema`` into a function that serializes appstructs
+    straight into a document.
+
+    ``compile_encoder(schema, encoding)(appstruct)`` returns the same
+    bytes of ``dumps(serialize(schema, schema.serialize(appstruct)),
+    encoding)``, in a single pass over the schema and without building
+    an element tree. Invalid appstructs raise the same
+    :class:`colander.Invalid` errors.
+
+    ``constants`` maps children of the root node to values that are
+    the same for every document. They are rendered once, here, and
+    need not be given to the encoder. If ``quote`` is given, every
+    piece of the document is passed through it, so the result may be
+    escaped for a transport on the fly (constant pieces are quoted
+    just once, too).
+    """
+    constants = constants or {}
+    quote = quote or str    # str() of a str is the str itself
+    encode = _compile_node(schema, encoding or 'us-ascii', quote, constants)
+    if encoding is None or encoding.lower() in ('utf-8', 'us-ascii'):
+        declaration = ''
+    else:
+        declaration = quote("<?xml version='1.0' encoding='%s'?>\n" % encoding)
+
+    def encoder(appstruct):
+        out = [declaration]
+        try:
+            encode(appstruct, out)
+        except colander.Invalid:
+            # let colander build the error, so it is reported exactly
+            # as in the reference implementation
+            if constants:
+                appstruct = dict(appstruct, **constants)
+            schema.serialize(appstruct)
+            raise
+        return ''.join(out)
+
+    return encoder
+
+
+def _compile_node(node, encoding, quote, constants=None):
+    tag = gettag(node)
+    default = node.default
+    if isinstance(default, colander.deferred):
+        default = colander.null
+
+    if not isinstance(node.typ, colander.Mapping):
+        typ_serialize = node.typ.serialize
+        opening, closing, empty = [quote(s) for s in ('<%s>' % tag, '</%s>' % tag,
+                                                      '<%s/>' % tag)]
+
+        def encode_leaf(appstruct, out):
+            if appstruct is colander.null:
+                appstruct = default
+            cstruct = typ_serialize(node, appstruct)
+            if cstruct is colander.null:
+                return
+            if cstruct:
+                out.append(opening)
+                out.append(quote(_escape_text(cstruct, encoding)))
+                out.append(closing)
+            else:
+                out.append(empty)
+
+        return encode_leaf
+
+    if node.typ.unknown != 'ignore':
+        # not worth compiling, use the reference implementation
+        def encode_reference(appstruct, out):
+            if constants:
+                appstruct = dict(appstruct, **constants)
+            tree = serialize(node, node.serialize(appstruct))
+            out.append(quote(dumps(tree, encoding).split('?>\n', 1)[-1]))
+        return encode_reference
+
+    # children listed in ``constants`` are rendered right away, and
+    # written as a single fragment by the encoder
+    attributes = []
+    elements = []
+    for child in node.children:
+        drop = child.default is colander.drop
+        if isattrib(child):
+            child_default = child.default
+            if isinstance(child_default, colander.deferred):
+                child_default = colander.null
+            attributes.append([child.name, gettag(child), drop, child,
+                               child.typ.serialize, child_default, None])
+        else:
+            elements.append([child.name, drop,
+                             _compile_node(child, encoding, quote), None])
+    attributes.sort(key=lambda attribute: attribute[1])
+
+    for name, value in (constants or {}).iteritems():
+        for attribute in attributes:
+            if attribute[0] == name:
+                child, typ_serialize, child_default = attribute[3:6]
+                if value is colander.null:
+                    value = child_default
+                cstruct = typ_serialize(child, value)
+                if cstruct is colander.null:
+                    attribute[-1] = ''
+                else:
+                    attribute[-1] = quote(' %s="%s"' % (attribute[1],
+                                                       _escape_attrib(cstruct, encoding)))
+                break
+        else:
+            for element in elements:
+                if element[0] == name:
+                    fragment = []
+                    element[2](value, fragment)
+                    element[-1] = ''.join(fragment)
+                    break
+            else:
+                raise ValueError("unknown constant: `%s'" % name)
+
+    opening, closing = quote('<%s' % tag), quote('</%s>' % tag)
+    end, empty_end = quote('>'), quote('/>')
+
+    def encode_mapping(appstruct, out):
+        if appstruct is colander.null:
+            appstruct = default
+        if appstruct is colander.null:
+            appstruct = {}
+        elif not hasattr(appstruct, 'items'):
+            # colander will complain about it
+            raise colander.Invalid(node)
+
+        out.append(opening)
+        for name, tag, drop, child, serialize, child_default, fragment in attributes:
+            if fragment is not None:
+                out.append(fragment)
+                continue
+            value = appstruct.get(name, colander.null)
+            if value is colander.drop or (value is colander.null and drop):
+                continue
+            if value is colander.null:
+                value = child_default
+            cstruct = serialize(child, value)
+            if cstruct is not colander.null:
+                out.append(quote(' %s="%s"' % (tag, _escape_attrib(cstruct, encoding))))
+
+        start = len(out)
+        out.append(end)
+        for name, drop, encode, fragment in elements:
+            if fragment is not None:
+                if fragment:
+                    out.append(fragment)
+                continue
+            value = appstruct.get(name, colander.null)
+            if value is colander.drop or (value is colander.null and drop):
+                continue
+            encode(value, out)
+
+        if len(out) == start + 1:
+            out[start] = empty_end
+        else:
+            out.append(closing)
+
+    return encode_mapping
+
+
+# lxml refuses these, and escapes carriage returns (and, in
+# attributes, tabs) that ElementTree writes as they are. the escaping
+# of the compiled encoders follows the backend in use.
+_lxml_invalid_regex = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _check_lxml(text):
+    if _lxml_invalid_regex.search(text):
+        raise ValueError("All strings must be XML compatible: Unicode or ASCII, "
+                         "no NULL bytes or control characters")
+
+
+def _escape_text(text, encoding):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if backend == 'lxml':
+        _check_lxml(text)
+        if '\r' in text:
+            text = text.replace('\r', '&#13;')
+    return text.encode(encoding, 'xmlcharrefreplace')
+
+
+def _escape_attrib(text, encoding):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    if backend == 'lxml':
+        _check_lxml(text)
+        if '\r' in text:
+            text = text.replace('\r', '&#13;')
+        if '\t' in text:
+            text = text.replace('\t', '&#9;')
+    return text.encode(encoding, 'xmlcharrefreplace')
+
+
 def deserialize(schema, tree):
     element = tree.getroot()
     return _deserialize(schema, element)
@@ -81,6 +340,121 @@ def _deserialize_mapping(schema, element):
     return cstruct
 
 
+def compile_decoder(schema, validate=True):
+    """Compile ``schema`` into a function that deserializes elements
+    straight into appstructs.
+
+    ``compile_decoder(schema)(tree.getroot())`` returns the same of
+    ``schema.deserialize(deserialize(schema, tree))``, visiting each
+    element once through a tag to handler dispatch table, instead of
+    searching the children of each element once per schema node and
+    then walking the resulting cstruct again. Invalid documents raise
+    the same :class:`colander.Invalid` errors.
+
+    With ``validate=False`` the validators of the nodes are skipped:
+    values are still converted, and required values still checked,
+    but not validated. Meant for documents from a trusted source.
+    """
+    decode = _compile_decoder_node(schema, validate)
+
+    def decoder(element):
+        try:
+            return decode(element)
+        except colander.Invalid:
+            # let colander build the error, so it is reported exactly
+            # as in the reference implementation
+            schema.deserialize(_deserialize(schema, element))
+            raise
+
+    return decoder
+
+
+def _compile_decoder_node(node, validate=True):
+    missing = node.missing
+    validator = node.validator if validate else None
+    preparer = node.preparer
+
+    def finish(appstruct):
+        if preparer is not None:
+            if hasattr(preparer, '__call__'):
+                appstruct = preparer(appstruct)
+            else:
+                for prepare in preparer:
+                    appstruct = prepare(appstruct)
+
+        if appstruct is colander.null:
+            if missing is colander.required or isinstance(missing, colander.deferred):
+                raise colander.Invalid(node)
+            return missing
+
+        if validator is not None:
+            validator(node, appstruct)
+        return appstruct
+
+    if not isinstance(node.typ, colander.Mapping):
+        deserialize = node.typ.deserialize
+
+        # leaves receive the text of their element
+        def decode_leaf(text):
+            return finish(deserialize(node, text))
+
+        return decode_leaf
+
+    attributes = []
+    handlers = {}
+    children = []
+    for child in node.children:
+        drop = child.default is colander.drop
+        decode = _compile_decoder_node(child, validate)
+        mapping = isinstance(child.typ, colander.Mapping)
+        if isattrib(child):
+            attributes.append((child.name, gettag(child), drop, decode))
+        else:
+            handlers.setdefault(gettag(child), (child.name, drop, decode, mapping))
+            children.append((child.name, drop, decode, mapping))
+
+    def decode_mapping(element):
+        if element is None:
+            return finish(colander.null)
+
+        appstruct = {}
+        for name, tag, drop, decode in attributes:
+            value = element.attrib.get(tag, colander.null)
+            if value is colander.null and drop:
+                continue
+            appstruct[name] = decode(value)
+
+        found = set()
+        for subelement in element:
+            handler = handlers.get(subelement.tag)
+            if handler is None:
+                continue
+            name, drop, decode, mapping = handler
+            if name in found:
+                # the reference implementation only sees the first one
+                continue
+            found.add(name)
+            if mapping:
+                appstruct[name] = decode(subelement)
+            else:
+                text = subelement.text
+                if text is None:
+                    if drop:
+                        continue
+                    text = colander.null
+                appstruct[name] = decode(text)
+
+        if len(found) < len(children):
+            for name, drop, decode, mapping in children:
+                if name in found or drop:
+                    continue
+                appstruct[name] = decode(None if mapping else colander.null)
+
+        return finish(appstruct)
+
+    return decode_mapping
+
+
 def dumps(tree, encoding=None):
     s = etree.tostring(tree.getroot(), encoding=encoding)
     # XXX xml.etree.ElementTree uses a space on self-closing tags, while lxml's
@@ -90,17 +464,94 @@ def dumps(tree, encoding=None):
 
 
 def loads(data):
-    element = etree.fromstring(data)
-    tree = etree.ElementTree(element)
-    remove_namespaces(tree)
-    return tree
+    """Parse a document, dropping the namespaces of its elements as
+    they are parsed."""
+    if backend == 'lxml':
+        return _loads_lxml(data)
+
+    root = None
+    for event, element in _iterparse(data):
+        element.tag = local_name(element.tag)
+        if root is None:
+            root = element
+    return etree.ElementTree(root)
+
+
+def _iterparse(data):
+    """Return the ``(event, element)`` pairs of the ``start`` events
+    of ``data``, as :func:`iterparse` would.
+
+    cElementTree parsers can collect the events of a whole document
+    in a single feed through their (private) ``_setevents``, which
+    costs about a third less than ``iterparse``, that reads the data
+    in chunks and is a generator. Parsers without it, or whose
+    ``_setevents`` doesn't take the same arguments, fall back to the
+    public ``iterparse``.
+    """
+    parser = etree.XMLParser()
+    setevents = getattr(parser, '_setevents', None)
+    if setevents is not None:
+        events = []
+        try:
+            setevents(events, ('start',))
+        except TypeError:
+            pass
+        else:
+            parser.feed(data)
+            parser.close()
+            return events
+    return etree.iterparse(StringIO(data), events=('start',))
+
+
+_lxml_parsers = threading.local()
+
+
+def _loads_lxml(data):
+    # lxml parsers must not be shared between threads. they are also
+    # told not to resolve entities, as lxml would happily read local
+    # files referenced by the document.
+    parser = getattr(_lxml_parsers, 'parser', None)
+    if parser is None:
+        parser = _lxml_parsers.parser = etree.XMLParser(
+            resolve_entities=False, no_network=True)
+
+    # parsing in C and renaming afterwards costs less than being
+    # called back for each element
+    root = etree.fromstring(data, parser)
+    for element in root.iter(etree.Element):
+        element.tag = local_name(element.tag)
+    return etree.ElementTree(root)
+
+
+# documents from the service only have a handful of different tags
+_local_names = {}
+_local_names_max = 1024
+
+
+def local_name(tag):
+    """Return ``tag`` without its namespace. The results are
+    interned and cached."""
+    name = _local_names.get(tag)
+    if name is None:
+        name = _namespace_regex.sub('', tag)
+        if isinstance(name, str):
+            name = intern(name)
+        if len(_local_names) < _local_names_max:
+            _local_names[tag] = name
+    return name
+
+
+_namespace_regex = re.compile(r'^\{[^\}]+\}')
 
 
 def remove_namespaces(element):
     """Remove all namespaces in the passed element in place."""
-    for ele in element.getiterator():
-        ele.tag = re.sub(r'^\{[^\}]+\}', '', ele.tag)
+    for ele in element.iter():
+        ele.tag = local_name(ele.tag)
 
 
 def get_root_tag(tree):
     return tree.getroot().tag
+
+
+use_backend(os.environ.get('BBE_CIELO_XML_BACKEND') or None)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""Timings of the requests of a client.
+
+Give a client an ``observer`` and it reports the :class:`Timings` of
+each request it sends, phase by phase::
+
+    >>> observer = HistogramObserver()
+    >>> client = Client(..., observer=observer)
+    >>> observer.snapshot()['requisicao-consulta']['network']['p99']
+    0.182
+
+Clients without an observer don't time anything.
+"""
+import timeit
+import threading
+import collections
+
+#: The clock used to time requests.
+timer = timeit.default_timer
+
+PHASES = ('build', 'network', 'parse', 'decode', 'total')
+
+
+class Timings(object):
+    """How long each phase of a request took, in seconds.
+
+    .. attribute:: build
+
+        Building the form body of the request (``None`` if it was
+        built by the caller of
+        :meth:`~bbe.cielo.client.Client.post_request`).
+
+    .. attribute:: network
+
+        Sending the request and reading the response.
+
+    .. attribute:: parse
+
+        Parsing the response XML.
+
+    .. attribute:: decode
+
+        Converting the response into a transaction or an error.
+
+    Phases that didn't happen, as the request failed before, are
+    ``None``. Besides the timings, it tells the ``tag`` of the
+    request, the ``store``, the ``root_tag`` of the response, the
+    ``error`` raised (and its ``error_code``, for service errors) and
+    the ``request_size`` and ``response_size`` in bytes.
+    """
+    __slots__ = ('tag', 'store', 'root_tag', 'error', 'error_code',
+                 'request_size', 'response_size',
+                 'build', 'network', 'parse', 'decode')
+
+    def __init__(self, tag, store, build=None):
+        self.tag = tag
+        self.store = store
+        self.build = build
+        self.root_tag = None
+        self.error = None
+        self.error_code = None
+        self.request_size = None
+        self.response_size = None
+        self.network = None
+        self.parse = None
+        self.decode = None
+
+    @property
+    def total(self):
+        return sum(getattr(self, phase) or 0 for phase in PHASES[:-1])
+
+
+class Observer(object):
+    """Receives the :class:`Timings` of the requests of a client.
+
+    :meth:`observe` is called in the thread that made the request,
+    once it finishes, whether it succeeded or not, so it must be
+    thread safe and quick.
+    """
+    def observe(self, timings):
+        pass
+
+
+class Observers(Observer):
+    """Hands the timings to each of ``observers``, in order."""
+
+    def __init__(self, *observers):
+        self.observers = observers
+
+    def observe(self, timings):
+        for observer in self.observers:
+            observer.observe(timings)
+
+
+class Histogram(object):
+    """Counts values in HDR-style buckets: each power of two is split
+    in ``2 ** (precision - 1)`` linear sub-buckets, so percentiles are
+    off by less than ``2 ** (1 - precision)`` of their value (1.6% by
+    default), while the buckets take a few KB from microseconds to
+    hours.
+
+    Values are counted in multiples of ``unit``; the default unit
+    suits values in seconds. Histograms are not thread safe.
+    """
+    def __init__(self, precision=7, unit=1e-6):
+        self.precision = precision
+        self.unit = unit
+        self.reset()
+
+    def reset(self):
+        self.counts = []
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        index = self._index(int(value / self.unit))
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if self.count:
+            return self.sum / self.count
+
+    def percentile(self, percent):
+        """Return the value below which ``percent`` of the values
+        are."""
+        if not self.count:
+            return None
+        rank = max(1, percent * self.count / 100.0)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        low, high = self._bounds(index)
+        # the middle of the bucket, within the values seen
+        value = (low + high) / 2.0 * self.unit
+        return min(max(value, self.min), self.max)
+
+    def _index(self, n):
+        linear = 1 << self.precision
+        if n < linear:
+            return n
+        shift = n.bit_length() - self.precision
+        return (shift << (self.precision - 1)) + (n >> shift)
+
+    def _bounds(self, index):
+        # the lowest value in the bucket, and the lowest of the next
+        if index < 1 << self.precision:
+            return index, index + 1
+        shift = (index >> (self.precision - 1)) - 1
+        mantissa = index - (shift << (self.precision - 1))
+        return mantissa << shift, (mantissa + 1) << shift
+
+
+class HistogramObserver(Observer):
+    """Aggregates the timings of each request tag in
+    :class:`Histogram` instances, for reports or to be scraped by a
+    monitoring system.
+    """
+    def __init__(self, percentiles=(50, 90, 99, 99.9), precision=7):
+        self.percentiles = percentiles
+        self.precision = precision
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # histograms by (tag, phase)
+            self.histograms = collections.defaultdict(
+                lambda: Histogram(self.precision))
+            # errors by (tag, code)
+            self.errors = collections.Counter()
+            # bytes sent and received, by tag
+            self.request_bytes = collections.Counter()
+            self.response_bytes = collections.Counter()
+
+    def observe(self, timings):
+        tag = timings.tag
+        with self._lock:
+            histograms = self.histograms
+            total = 0
+            for phase in PHASES[:-1]:
+                value = getattr(timings, phase)
+                if value is not None:
+                    histograms[tag, phase].record(value)
+                    total += value
+            histograms[tag, 'total'].record(total)
+            if timings.error is not None:
+                self.errors[tag, timings.error_code] += 1
+            self.request_bytes[tag] += timings.request_size or 0
+            self.response_bytes[tag] += timings.response_size or 0
+
+    def snapshot(self):
+        """Return the statistics of each tag, as a
+        ``{tag: {phase: {statistic: value}}}`` dict. Besides the
+        phases, each tag has its ``errors`` by code and the
+        ``request_bytes`` and ``response_bytes`` transferred."""
+        with self._lock:
+            result = collections.defaultdict(lambda: {'errors': {}})
+            for (tag, phase), histogram in self.histograms.iteritems():
+                stats = result[tag][phase] = {
+                    'count': histogram.count,
+                    'min': histogram.min,
+                    'max': histogram.max,
+                    'mean': histogram.mean,
+                }
+                for percent in self.percentiles:
+                    stats['p%s' % percent] = histogram.percentile(percent)
+            for (tag, code), count in self.errors.iteritems():
+                result[tag]['errors'][code] = count
+            for tag in result:
+                result[tag]['request_bytes'] = self.request_bytes[tag]
+                result[tag]['response_bytes'] = self.response_bytes[tag]
+            return dict(result)
+
+
+class UsageObserver(Observer):
+    """Counts the requests of each store and tag: how many were sent,
+    how many failed, the bytes sent and received and the seconds
+    spent waiting for the service."""
+
+    fields = ('requests', 'errors', 'request_bytes', 'response_bytes', 'network_time')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # a list of counts, in the order of `fields`, by (store, tag)
+            self._usage = {}
+
+    def observe(self, timings):
+        key = (timings.store, timings.tag)
+        with self._lock:
+            usage = self._usage.get(key)
+            if usage is None:
+                usage = self._usage[key] = [0, 0, 0, 0, 0]
+            usage[0] += 1
+            if timings.error is not None:
+                usage[1] += 1
+            usage[2] += timings.request_size or 0
+            usage[3] += timings.response_size or 0
+            usage[4] += timings.network or 0
+
+    def snapshot(self, store):
+        """Return the usage of ``store``, as a
+        ``{tag: {field: value}}`` dict."""
+        with self._lock:
+            return dict((tag, dict(zip(self.fields, usage)))
+                        for (key, tag), usage in self._usage.iteritems()
+                        if key == store)
+
+    def stores(self):
+        """Return the stores that made requests."""
+        with self._lock:
+            return set(store for store, tag in self._usage)
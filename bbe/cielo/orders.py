@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Time-ordered order numbers.
+
+Order numbers are 20 base 36 characters (the limit of the
+``numero`` of orders)::
+
+    tttttttttwwwwwwccccc
+
+* ``t``: milliseconds since the unix epoch, good until the year 5188;
+* ``w``: the id of the worker (process) that generated it, by
+  default random;
+* ``c``: a counter of the worker.
+
+Numbers of the same worker never repeat, and numbers are sorted by
+the time they were generated at, so they may be used as a cheap
+time index of transactions (see :func:`bounds`).
+"""
+import os
+import time
+import zlib
+import socket
+import struct
+import datetime
+import itertools
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+TIMESTAMP_WIDTH = 9
+WORKER_WIDTH = 6
+COUNTER_WIDTH = 5
+
+#: The number of distinct worker ids.
+MAX_WORKERS = 36 ** WORKER_WIDTH
+
+_COUNTER_LIMIT = 36 ** COUNTER_WIDTH
+_PAIRS = [a + b for a in DIGITS for b in DIGITS]
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def encode(value, width):
+    """Encode ``value`` in base 36, zero padded to ``width``
+    characters."""
+    pieces = []
+    while width > 1:
+        value, rest = divmod(value, 1296)
+        pieces.append(_PAIRS[rest])
+        width -= 2
+    if width:
+        value, rest = divmod(value, 36)
+        pieces.append(DIGITS[rest])
+    if value:
+        raise OverflowError("value too large")
+    pieces.reverse()
+    return ''.join(pieces)
+
+
+def random_worker_id():
+    """A random worker id, drawn from :func:`os.urandom`.
+
+    Two workers only share an id by chance: with a thousand workers
+    generating numbers for the same store, the odds that any two of
+    them do are about one in ten thousand, and even then their
+    numbers only repeat if generated in the same millisecond.
+    """
+    return struct.unpack('>I', os.urandom(4))[0] % MAX_WORKERS
+
+
+def host_worker_id():
+    """The pid of the process, tagged with 9 bits of the hostname.
+
+    Processes of the same host never share an id, but two hosts may,
+    and so may containers whose processes have the same pids. Only
+    use it where that can't happen.
+    """
+    host = zlib.crc32(socket.gethostname()) & 0x1ff
+    return (host << 22) | (os.getpid() & 0x3fffff)
+
+
+class OrderNumberGenerator(object):
+    """Generates order numbers; call it to get the next one.
+
+    ``worker_id`` is an integer (up to :data:`MAX_WORKERS`) that must
+    be unique among the processes using the same store, or a function
+    that returns one. Functions are called again in forked processes,
+    so a generator created before forking (e.g. by a preloaded
+    gunicorn app) gives each worker its own id. By default,
+    :func:`random_worker_id` is used, so each generator (and each
+    forked copy of one) gets an id of its own.
+
+    Generating takes no locks: the counter is an
+    ``itertools.count``, whose increments are atomic.
+    """
+    def __init__(self, worker_id=random_worker_id, clock=time.time):
+        self.clock = clock
+        self._worker_id = worker_id
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        worker_id = self._worker_id
+        if callable(worker_id):
+            worker_id = worker_id()
+        if not 0 <= worker_id < MAX_WORKERS:
+            raise ValueError("invalid worker id: %r" % (worker_id,))
+        self.worker_id = worker_id
+        self._worker = encode(worker_id, WORKER_WIDTH)
+        self._counter = itertools.count()
+        # the last timestamp encoded, and its encoding
+        self._last = (None, None)
+
+    def __call__(self):
+        if self._pid != os.getpid():
+            # the child of a fork would repeat the numbers of its parent
+            self._reset()
+
+        millis = int(self.clock() * 1000)
+        last, timestamp = self._last
+        if millis != last:
+            timestamp = encode(millis, TIMESTAMP_WIDTH)
+            self._last = (millis, timestamp)
+        counter = next(self._counter) % _COUNTER_LIMIT
+        return timestamp + self._worker + encode(counter, COUNTER_WIDTH)
+
+
+def timestamp(order_number):
+    """Return when ``order_number`` was generated, as a naive UTC
+    datetime."""
+    millis = int(order_number[:TIMESTAMP_WIDTH], 36)
+    return _EPOCH + datetime.timedelta(milliseconds=millis)
+
+
+def bounds(start, end):
+    """Return the ``(lowest, highest)`` order numbers such that every
+    order number generated from ``start`` up to (not including)
+    ``end``, naive UTC datetimes, sorts in ``lowest <= n < highest``.
+    """
+    return _lowest(start), _lowest(end)
+
+
+def _lowest(when):
+    delta = when - _EPOCH
+    millis = (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+    return encode(millis, TIMESTAMP_WIDTH) + '0' * (WORKER_WIDTH + COUNTER_WIDTH)
+
+
+#: The generator used by clients by default.
+default_generator = OrderNumberGenerator()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import select
+import socket
+import httplib
+import urlparse
+import threading
+
+
+class ConnectionPool(object):
+    """Keeps keep-alive HTTP(S) connections to the service, so that
+    consecutive requests don't pay a new TCP connect and a full TLS
+    handshake.
+
+    Idle connections are kept per ``(scheme, host, port)``.
+
+    .. attribute:: maxsize
+
+        Maximum number of idle connections kept for each host. Extra
+        connections are closed when released.
+
+    .. attribute:: idle_timeout
+
+        Connections idle for more than this many seconds are closed
+        instead of reused.
+
+    .. attribute:: timeout
+
+        Socket timeout, in seconds, of requests that don't give their
+        own. By default, the one set by :func:`socket.setdefaulttimeout`,
+        like :mod:`httplib` and :mod:`urllib2` do.
+    """
+    connection_classes = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection,
+    }
+
+    def __init__(self, maxsize=10, idle_timeout=10,
+                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._urls = {}
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def urlopen(self, url, body, headers=None, timeout=None):
+        """POST ``body`` to ``url`` and return the response body.
+
+        ``timeout`` is the socket timeout, in seconds, of each
+        operation of the request (by default, :attr:`timeout`).
+
+        Raises :class:`socket.error` or :class:`httplib.HTTPException`
+        if the request fails or the response status is not 200.
+        """
+        key, path = self._parse_url(url)
+        conn = self._get_connection(key)
+        if timeout is None:
+            timeout = self.timeout
+        # reused connections may have been opened with another timeout
+        conn.timeout = timeout
+        if conn.sock is not None:
+            if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                conn.sock.settimeout(socket.getdefaulttimeout())
+            else:
+                conn.sock.settimeout(timeout)
+
+        try:
+            conn.request('POST', path, body, headers or {})
+            response = conn.getresponse()
+            data = response.read()
+        except:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._put_connection(key, conn)
+
+        if response.status != httplib.OK:
+            raise httplib.HTTPException("%s %s" % (response.status, response.reason))
+
+        return data
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.itervalues():
+            for conn, released_at in connections:
+                conn.close()
+
+    def _parse_url(self, url):
+        parsed = self._urls.get(url)
+        if parsed is None:
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in self.connection_classes:
+                raise ValueError("unsupported url scheme: `%s'" % parts.scheme)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            key = (parts.scheme, parts.hostname, parts.port)
+            parsed = self._urls[url] = (key, path)
+        return parsed
+
+    def _get_connection(self, key):
+        if self._pid != os.getpid():
+            # we were forked. the idle connections belong to our parent
+            # and must not be shared with it.
+            self._reset()
+
+        now = time.time()
+        with self._lock:
+            connections = self._idle.get(key, [])
+            while connections:
+                conn, released_at = connections.pop()
+                if now - released_at > self.idle_timeout:
+                    # connections are released in order, so all the
+                    # remaining ones are even older than this one.
+                    stale = connections + [(conn, released_at)]
+                    del connections[:]
+                    break
+                if not is_connection_dropped(conn):
+                    return conn
+                conn.close()
+            else:
+                stale = []
+
+        for conn, released_at in stale:
+            conn.close()
+
+        scheme, host, port = key
+        return self.connection_classes[scheme](host, port, timeout=self.timeout)
+
+    def _put_connection(self, key, conn):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.maxsize:
+                connections.append((conn, time.time()))
+                return
+        conn.close()
+
+
+def is_connection_dropped(conn):
+    """Health check for idle connections.
+
+    An idle connection should have nothing to read. If its socket is
+    readable, the server either closed it or sent something we did
+    not ask for, and the connection can't be reused.
+    """
+    sock = conn.sock
+    if sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+#: The pool shared by every client in the process.
+default_pool = ConnectionPool()
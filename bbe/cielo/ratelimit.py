@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+
+class RateLimiter(object):
+    """A token bucket that lets ``rate`` calls per second through, in
+    bursts of up to ``burst`` calls (by default, ``rate``).
+
+    Limiters are thread safe, so one can bound the calls of many
+    threads (or of many clients) to the service.
+    """
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = max(burst or rate, 1)
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._refilled_at = clock()
+
+    def reserve(self, timeout=None):
+        """Take a token, and return how many seconds to wait before
+        using it. If that would be longer than ``timeout`` seconds,
+        take nothing and return ``None``."""
+        with self._lock:
+            now = self.clock()
+            elapsed, self._refilled_at = now - self._refilled_at, now
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            # tokens may go negative, so that waiting callers queue up
+            delay = max(0.0, (1 - self._tokens) / self.rate)
+            if timeout is not None and delay > timeout:
+                return None
+            self._tokens -= 1
+            return delay
+
+    def acquire(self, timeout=None):
+        """Wait for a token. Return ``False`` if it would take longer
+        than ``timeout`` seconds."""
+        delay = self.reserve(timeout)
+        if delay is None:
+            return False
+        if delay > 0:
+            self.sleep(delay)
+        return True
+
+    def try_acquire(self):
+        """Take a token if one is available right away."""
+        return self.acquire(0)
+
+
+class KeyedRateLimiter(object):
+    """A :class:`RateLimiter` for each key (e.g. each store), all with
+    the same ``rate`` and ``burst``, created on demand."""
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def get(self, key):
+        """Return the limiter of ``key``."""
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(key)
+                if limiter is None:
+                    limiter = self._limiters[key] = RateLimiter(
+                        self.rate, self.burst, self.clock, self.sleep)
+        return limiter
+
+    def acquire(self, key, timeout=None):
+        return self.get(key).acquire(timeout)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Clients for many stores, e.g. the merchants of a marketplace::
+
+    >>> registry = ClientRegistry(INSTALLMENT_TYPE, cache=StatusCache(), rate=5)
+    >>> registry.register('1006993069', '25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3')
+    >>> transaction = registry.get('1006993069').query_by_tid(tid)
+    >>> registry.usage('1006993069')['requisicao-consulta']['requests']
+    1
+"""
+import threading
+from bbe.cielo import metrics
+from bbe.cielo import schema as schemas
+from bbe.cielo import transport as transports
+from bbe.cielo.client import Client
+from bbe.cielo.executor import SingleFlight
+from bbe.cielo.ratelimit import KeyedRateLimiter
+
+
+class ClientRegistry(object):
+    """Hands out a client of ``client_class`` for each registered
+    store, created when it is first asked for.
+
+    The clients share everything but the establishment: one transport
+    (and so one connection pool), the compiled request schemas and
+    response decoders, the ``cache``, the coalesced queries (if
+    ``coalesce`` is set, see :class:`~bbe.cielo.client.Client`) and
+    the usage counters, which are all keyed by store. If ``rate`` is
+    given, each store may send up to ``rate`` requests per second, in
+    bursts of up to ``burst``, whatever the other stores do.
+
+    Other keyword arguments are given to every client (e.g. the
+    ``executor`` of :class:`~bbe.cielo.client.AsyncClient` instances,
+    or their ``timeouts``).
+    """
+    def __init__(self, default_installment_type, client_class=Client,
+                 service_url=schemas.SERVICE_URL, transport=None, pool=None,
+                 cache=None, coalesce=False, rate=None, burst=None,
+                 observer=None, **options):
+        self.default_installment_type = default_installment_type
+        self.client_class = client_class
+        self.transport = transport or transports.PooledTransport(service_url, pool)
+        self.cache = cache
+        self.single_flight = SingleFlight() if coalesce else None
+        self.limiter = KeyedRateLimiter(rate, burst) if rate else None
+        self.usage_observer = metrics.UsageObserver()
+        if observer is None:
+            self.observer = self.usage_observer
+        else:
+            self.observer = metrics.Observers(self.usage_observer, observer)
+        options['service_url'] = service_url
+        self.options = options
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._clients = {}
+
+    def register(self, store_id, store_key):
+        """Add a store, or change its key."""
+        with self._lock:
+            self._keys[store_id] = store_key
+            self._clients.pop(store_id, None)
+
+    def unregister(self, store_id):
+        """Remove a store. Its client keeps working for whoever has it."""
+        with self._lock:
+            del self._keys[store_id]
+            self._clients.pop(store_id, None)
+
+    def get(self, store_id):
+        """Return the client of ``store_id``. Raise :class:`KeyError`
+        if the store isn't registered."""
+        client = self._clients.get(store_id)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(store_id)
+                if client is None:
+                    client = self._clients[store_id] = self._create_client(
+                        store_id, self._keys[store_id])
+        return client
+
+    __getitem__ = get
+
+    def usage(self, store_id):
+        """Return the requests of ``store_id`` so far, as a
+        ``{tag: {field: value}}`` dict (see
+        :class:`~bbe.cielo.metrics.UsageObserver`)."""
+        return self.usage_observer.snapshot(store_id)
+
+    def __contains__(self, store_id):
+        return store_id in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def _create_client(self, store_id, store_key):
+        limiter = None
+        if self.limiter is not None:
+            limiter = self.limiter.get(store_id)
+        return self.client_class(
+            store_id, store_key, self.default_installment_type,
+            transport=self.transport, cache=self.cache,
+            coalesce=self.single_flight or False, observer=self.observer,
+            limiter=limiter, **self.options)
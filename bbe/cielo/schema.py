@@ -68,6 +68,23 @@ STATUS = (
     ST_AUTHENTICATING,
 )
 
+# statuses a transaction never leaves (except by being cancelled).
+FINAL_STATUS = (
+    ST_NOT_AUTHENTICATED,
+    ST_NOT_AUTHORIZED,
+    ST_CAPTURED,
+    ST_NOT_CAPTURED,
+    ST_CANCELLED,
+)
+
+# statuses a transaction leaves within seconds or minutes.
+TRANSITIONAL_STATUS = (
+    ST_CREATED,
+    ST_PROCESSING,
+    ST_AUTHENTICATED,
+    ST_AUTHENTICATING,
+)
+
 
 DEFAULT_CURRENCY = '986'
 
@@ -109,6 +126,49 @@ class SecurityCodeIndicator(colander.Integer):
         return appstruct
 
 
+class Cents(int):
+    """A monetary value, as an integer number of cents.
+
+    Cents are what the service speaks, so they are converted with
+    plain integer arithmetic, without going through ``Decimal``.
+    Arithmetic on them returns plain ints.
+
+    ::
+
+        >>> Cents(20050)
+        Cents(20050)
+        >>> print Cents(20050)
+        200.50
+        >>> Cents(20050).to_decimal()
+        Decimal('200.50')
+        >>> Cents.from_decimal(Decimal('200.5'))
+        Cents(20050)
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_decimal(cls, value):
+        """Convert a value in units (reais, dollars) into cents.
+        Raises :class:`ValueError` if ``value`` has more than two
+        decimal places."""
+        if isinstance(value, float):
+            value = repr(value)
+        cents = Decimal(value).scaleb(2)
+        if cents != cents.to_integral_value():
+            raise ValueError("%s has more than two decimal places" % value)
+        return cls(cents)
+
+    def to_decimal(self):
+        return Decimal(int(self)).scaleb(-2)
+
+    def __repr__(self):
+        return 'Cents(%d)' % self
+
+    def __str__(self):
+        units, cents = divmod(abs(self), 100)
+        return '%s%d.%02d' % ('-' if self < 0 else '', units, cents)
+
+
 class Money(colander.Decimal):
     """Serializes python numeric values.
 
@@ -145,6 +205,9 @@ class Money(colander.Decimal):
         Decimal('1.90')
     """
     def serialize(self, node, appstruct):
+        if isinstance(appstruct, Cents):
+            return '%d' % appstruct
+
         cstruct = super(Money, self).serialize(node, appstruct)
 
         if cstruct is not colander.null:
@@ -173,6 +236,132 @@ class Money(colander.Decimal):
         return super(Money, self).deserialize(node, cstruct)
 
 
+class CentsMoney(Money):
+    """Like :class:`Money`, but deserializes into :class:`Cents`.
+
+    ::
+
+        >>> node = colander.SchemaNode(CentsMoney())
+        >>> node.deserialize('20050')
+        Cents(20050)
+        >>> node.serialize(Cents(20050))
+        '20050'
+        >>> node.serialize(Decimal('200.5'))
+        '20050'
+    """
+    def deserialize(self, node, cstruct):
+        if not cstruct:
+            return colander.null
+        if not isinstance(cstruct, basestring) or not cstruct.isdigit():
+            raise colander.Invalid(node, '"%s" is not a number' % (cstruct,))
+        return Cents(cstruct)
+
+
+class FixedOffset(datetime.tzinfo):
+    """A timezone ``minutes`` away from UTC.
+
+    Use :func:`get_tzinfo` instead of creating them, so that every
+    datetime with the same offset shares the same instance.
+    """
+    def __init__(self, minutes):
+        self._minutes = minutes
+        self._offset = datetime.timedelta(minutes=minutes)
+        sign = '-' if minutes < 0 else '+'
+        self._name = '%s%02d:%02d' % ((sign,) + divmod(abs(minutes), 60))
+
+    def utcoffset(self, dt):
+        return self._offset
+
+    def dst(self, dt):
+        return _ZERO
+
+    def tzname(self, dt):
+        return self._name
+
+    def __getinitargs__(self):
+        return (self._minutes,)
+
+    def __repr__(self):
+        return '<FixedOffset %s>' % self._name
+
+
+_ZERO = datetime.timedelta(0)
+_tzinfos = {}
+
+
+def get_tzinfo(minutes):
+    """Return the (cached) :class:`FixedOffset` of ``minutes``."""
+    tzinfo = _tzinfos.get(minutes)
+    if tzinfo is None:
+        tzinfo = _tzinfos.setdefault(minutes, FixedOffset(minutes))
+    return tzinfo
+
+
+_datetime_regex = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)'
+                             r'(?:\.(\d{1,6}))?(?:(Z)|([-+])(\d\d):(\d\d))?$')
+
+
+def parse_datetime(text):
+    """Parse a datetime in the format sent by the service, like
+    ``2012-08-11T08:48:23.659-03:00``. Both the fraction of seconds
+    and the offset are optional; without an offset the result is
+    naive. Raises :class:`ValueError` on anything else.
+
+    ::
+
+        >>> parse_datetime('2012-08-11T08:48:23.659-03:00')
+        datetime.datetime(2012, 8, 11, 8, 48, 23, 659000, tzinfo=<FixedOffset -03:00>)
+        >>> parse_datetime('2012-08-11T08:48:23')
+        datetime.datetime(2012, 8, 11, 8, 48, 23)
+    """
+    match = _datetime_regex.match(text)
+    if match is None:
+        raise ValueError('"%s" is not a valid datetime' % text)
+
+    year, month, day, hour, minute, second, fraction, utc, sign, tzhour, tzminute = match.groups()
+
+    if fraction is None:
+        microsecond = 0
+    else:
+        microsecond = int(fraction.ljust(6, '0'))
+
+    if utc is not None:
+        tzinfo = get_tzinfo(0)
+    elif sign is not None:
+        tzhour, tzminute = int(tzhour), int(tzminute)
+        if tzhour > 23 or tzminute > 59:
+            raise ValueError('"%s" has an invalid offset' % text)
+        offset = tzhour * 60 + tzminute
+        tzinfo = get_tzinfo(-offset if sign == '-' else offset)
+    else:
+        tzinfo = None
+
+    return datetime.datetime(int(year), int(month), int(day), int(hour),
+                             int(minute), int(second), microsecond, tzinfo)
+
+
+def format_datetime(value):
+    """Format a naive datetime (or a date, at midnight) in the format
+    accepted by the service, ``AAAA-MM-DDTHH24:MI:SS``. Fractions of
+    seconds are dropped, and datetimes with timezone information are
+    refused with a :class:`ValueError`.
+
+    ::
+
+        >>> format_datetime(datetime.datetime(2012, 8, 11, 8, 48, 23, 659000))
+        '2012-08-11T08:48:23'
+        >>> format_datetime(datetime.date(2012, 8, 11))
+        '2012-08-11T00:00:00'
+    """
+    if type(value) is datetime.date:
+        return value.isoformat() + 'T00:00:00'
+    if value.tzinfo is not None and value.utcoffset() is not None:
+        raise ValueError("datetimes with timezone information are not supported")
+    if value.microsecond:
+        value = value.replace(microsecond=0)
+    return value.isoformat()
+
+
 class Month(colander.SchemaType):
     """Serializes dates into '%Y%m' strings representing months.
 
@@ -180,11 +369,15 @@ class Month(colander.SchemaType):
 
     The ``day`` of deserialized values will always ``1``.
 
-    Also, it's good to note that I don't know how this will deal
-    with timezones and so. I just use ``strftime`` and ``strptime``.
+    ::
+
+        >>> node = colander.SchemaNode(Month())
+        >>> node.serialize(datetime.date(2012, 12, 25))
+        '201212'
+        >>> node.deserialize('201212')
+        datetime.date(2012, 12, 1)
     """
     err_template =  "Invalid date"
-    _format = '%Y%m'
 
     def serialize(self, node, appstruct):
         if not appstruct:
@@ -193,13 +386,15 @@ class Month(colander.SchemaType):
         if not isinstance(appstruct, datetime.date):
             raise colander.Invalid(node, '"%s" is not a datetime object' % appstruct)
 
-        return appstruct.strftime(self._format)
+        return '%04d%02d' % (appstruct.year, appstruct.month)
 
     def deserialize(self, node, cstruct):
         if not cstruct:
             return colander.null
+        if len(cstruct) != 6 or not cstruct.isdigit():
+            raise colander.Invalid(node, self.err_template)
         try:
-            return datetime.date.strptime(cstruct, self._format)
+            return datetime.date(int(cstruct[:4]), int(cstruct[4:]), 1)
         except ValueError:
             raise colander.Invalid(node, self.err_template)
 
@@ -216,27 +411,35 @@ class InconsistentDateTime(colander.DateTime):
     have any timezone information, while the returned data WILL HAVE
     timezone information. To ignore the returned information is up to
     you.
-    """
-    _tzinfo_regex = re.compile(r"(Z|(([-+])([0-9]{2}):([0-9]{2})))?$")
 
+    Both ways are handled by :func:`format_datetime` and
+    :func:`parse_datetime`, not by the generic ISO8601 machinery.
+    """
     def __init__(self):
         super(InconsistentDateTime, self).__init__(None)
 
     def serialize(self, node, appstruct):
-        if appstruct is colander.null:
+        if not appstruct:
             return colander.null
 
-        cstruct = super(InconsistentDateTime, self).serialize(node, appstruct)
-
-        if cstruct is colander.null:
-            return colander.null
+        if not isinstance(appstruct, datetime.date):
+            raise colander.Invalid(node, '"%s" is not a datetime object' % (appstruct,))
 
         # if it has any timezone information, we raise an error. if you don't
         # like it, complain with Cielo.
-        if self._tzinfo_regex.match(cstruct):
-            raise colander.Invalid(node, "datetimes with timezone information are not supported")
+        try:
+            return format_datetime(appstruct)
+        except ValueError, e:
+            raise colander.Invalid(node, str(e))
 
-        return cstruct
+    def deserialize(self, node, cstruct):
+        if not cstruct:
+            return colander.null
+
+        try:
+            return parse_datetime(cstruct)
+        except (ValueError, TypeError):
+            raise colander.Invalid(node, self.err_template)
 
 
 class CardHolderSchema(colander.Schema):
@@ -573,3 +776,21 @@ class TransactionSchema(RootNode):
 
 def _compile_request_schemas():
     return dict((schema.tag, schema(tag=schema.tag)) for schema in RequestSchema.__subclasses__())
+
+
+def _cents_schema(schema):
+    """Return a copy of ``schema`` whose :class:`Money` nodes use
+    :class:`CentsMoney` instead, with their ranges scaled to cents."""
+    schema = schema.clone()
+    nodes = [schema]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.children)
+        if type(node.typ) is not Money:
+            continue
+        node.typ = CentsMoney()
+        if isinstance(node.validator, colander.Range):
+            node.validator = colander.Range(
+                *[None if value is None else Cents.from_decimal(value)
+                  for value in (node.validator.min, node.validator.max)])
+    return schema
@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+"""A local Cielo gateway, for load tests and benchmarks.
+
+The :class:`Simulator` understands the request documents defined in
+:mod:`bbe.cielo.schema`, keeps the state of each transaction by tid
+and answers with ``transacao`` or ``erro`` documents, just like the
+real service. Latency, errors and throughput limits can be injected.
+
+It can be used in-process, through :class:`SimulatorTransport`::
+
+    >>> simulator = Simulator(latency=lognormal(0.2, 0.5))
+    >>> client = Client(store_id, store_key, PARCELADO_LOJA,
+    ...                 transport=SimulatorTransport(simulator))
+
+or served over HTTP, with :func:`serve` or from the command line::
+
+    $ python -m bbe.cielo.simulator --port 8000 --latency 0.2
+"""
+import sys
+import math
+import time
+import uuid
+import base64
+import random
+import hashlib
+import datetime
+import argparse
+import threading
+import collections
+import SocketServer
+import BaseHTTPServer
+import colander
+from bbe.cielo import message
+from bbe.cielo import schema as schemas
+from bbe.cielo import transport as transports
+from bbe.cielo.errors import CommunicationError, Error, InvalidMessageError, UnexpectedError
+
+NAMESPACE = 'http://ecommerce.cbmp.com.br'
+
+
+def constant(seconds):
+    """A latency distribution that always takes ``seconds``."""
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    """A latency distribution uniform between ``low`` and ``high``
+    seconds."""
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal(median, sigma):
+    """A log-normal latency distribution, the usual shape of network
+    latencies, with the given ``median`` in seconds."""
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+class Dropped(Exception):
+    """Raised by :meth:`Simulator.handle` when the response to a
+    request is lost. The request itself may have been processed."""
+
+
+class Simulator(object):
+    """A fake Cielo gateway.
+
+    :param latency: a latency distribution (see :func:`constant`,
+        :func:`uniform` and :func:`lognormal`), or a number of seconds.
+    :param error_rate: probability of answering a request with one of
+        the ``error_codes`` instead of processing it.
+    :param drop_rate: probability of processing a request and losing
+        its response, as a connection failure would.
+    :param max_rps: maximum requests per second. Requests above the
+        limit are answered with error 97.
+    :param stores: a mapping of store numbers to keys. If given,
+        requests with other credentials are answered with error 2.
+    :param auto_advance: if given, pending transactions move to their
+        next status when queried this many seconds after their last
+        change, as if the card holder were going through the Cielo
+        pages.
+
+    Following the Cielo test environment, authorizations are approved
+    when the cents of the value are zero and denied otherwise.
+    """
+    def __init__(self, latency=None, error_rate=0, error_codes=(97, 99),
+                 drop_rate=0, max_rps=None, stores=None, auto_advance=None,
+                 seed=None, clock=time.time, sleep=time.sleep):
+        if latency is not None and not callable(latency):
+            latency = constant(latency)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.drop_rate = drop_rate
+        self.max_rps = max_rps
+        self.stores = stores
+        self.auto_advance = auto_advance
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.sleep = sleep
+
+        self.transactions = {}
+        self.orders = {}
+        self.stats = collections.Counter()
+
+        self._lock = threading.Lock()
+        self._tids = 0
+        self._tokens = max_rps
+        self._refilled_at = clock()
+
+        self._schemas = schemas._compile_request_schemas()
+        self._handlers = {
+            'requisicao-transacao': self._create,
+            'requisicao-consulta': self._query,
+            'requisicao-consulta-chsec': self._query_by_order_number,
+            'requisicao-captura': self._capture,
+            'requisicao-cancelamento': self._cancel,
+        }
+
+    def handle(self, request):
+        """Process a serialized request and return the serialized
+        response.
+
+        Raises :class:`Dropped` if the response is lost.
+        """
+        with self._lock:
+            latency = self.latency(self.random) if self.latency else 0
+            fail = self.random.random() < self.error_rate
+            drop = self.random.random() < self.drop_rate
+            limited = not self._take_token()
+            if limited:
+                self.stats['limited'] += 1
+            elif fail:
+                self.stats['failed'] += 1
+                code = self.random.choice(self.error_codes)
+            if drop:
+                self.stats['dropped'] += 1
+
+        if latency > 0:
+            self.sleep(latency)
+
+        if limited:
+            response = self._error(97)
+        elif fail:
+            response = self._error(code)
+        else:
+            response = self._process(request)
+
+        if drop:
+            raise Dropped()
+
+        return response
+
+    def advance(self, tid, authenticated=True):
+        """Move a pending transaction to its next status, as the card
+        holder going through the Cielo pages would."""
+        with self._lock:
+            self._advance(self.transactions[tid], authenticated)
+
+    def _take_token(self):
+        if self.max_rps is None:
+            return True
+        now = self.clock()
+        elapsed, self._refilled_at = now - self._refilled_at, now
+        self._tokens = min(self.max_rps, self._tokens + elapsed * self.max_rps)
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _process(self, request):
+        try:
+            tree = message.loads(request)
+        except Exception:
+            return self._error(1)
+
+        tag = message.get_root_tag(tree)
+        schema = self._schemas.get(tag)
+        if schema is None:
+            return self._error(1)
+
+        try:
+            appstruct = schema.deserialize(message.deserialize(schema, tree))
+        except colander.Invalid, e:
+            return self._error(InvalidMessageError.code,
+                               (u'%s: %s' % (InvalidMessageError.description, e))[:100])
+
+        establishment = appstruct['establishment']
+        if self.stores is not None:
+            if self.stores.get(establishment['number']) != establishment['key']:
+                return self._error(2)
+
+        with self._lock:
+            self.stats[tag] += 1
+            return self._handlers[tag](establishment['number'], appstruct)
+
+    def _create(self, store, appstruct):
+        self._tids += 1
+        tid = ('%s%010d' % (store[:10], self._tids))[-20:]
+
+        order = appstruct['order']
+        payment = appstruct['payment']
+        holder = appstruct['holder']
+        now = self.clock()
+
+        transaction = {
+            'tid': tid,
+            'store': store,
+            'order': {
+                'number': order['number'],
+                'value': _cents(order['value']),
+                'currency': order['currency'],
+                'datetime': order['datetime'].strftime('%Y-%m-%dT%H:%M:%S'),
+                'description': order['description'],
+                'language': order['language'],
+            },
+            'payment': {
+                'brand': payment['brand'],
+                'product': payment['product'],
+                'installments': str(payment['installments']),
+            },
+            'status': schemas.ST_CREATED,
+            'pan': colander.null,
+            'authentication_url': colander.null,
+            'authentication': colander.null,
+            'authorization': colander.null,
+            'capture': colander.null,
+            'cancel': colander.null,
+            'authorize': appstruct['authorize'],
+            'autocapture': appstruct['capture'] is True,
+            'changed_at': now,
+        }
+
+        if holder is not colander.null and holder.get('number'):
+            transaction['pan'] = base64.b64encode(hashlib.sha256(holder['number']).digest())
+
+        if transaction['pan'] is not colander.null and appstruct['authorize'] == 3:
+            self._authorize(transaction)
+        else:
+            transaction['authentication_url'] = (
+                'https://localhost/simulator/autenticacao?tid=%s' % tid)
+
+        self.transactions[tid] = transaction
+        self.orders[store, order['number']] = tid
+        return self._render(transaction)
+
+    def _query(self, store, appstruct):
+        transaction = self.transactions.get(appstruct['tid'])
+        if transaction is None or transaction['store'] != store:
+            return self._error(3)
+        self._auto_advance(transaction)
+        return self._render(transaction)
+
+    def _query_by_order_number(self, store, appstruct):
+        tid = self.orders.get((store, appstruct['order_number']))
+        if tid is None:
+            return self._error(3)
+        transaction = self.transactions[tid]
+        self._auto_advance(transaction)
+        return self._render(transaction)
+
+    def _capture(self, store, appstruct):
+        transaction = self.transactions.get(appstruct['tid'])
+        if transaction is None or transaction['store'] != store:
+            return self._error(3)
+        if transaction['status'] != schemas.ST_AUTHORIZED:
+            return self._error(30)
+
+        value = transaction['order']['value']
+        if appstruct['value'] is not colander.null:
+            if _cents(appstruct['value']) > value:
+                return self._error(32)
+            value = _cents(appstruct['value'])
+
+        self._capture_transaction(transaction, value)
+        return self._render(transaction)
+
+    def _cancel(self, store, appstruct):
+        transaction = self.transactions.get(appstruct['tid'])
+        if transaction is None or transaction['store'] != store:
+            return self._error(3)
+        if transaction['status'] not in (schemas.ST_AUTHORIZED, schemas.ST_CAPTURED):
+            return self._error(41)
+
+        authorized_on = datetime.date.fromtimestamp(transaction['authorized_at'])
+        if authorized_on != datetime.date.fromtimestamp(self.clock()):
+            return self._error(40)
+
+        transaction['status'] = schemas.ST_CANCELLED
+        transaction['cancel'] = self._event(9, u'Transacao cancelada com sucesso',
+                                            transaction['order']['value'])
+        return self._render(transaction)
+
+    def _auto_advance(self, transaction):
+        if self.auto_advance is None:
+            return
+        if self.clock() - transaction['changed_at'] >= self.auto_advance:
+            self._advance(transaction, True)
+
+    def _advance(self, transaction, authenticated):
+        status = transaction['status']
+        if status == schemas.ST_CREATED:
+            transaction['status'] = schemas.ST_AUTHENTICATING
+        elif status in (schemas.ST_PROCESSING, schemas.ST_AUTHENTICATING):
+            value = transaction['order']['value']
+            if authenticated:
+                transaction['authentication'] = self._event(
+                    6, u'Transacao autenticada', value, eci='5')
+                if transaction['authorize'] == 0:
+                    transaction['status'] = schemas.ST_AUTHENTICATED
+                else:
+                    self._authorize(transaction)
+            else:
+                transaction['authentication'] = self._event(
+                    3, u'Transacao nao autenticada', value, eci='7')
+                if transaction['authorize'] == 2:
+                    self._authorize(transaction)
+                else:
+                    transaction['status'] = schemas.ST_NOT_AUTHENTICATED
+        elif status == schemas.ST_AUTHENTICATED:
+            self._authorize(transaction)
+        transaction['changed_at'] = self.clock()
+
+    def _authorize(self, transaction):
+        value = transaction['order']['value']
+        transaction['authorized_at'] = self.clock()
+        if value % 100 == 0:
+            transaction['status'] = schemas.ST_AUTHORIZED
+            transaction['authorization'] = self._event(
+                4, u'Transação autorizada', value, lr='00',
+                arp='%06d' % self.random.randint(0, 999999),
+                nsu='%06d' % self.random.randint(0, 999999))
+            if transaction['autocapture']:
+                self._capture_transaction(transaction, value)
+        else:
+            transaction['status'] = schemas.ST_NOT_AUTHORIZED
+            transaction['authorization'] = self._event(
+                5, u'Autorização negada', value, lr='57',
+                nsu='%06d' % self.random.randint(0, 999999))
+
+    def _capture_transaction(self, transaction, value):
+        transaction['status'] = schemas.ST_CAPTURED
+        transaction['capture'] = self._event(6, u'Transacao capturada com sucesso', value)
+
+    def _event(self, code, msg, value, **extra):
+        event = {
+            'code': str(code),
+            'message': msg,
+            'datetime': self._now(),
+            'value': str(value),
+        }
+        # CaptureSchema and CancelSchema call it `date`
+        event['date'] = event['datetime']
+        event.update(extra)
+        return event
+
+    def _now(self):
+        # the service answers in Brasília time, with milliseconds
+        now = datetime.datetime.utcfromtimestamp(self.clock()) - datetime.timedelta(hours=3)
+        return '%s.%03d-03:00' % (now.strftime('%Y-%m-%dT%H:%M:%S'), now.microsecond // 1000)
+
+    def _render(self, transaction):
+        cstruct = dict(transaction, id=str(uuid.uuid4()), version=schemas.SERVICE_VERSION,
+                       status=str(transaction['status']))
+        cstruct['order'] = dict(transaction['order'], value=str(transaction['order']['value']))
+        return _dumps(schemas.TransactionSchema(), cstruct)
+
+    def _error(self, code, msg=None):
+        if msg is None:
+            msg = (Error.get_error_class(code).description
+                   or UnexpectedError.description)
+        return _dumps(schemas.ErrorSchema(), {'code': '%03d' % code, 'message': msg})
+
+
+def _cents(value):
+    return int(value * 100)
+
+
+def _dumps(schema, cstruct):
+    tree = message.serialize(schema, cstruct)
+    tree.getroot().set('xmlns', NAMESPACE)
+    return message.dumps(tree, encoding='ISO-8859-1')
+
+
+class SimulatorTransport(transports.LoopbackTransport):
+    """Sends requests to a :class:`Simulator` in the same process."""
+
+    def __init__(self, simulator):
+        super(SimulatorTransport, self).__init__(simulator.handle)
+        self.simulator = simulator
+
+    def send(self, data, timeout=None):
+        try:
+            return super(SimulatorTransport, self).send(data, timeout)
+        except Dropped:
+            raise CommunicationError('connection reset by the simulator')
+
+
+class SimulatorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, simulator, address):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SimulatorRequestHandler)
+        self.simulator = simulator
+
+
+class SimulatorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        data = self.rfile.read(length)
+
+        try:
+            request = transports.decode_message(data)
+        except ValueError:
+            self.send_error(400)
+            return
+
+        try:
+            response = self.server.simulator.handle(request)
+        except Dropped:
+            self.close_connection = 1
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=ISO-8859-1')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(simulator, host='127.0.0.1', port=0):
+    """Serve ``simulator`` over HTTP in a daemon thread and return the
+    server. Its url is ``http://host:server.server_port/``; call
+    ``server.shutdown()`` to stop it."""
+    server = SimulatorServer(simulator, (host, port))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=None,
+                        help='median latency, in seconds')
+    parser.add_argument('--sigma', type=float, default=0.5,
+                        help='sigma of the log-normal latency distribution')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--drop-rate', type=float, default=0)
+    parser.add_argument('--max-rps', type=float, default=None)
+    parser.add_argument('--auto-advance', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    latency = None
+    if args.latency:
+        latency = lognormal(args.latency, args.sigma)
+
+    simulator = Simulator(latency=latency, error_rate=args.error_rate,
+                          drop_rate=args.drop_rate, max_rps=args.max_rps,
+                          auto_advance=args.auto_advance, seed=args.seed)
+    server = SimulatorServer(simulator, (args.host, args.port))
+    sys.stderr.write('serving on http://%s:%d/\n' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,80 @@
 # -*- coding: utf-8 -*-
 from decimal import Decimal
+import os
+import pickle
 import colander
+import socket
+import StringIO
+import time
 import datetime
+import tempfile
 import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
 import bbe.cielo as cielo
+from bbe.cielo import batch
+from bbe.cielo import cache
+from bbe.cielo import metrics
+from bbe.cielo import orders
+from bbe.cielo import ratelimit
+from bbe.cielo import registry
+from bbe.cielo import simulator
+from bbe.cielo import timeouts
+from bbe.cielo import watcher
 
 
 def nextmonth():
     return datetime.datetime.now() + datetime.timedelta(days=30)
 
 
+def create_transaction(client, value=Decimal('200.0'), **kwargs):
+    """Create a transaction of a test card with ``client``, by default
+    authorized right away but not captured."""
+    card = cielo.Card(brand=cielo.VISA, number='4551870000000183',
+                      expiration_date=nextmonth(), security_code='123',
+                      holder_name='Joao da Silva')
+    kwargs.setdefault('installments', 1)
+    kwargs.setdefault('authorize', 3)
+    kwargs.setdefault('capture', False)
+    return client.create_transaction(value=value, card=card, **kwargs)
+
+
+TRANSACTION_RESPONSE = u"""<?xml version="1.0" encoding="ISO-8859-1"?>
+<transacao versao="1.1.1" id="f71e286f-21f6-4abe-8999-cc200e585454" xmlns="http://ecommerce.cbmp.com.br">
+  <tid>100699306905227C1001</tid>
+  <pan>uv9yI5tkhX9jpuCt+dfrtoSVM4U3gIjvrcwMBfZcadE=</pan>
+  <dados-pedido>
+    <numero>1</numero>
+    <valor>20000</valor>
+    <moeda>986</moeda>
+    <data-hora>2012-08-11T08:48:23.659-03:00</data-hora>
+    <idioma>PT</idioma>
+  </dados-pedido>
+  <forma-pagamento>
+    <bandeira>visa</bandeira>
+    <produto>1</produto>
+    <parcelas>1</parcelas>
+  </forma-pagamento>
+  <status>4</status>
+  <autorizacao>
+    <codigo>4</codigo>
+    <mensagem>Transação autorizada</mensagem>
+    <data-hora>2012-08-11T08:48:43.708-03:00</data-hora>
+    <valor>20000</valor>
+    <lr>0</lr>
+    <arp>123456</arp>
+    <nsu>336508</nsu>
+  </autorizacao>
+</transacao>""".encode('iso-8859-1')
+
+ERROR_RESPONSE = u"""<?xml version="1.0" encoding="ISO-8859-1"?>
+<erro xmlns="http://ecommerce.cbmp.com.br">
+  <codigo>032</codigo>
+  <mensagem>Valor de captura inválido</mensagem>
+</erro>""".encode('iso-8859-1')
+
+
 class MessageSerializationTestCase(unittest.TestCase):
     def assertDumps(self, node, appstruct, test):
         cstruct = node.serialize(appstruct)
@@ -58,6 +123,126 @@ class MessageSerializationTestCase(unittest.TestCase):
         self.assertDumps(node, colander.null, '<node/>')
 
 
+class CompiledEncoderTestCase(unittest.TestCase):
+    schemas = cielo.schema._compile_request_schemas()
+
+    def establishment(self, **kwargs):
+        kwargs.update({
+            'id': 'f71e286f-21f6-4abe-8999-cc200e585454',
+            'version': cielo.SERVICE_VERSION,
+            'establishment': {'number': '1006993069', 'key': 'key'},
+        })
+        return kwargs
+
+    def transaction(self, **kwargs):
+        return self.establishment(
+            order={
+                'number': '1234',
+                'value': Decimal('200.10'),
+                'currency': '986',
+                'datetime': datetime.datetime(2012, 8, 11, 8, 48, 23),
+                'description': u'Caf\xe9 & <p\xe3o> \u20ac "especial"',
+            },
+            payment={
+                'brand': cielo.VISA,
+                'product': cielo.CREDITO_A_VISTA,
+                'installments': 1,
+            },
+            holder={
+                'number': '4551870000000183',
+                'holder_name': 'Joao da Silva',
+                'expiration_date': datetime.date(2020, 12, 1),
+                'security_code': '123',
+                'security_code_indicator': cielo.SC_INFORMADO,
+            },
+            bin='455187',
+            return_url='http://example.com/?a=1&b=2',
+            authorize=3,
+            capture=False,
+            **kwargs
+        )
+
+    def assertEquivalent(self, tag, appstruct, encoding='ISO-8859-1'):
+        schema = self.schemas[tag]
+        reference = cielo.message.dumps(
+            cielo.message.serialize(schema, schema.serialize(appstruct)),
+            encoding=encoding)
+        encoder = cielo.message.compile_encoder(schema, encoding)
+        self.assertEqual(encoder(appstruct), reference)
+
+        constants = dict((name, appstruct.pop(name)) for name in ('version', 'establishment'))
+        template = cielo.message.compile_encoder(schema, encoding, constants,
+                                                 cielo.transport.quote)
+        self.assertEqual(template(appstruct), cielo.transport.quote(reference))
+
+    def test_transaction_request(self):
+        self.assertEquivalent('requisicao-transacao', self.transaction())
+        self.assertEquivalent('requisicao-transacao', self.transaction(), None)
+
+    def test_transaction_request_without_optional_values(self):
+        appstruct = self.transaction()
+        del appstruct['bin'], appstruct['capture'], appstruct['holder']['holder_name']
+        del appstruct['order']['description']
+        appstruct['id'] = 'a"b\nc'
+        self.assertEquivalent('requisicao-transacao', appstruct)
+
+    def test_fixed_shape_requests(self):
+        self.assertEquivalent('requisicao-consulta', self.establishment(tid='100699306905227C1001'))
+        self.assertEquivalent('requisicao-consulta-chsec', self.establishment(order_number='1234'))
+        self.assertEquivalent('requisicao-cancelamento', self.establishment(tid='1'))
+        self.assertEquivalent('requisicao-captura', self.establishment(tid='1'))
+        self.assertEquivalent('requisicao-captura', self.establishment(
+            tid='1', value=Decimal('10.5'), attachment=u'anexo & <mais>'))
+
+    def test_empty_and_null_values(self):
+        node = colander.SchemaNode(colander.Mapping(), name='node')
+        node.add(colander.SchemaNode(colander.String(), name='a', attrib=True))
+        node.add(colander.SchemaNode(colander.String(), name='b'))
+        node.add(colander.SchemaNode(colander.String(), name='c', default='x'))
+        encoder = cielo.message.compile_encoder(node)
+        self.assertEqual(encoder({}), '<node><c>x</c></node>')
+        self.assertEqual(encoder({'a': '1', 'b': '', 'c': 'y'}), '<node a="1"><b/><c>y</c></node>')
+        self.assertEqual(encoder(colander.null), '<node><c>x</c></node>')
+
+    def test_reference_fallback(self):
+        # mappings that don't ignore unknown keys aren't compiled
+        node = colander.SchemaNode(colander.Mapping(unknown='preserve'), name='node')
+        node.add(colander.SchemaNode(colander.String(), name='a', attrib=True))
+        node.add(colander.SchemaNode(colander.String(), name='b'))
+        root = colander.SchemaNode(colander.Mapping(), name='root')
+        root.add(node)
+        root.add(colander.SchemaNode(colander.String(), name='c'))
+        appstruct = {'node': {'a': '1', 'b': 'x & y'}, 'c': 'z'}
+        self.assertEqual(cielo.message.compile_encoder(root)(appstruct),
+                         '<root><node a="1"><b>x &amp; y</b></node><c>z</c></root>')
+        self.assertEqual(cielo.message.compile_encoder(node, None, {'a': '1'})({'b': 'x'}),
+                         '<node a="1"><b>x</b></node>')
+
+    def test_invalid_appstruct(self):
+        schema = self.schemas['requisicao-transacao']
+        appstruct = self.transaction()
+        appstruct['order']['value'] = Decimal('1.234')
+        try:
+            schema.serialize(appstruct)
+        except colander.Invalid, e:
+            expected = e.asdict()
+
+        constants = {'establishment': appstruct.pop('establishment')}
+        for encoder in (cielo.message.compile_encoder(schema, 'ISO-8859-1', constants),
+                        cielo.message.compile_encoder(schema, 'ISO-8859-1', constants,
+                                                      cielo.transport.quote)):
+            try:
+                encoder(appstruct)
+            except colander.Invalid, e:
+                self.assertEqual(e.asdict(), expected)
+            else:
+                self.fail('invalid appstruct serialized')
+
+    def test_unknown_constant(self):
+        self.assertRaises(ValueError, cielo.message.compile_encoder,
+                          self.schemas['requisicao-consulta'], None, {'tid': '1', 'foo': '2'})
+
+
 class MessageDeserializationTestCase(unittest.TestCase):
     def assertLoads(self, node, message, test):
         etree = cielo.message.loads(message)
@@ -78,6 +263,39 @@ class MessageDeserializationTestCase(unittest.TestCase):
         node.add(colander.SchemaNode(colander.String(), name='sub'))
         self.assertLoads(node, '<node><sub>abcdef</sub></node>', {'sub': 'abcdef'})
 
+    def test_namespaces_are_removed(self):
+        tree = cielo.message.loads(
+            '<a xmlns="http://ecommerce.cbmp.com.br" xmlns:x="urn:x">'
+            '<b><x:c>1</x:c></b><d/></a>')
+        self.assertEqual([e.tag for e in tree.iter()], ['a', 'b', 'c', 'd'])
+
+    def test_namespaces_are_removed_by_every_backend(self):
+        for backend in cielo.message.available_backends():
+            previous = cielo.message.use_backend(backend)
+            try:
+                self.test_namespaces_are_removed()
+            finally:
+                cielo.message.use_backend(previous)
+
+    def test_parsers_without_setevents(self):
+        import xml.etree.ElementTree
+
+        class Parser(object):
+            def _setevents(self, events):
+                pass
+
+        class etree(object):
+            XMLParser = Parser
+            iterparse = staticmethod(xml.etree.ElementTree.iterparse)
+            ElementTree = xml.etree.ElementTree.ElementTree
+
+        previous = cielo.message.use_backend('ElementTree')
+        cielo.message.etree = etree
+        try:
+            self.test_namespaces_are_removed()
+        finally:
+            cielo.message.use_backend(previous)
+
     def test_empty_mapping_deserialization(self):
         node = colander.SchemaNode(colander.Mapping(), name='node')
         node.add(colander.SchemaNode(colander.String(), name='a', missing=colander.null))
@@ -86,6 +304,176 @@ class MessageDeserializationTestCase(unittest.TestCase):
         self.assertLoads(node, '<node/>', {'a': colander.null, 'b': colander.null, 'c': colander.null})
 
 
+class CompiledDecoderTestCase(unittest.TestCase):
+    def assertEquivalent(self, schema, response):
+        tree = cielo.message.loads(response)
+        decoder = cielo.message.compile_decoder(schema)
+        try:
+            expected = schema.deserialize(cielo.message.deserialize(schema, tree))
+        except colander.Invalid, e:
+            try:
+                decoder(tree.getroot())
+            except colander.Invalid, compiled:
+                self.assertEqual(compiled.asdict(), e.asdict())
+            else:
+                self.fail('invalid document decoded')
+        else:
+            self.assertEqual(decoder(tree.getroot()), expected)
+
+    def test_transaction(self):
+        self.assertEquivalent(cielo.TransactionSchema(), TRANSACTION_RESPONSE)
+
+    def test_error(self):
+        self.assertEquivalent(cielo.ErrorSchema(), ERROR_RESPONSE)
+
+    def test_invalid_transaction(self):
+        self.assertEquivalent(cielo.TransactionSchema(),
+                              TRANSACTION_RESPONSE.replace('<status>4<', '<status>42<'))
+        self.assertEquivalent(cielo.TransactionSchema(),
+                              TRANSACTION_RESPONSE.replace('<lr>0</lr>', '<lr></lr>'))
+        self.assertEquivalent(cielo.TransactionSchema(),
+                              TRANSACTION_RESPONSE.replace('<forma-pagamento>', '<outra-forma>')
+                                                  .replace('</forma-pagamento>', '</outra-forma>'))
+
+    def test_unknown_and_repeated_elements(self):
+        response = TRANSACTION_RESPONSE.replace(
+            '<status>4</status>', '<status>4</status><status>6</status><desconhecido/>')
+        self.assertEquivalent(cielo.TransactionSchema(), response)
+
+    def test_missing_optional_nodes(self):
+        schema = colander.SchemaNode(colander.Mapping(), name='node')
+        schema.add(colander.SchemaNode(colander.String(), name='a', attrib=True,
+                                       missing=colander.null))
+        schema.add(colander.SchemaNode(colander.String(), name='b', missing='x'))
+        schema.add(colander.SchemaNode(colander.String(), name='c', default=colander.drop,
+                                       missing=colander.null))
+        self.assertEquivalent(schema, '<node/>')
+        self.assertEquivalent(schema, '<node a="1"><b>2</b><c>3</c></node>')
+
+    def test_without_validation(self):
+        schema = cielo.TransactionSchema()
+        decoder = cielo.message.compile_decoder(schema, validate=False)
+        tree = cielo.message.loads(TRANSACTION_RESPONSE)
+        self.assertEqual(decoder(tree.getroot()),
+                         cielo.message.compile_decoder(schema)(tree.getroot()))
+
+        tree = cielo.message.loads(TRANSACTION_RESPONSE.replace('<status>4<', '<status>42<'))
+        self.assertEqual(decoder(tree.getroot())['status'], 42)
+        # types are still converted and required values still checked
+        for invalid in (TRANSACTION_RESPONSE.replace('<status>4<', '<status>x<'),
+                        TRANSACTION_RESPONSE.replace('<tid>', '<x>').replace('</tid>', '</x>')):
+            tree = cielo.message.loads(invalid)
+            self.assertRaises(colander.Invalid, decoder, tree.getroot())
+
+
+class BackendParityTestCase(unittest.TestCase):
+    """Every xml backend must produce the same requests and
+    appstructs."""
+
+    def setUp(self):
+        self.backends = cielo.message.available_backends()
+
+    def each_backend(self, fn):
+        results = {}
+        for backend in self.backends:
+            previous = cielo.message.use_backend(backend)
+            try:
+                results[backend] = fn()
+            finally:
+                cielo.message.use_backend(previous)
+        return results
+
+    def assertSameResults(self, fn):
+        results = self.each_backend(fn)
+        expected = results.pop(self.backends[-1])
+        for backend, result in results.items():
+            self.assertEqual(result, expected, '%s differs' % backend)
+
+    def test_force_backend(self):
+        for backend in self.backends:
+            previous = cielo.message.use_backend(backend)
+            try:
+                self.assertEqual(cielo.message.backend, backend)
+            finally:
+                cielo.message.use_backend(previous)
+        self.assertRaises(ValueError, cielo.message.use_backend, 'libxml3')
+
+    def test_requests(self):
+        from bbe.cielo import benchmark
+        request_schemas = cielo.schema._compile_request_schemas()
+
+        def dumps():
+            requests = {}
+            for tag, appstruct in benchmark.request_fixtures().items():
+                schema = request_schemas[tag]
+                tree = cielo.message.serialize(schema, schema.serialize(appstruct))
+                requests[tag] = cielo.message.dumps(tree, encoding='ISO-8859-1')
+                self.assertEqual(requests[tag], cielo.message.compile_encoder(
+                    schema, 'ISO-8859-1')(appstruct))
+            return requests
+
+        self.assertSameResults(dumps)
+
+    def test_empty_values(self):
+        node = colander.SchemaNode(colander.Mapping(), name='node')
+        node.add(colander.SchemaNode(colander.String(), name='b', attrib=True))
+        node.add(colander.SchemaNode(colander.String(), name='a', attrib=True))
+        node.add(colander.SchemaNode(colander.String(), name='c'))
+
+        def dumps():
+            appstruct = {'a': '1', 'b': '2', 'c': ''}
+            return cielo.message.dumps(cielo.message.serialize(node, node.serialize(appstruct)))
+
+        self.assertSameResults(dumps)
+
+    def test_control_characters(self):
+        # backends escape them differently, but the compiled encoders
+        # must follow the one in use
+        node = colander.SchemaNode(colander.Mapping(), name='node')
+        node.add(colander.SchemaNode(colander.String(), name='a', attrib=True))
+        node.add(colander.SchemaNode(colander.String(), name='b'))
+
+        def dumps(appstruct):
+            try:
+                return cielo.message.dumps(cielo.message.serialize(
+                    node, node.serialize(appstruct)), 'ISO-8859-1')
+            except ValueError:
+                return ValueError
+
+        def encode(appstruct):
+            try:
+                return cielo.message.compile_encoder(node, 'ISO-8859-1')(appstruct)
+            except ValueError:
+                return ValueError
+
+        def compare():
+            for text in (u'a\r\nb\tc', u'a\x01b'):
+                appstruct = {'a': text, 'b': text}
+                self.assertEqual(encode(appstruct), dumps(appstruct),
+                                 '%s differs' % cielo.message.backend)
+
+        self.each_backend(compare)
+
+    def test_responses(self):
+        from bbe.cielo import benchmark
+        response_schemas = {
+            'erro': cielo.ErrorSchema(),
+            'transacao': cielo.TransactionSchema(),
+        }
+
+        def loads():
+            appstructs = {}
+            for name, response in benchmark.response_fixtures().items():
+                tree = cielo.message.loads(response)
+                schema = response_schemas[cielo.message.get_root_tag(tree)]
+                appstructs[name] = schema.deserialize(cielo.message.deserialize(schema, tree))
+                self.assertEqual(appstructs[name],
+                                 cielo.message.compile_decoder(schema)(tree.getroot()))
+            return appstructs
+
+        self.assertSameResults(loads)
+
+
 class MoneyTestCase(unittest.TestCase):
     def setUp(self):
         self.node = colander.SchemaNode(cielo.Money())
@@ -141,12 +529,1487 @@ class MoneyTestCase(unittest.TestCase):
         self.assertRaises(colander.Invalid, self.node.deserialize, None)
         self.assertRaises(colander.Invalid, self.node.deserialize, 'notanumber')
 
+
+class InconsistentDateTimeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.node = colander.SchemaNode(cielo.schema.InconsistentDateTime())
+
+    def test_deserialization(self):
+        value = self.node.deserialize('2012-08-11T08:48:23.659-03:00')
+        self.assertEqual(value.replace(tzinfo=None), datetime.datetime(2012, 8, 11, 8, 48, 23, 659000))
+        self.assertEqual(value.utcoffset(), datetime.timedelta(hours=-3))
+        self.assertEqual(self.node.deserialize('2012-08-11T11:48:23.659Z'), value)
+        self.assertEqual(self.node.deserialize('2012-08-11T08:48:23+05:30').utcoffset(),
+                         datetime.timedelta(hours=5, minutes=30))
+        self.assertEqual(self.node.deserialize('2012-08-11T08:48:23'),
+                         datetime.datetime(2012, 8, 11, 8, 48, 23))
+
+    def test_tzinfo_is_cached(self):
+        a = self.node.deserialize('2012-08-11T08:48:23.659-03:00')
+        b = self.node.deserialize('2013-01-01T00:00:00-03:00')
+        self.assertIs(a.tzinfo, b.tzinfo)
+
+    def test_invalid_values(self):
+        for cstruct in ('2012-08-11', '2012-08-11 08:48:23', '2012-08-11T08:48:23-24:00',
+                        '2012-13-11T08:48:23', '2012-08-11T08:48:23.1234567', None):
+            self.assertRaises(colander.Invalid, self.node.deserialize, cstruct)
+
+    def test_serialization(self):
+        self.assertEqual(self.node.serialize(datetime.datetime(2012, 8, 11, 8, 48, 23, 659000)),
+                         '2012-08-11T08:48:23')
+        self.assertEqual(self.node.serialize(datetime.date(2012, 8, 11)), '2012-08-11T00:00:00')
+        aware = cielo.schema.parse_datetime('2012-08-11T08:48:23-03:00')
+        self.assertRaises(colander.Invalid, self.node.serialize, aware)
+        self.assertRaises(colander.Invalid, self.node.serialize, '2012-08-11')
+
+    def test_month(self):
+        node = colander.SchemaNode(cielo.schema.Month())
+        self.assertEqual(node.serialize(datetime.date(2020, 2, 29)), '202002')
+        self.assertEqual(node.deserialize('202002'), datetime.date(2020, 2, 1))
+        for cstruct in ('202013', '20202', '2020-2'):
+            self.assertRaises(colander.Invalid, node.deserialize, cstruct)
+
+
+class TrustedResponsesTestCase(unittest.TestCase):
+    def client(self, response, **kwargs):
+        transport = cielo.transport.LoopbackTransport(lambda request: response)
+        return cielo.Client('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                            transport=transport, **kwargs)
+
+    def test_validation_is_skipped(self):
+        response = TRANSACTION_RESPONSE.replace('<status>4<', '<status>42<')
+        self.assertRaises(colander.Invalid, self.client(response).query_by_tid, '1')
+        client = self.client(response, trust_responses=True)
+        self.assertEqual(client.query_by_tid('1').status, 42)
+        self.assertEqual(client.query_by_tid('1').authorization.arp, '123456')
+
+    def test_sampling(self):
+        response = TRANSACTION_RESPONSE.replace('<status>4<', '<status>42<')
+        client = self.client(response, trust_responses=True, sample_validation=3)
+        errors = []
+        client.report_validation_error = lambda response, error: errors.append(error)
+        for i in range(7):
+            self.assertEqual(client.query_by_tid('1').status, 42)
+        self.assertEqual(len(errors), 3)
+        self.assertIn('status', errors[0].asdict())
+
+        client = self.client(TRANSACTION_RESPONSE, trust_responses=True, sample_validation=1)
+        client.report_validation_error = lambda response, error: errors.append(error)
+        client.query_by_tid('1')
+        self.assertEqual(len(errors), 3)
+
+
+class LazyTransactionTestCase(unittest.TestCase):
+    def query(self, response=TRANSACTION_RESPONSE, **kwargs):
+        transport = cielo.transport.LoopbackTransport(lambda request: response)
+        client = cielo.Client('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                              transport=transport, **kwargs)
+        return client.query_by_tid('100699306905227C1001')
+
+    def test_nodes_are_decoded_on_access(self):
+        transaction = self.query()
+        self.assertFalse(hasattr(transaction, '__dict__'))
+        self.assertEqual(sorted(transaction._nodes[1]), ['authorization'])
+        self.assertEqual(transaction.status, cielo.ST_AUTHORIZED)
+        self.assertIsNone(transaction.capture)
+        self.assertIsNone(transaction.cancel)
+        self.assertIsNone(transaction.authentication)
+        self.assertEqual(transaction.authorization.arp, '123456')
+        self.assertEqual(transaction.authorization.value, Decimal('200.00'))
+        self.assertIs(transaction.authorization, transaction.authorization)
+        self.assertIsNone(transaction._nodes)
+
+    def test_concurrent_access(self):
+        transaction = self.query()
+        # another thread may decode the nodes between the check of a
+        # node and the decoding
+        transaction._decode_nodes()
+        transaction._decode_nodes()
+        self.assertEqual(transaction.authorization.arp, '123456')
+
+        transactions = [self.query() for i in range(50)]
+        errors = []
+
+        def read():
+            for transaction in transactions:
+                try:
+                    self.assertEqual(transaction.authorization.arp, '123456')
+                except Exception, e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(errors, [])
+
+    def test_invalid_nodes_raise_on_access(self):
+        transaction = self.query(TRANSACTION_RESPONSE.replace('<lr>0</lr>', '<lr>x</lr>'))
+        self.assertEqual(transaction.status, cielo.ST_AUTHORIZED)
+        self.assertRaises(colander.Invalid, getattr, transaction, 'authorization')
+
+    def test_sampled_responses_are_decoded_eagerly(self):
+        transaction = self.query(trust_responses=True, sample_validation=1)
+        self.assertIsNone(transaction._nodes)
+        self.assertEqual(transaction.authorization.arp, '123456')
+
+    def test_pickle(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            transaction = pickle.loads(pickle.dumps(self.query(), protocol))
+            self.assertEqual(transaction.tid, '100699306905227C1001')
+            self.assertEqual(transaction.authorization.arp, '123456')
+            self.assertIsNone(transaction.capture)
+
+
+class ErrorTestCase(unittest.TestCase):
+    codes = [1, 2, 3] + range(10, 23) + [25] + range(30, 37) + range(40, 44) + \
+        range(51, 58) + [61, 77, 78] + range(86, 91) + [95, 97, 98, 99]
+
+    def test_every_code_has_a_class(self):
+        for code in self.codes:
+            cls = cielo.Error.get_error_class(code)
+            self.assertEqual(cls.code, code)
+            self.assertTrue(cls.description)
+            self.assertNotEqual(cls.client_fault, cls.gateway_fault)
+        self.assertIs(cielo.Error.get_error_class(98), cielo.TimeoutError)
+        self.assertIs(cielo.Error.get_error_class(4), cielo.Error)
+
+    def test_classification(self):
+        self.assertFalse(cielo.Error.retryable or cielo.Error.idempotent_safe)
+        for cls in (cielo.InvalidCaptureValueError, cielo.TransactionNotFoundError):
+            self.assertFalse(cls.retryable)
+            self.assertTrue(cls.idempotent_safe)
+            self.assertTrue(cls.client_fault)
+        self.assertTrue(cielo.UnavailableError.retryable)
+        self.assertTrue(cielo.UnavailableError.idempotent_safe)
+        self.assertTrue(cielo.TimeoutError.retryable)
+        self.assertFalse(cielo.TimeoutError.idempotent_safe)
+        self.assertTrue(cielo.TimeoutError.gateway_fault)
+
+    def test_subclasses_are_registered(self):
+        class MyError(cielo.Error):
+            code = 1234
+        self.assertIs(cielo.Error.get_error_class(1234), MyError)
+
+    def test_client_raises_the_error_class(self):
+        transport = cielo.transport.LoopbackTransport(lambda request: ERROR_RESPONSE)
+        client = cielo.Client('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                              transport=transport)
+        try:
+            client.capture_transaction('1')
+        except cielo.InvalidCaptureValueError, e:
+            self.assertEqual(e.code, 32)
+        else:
+            self.fail('error not raised')
+
+
+class OrderNumberTestCase(unittest.TestCase):
+    def test_format(self):
+        generator = orders.OrderNumberGenerator(worker_id=42)
+        number = generator()
+        self.assertEqual(len(number), 20)
+        self.assertTrue(number.isalnum() and number.islower())
+        self.assertEqual(number[9:15], orders.encode(42, 6))
+        self.assertRaises(ValueError, orders.OrderNumberGenerator, orders.MAX_WORKERS)
+
+    def test_encode(self):
+        self.assertEqual(orders.encode(0, 5), '00000')
+        self.assertEqual(orders.encode(36 ** 5 - 1, 5), 'zzzzz')
+        self.assertEqual(int(orders.encode(123456789, 9), 36), 123456789)
+        self.assertRaises(OverflowError, orders.encode, 36 ** 5, 5)
+
+    def test_numbers_are_unique_and_sorted(self):
+        clock = iter([1.0] * 500 + [1.001] * 500 + [1.0005] * 500).next
+        generator = orders.OrderNumberGenerator(worker_id=1, clock=clock)
+        numbers = [generator() for i in range(1500)]
+        self.assertEqual(len(set(numbers)), 1500)
+        self.assertEqual(numbers[:1000], sorted(numbers[:1000]))
+
+    def test_time_bounds(self):
+        when = datetime.datetime(2012, 8, 11, 8, 48, 23, 659000)
+        epoch = (when - datetime.datetime(1970, 1, 1)).total_seconds()
+        number = orders.OrderNumberGenerator(worker_id=7, clock=lambda: epoch)()
+        self.assertEqual(orders.timestamp(number), when)
+        lowest, highest = orders.bounds(when, when + datetime.timedelta(milliseconds=1))
+        self.assertTrue(lowest <= number < highest)
+        lowest, highest = orders.bounds(when - datetime.timedelta(hours=1), when)
+        self.assertTrue(highest <= number)
+
+    def test_forked_workers_get_their_own_id(self):
+        generator = orders.OrderNumberGenerator(worker_id=lambda: os.getpid() % 1000)
+        read, write = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.write(write, generator())
+            os._exit(0)
+        os.waitpid(pid, 0)
+        number = os.read(read, 20)
+        os.close(read)
+        os.close(write)
+        self.assertEqual(number[9:15], orders.encode(pid % 1000, 6))
+
+    def test_default_worker_ids_are_random(self):
+        clock = lambda: 1.0
+        numbers = [orders.OrderNumberGenerator(clock=clock)() for i in range(2)]
+        self.assertNotEqual(numbers[0], numbers[1])
+
+        generator = orders.OrderNumberGenerator(clock=clock)
+        read, write = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.write(write, generator())
+            os._exit(0)
+        os.waitpid(pid, 0)
+        number = os.read(read, 20)
+        os.close(read)
+        os.close(write)
+        self.assertNotEqual(number[9:15], generator()[9:15])
+
+    def test_client(self):
+        client = cielo.Client('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                              order_number_generator=lambda: 'x' * 20)
+        self.assertEqual(client.generate_order_number(), 'x' * 20)
+        client = cielo.Client('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA)
+        self.assertTrue(client.generate_order_number() < client.generate_order_number())
+
+
+class StatusCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = cache.StatusCache(maxsize=4, clock=lambda: self.now)
+        self.simulator = simulator.Simulator(seed=1)
+        self.client = cielo.Client(
+            '1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA, cache=self.cache,
+            transport=simulator.SimulatorTransport(self.simulator))
+
+    def transaction(self, tid, status, order=None):
+        return cielo.Transaction(tid=tid, order=order or 'o' + tid, store='1006993069',
+                                 value=Decimal('1.00'), currency='986', datetime=None,
+                                 language='PT', brand=cielo.VISA, installments=1,
+                                 product=cielo.CREDITO_A_VISTA, status=status, pan='')
+
+    def test_ttl_depends_on_status(self):
+        self.cache.maxsize = 10
+        for tid, status in (('1', cielo.ST_CAPTURED), ('2', cielo.ST_PROCESSING),
+                            ('3', cielo.ST_AUTHORIZED)):
+            self.cache.put(self.transaction(tid, status))
+        self.now += 10
+        self.assertIsNotNone(self.cache.get_by_tid('1006993069', '1'))
+        self.assertIsNone(self.cache.get_by_tid('1006993069', '2'))
+        self.assertIsNone(self.cache.get_by_order_number('1006993069', 'o2'))
+        self.assertIsNotNone(self.cache.get_by_order_number('1006993069', 'o3'))
+        self.now += 30
+        self.assertIsNone(self.cache.get_by_tid('1006993069', '3'))
+        self.assertIsNotNone(self.cache.get_by_tid('1006993069', '1'))
+        self.assertIsNone(self.cache.get_by_tid('other store', '1'))
+
+    def test_lru_eviction(self):
+        for tid in '12':
+            self.cache.put(self.transaction(tid, cielo.ST_CAPTURED))
+        self.cache.get_by_tid('1006993069', '1')
+        self.cache.put(self.transaction('3', cielo.ST_CAPTURED))
+        self.assertEqual(len(self.cache), 4)
+        self.assertIsNotNone(self.cache.get_by_tid('1006993069', '1'))
+        self.assertIsNone(self.cache.get_by_tid('1006993069', '2'))
+
+    def test_invalidate(self):
+        self.cache.put(self.transaction('1', cielo.ST_CAPTURED))
+        self.cache.invalidate('1006993069', tid='1')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_write_through(self):
+        transaction = create_transaction(self.client)
+        self.assertIs(self.client.query_by_tid(transaction.tid), transaction)
+        self.assertIs(self.client.query_by_order_number(transaction.order), transaction)
+        self.assertEqual(self.simulator.stats['requisicao-consulta'], 0)
+
+        captured = self.client.capture_transaction(transaction.tid)
+        self.assertEqual(captured.status, cielo.ST_CAPTURED)
+        self.assertIs(self.client.query_by_tid(transaction.tid), captured)
+        self.assertEqual(self.simulator.stats['requisicao-consulta'], 0)
+
+        self.cache.clear()
+        self.assertEqual(self.client.query_by_tid(transaction.tid).status, cielo.ST_CAPTURED)
+        self.assertEqual(self.simulator.stats['requisicao-consulta'], 1)
+
+    def test_stale_responses_are_not_cached(self):
+        transaction = create_transaction(self.client)
+        self.cache.clear()
+        answered, release = threading.Event(), threading.Event()
+
+        def handle(request):
+            response = self.simulator.handle(request)
+            if threading.current_thread() is not main:
+                # answered before the capture, received after it
+                answered.set()
+                release.wait(10)
+            return response
+
+        main = threading.current_thread()
+        self.client.transport = cielo.transport.LoopbackTransport(handle)
+        queried = []
+        query = threading.Thread(target=lambda: queried.append(
+            self.client.query_by_tid(transaction.tid)))
+        query.start()
+        self.assertTrue(answered.wait(10))
+        captured = self.client.capture_transaction(transaction.tid)
+        release.set()
+        query.join(10)
+
+        self.assertEqual(queried[0].status, cielo.ST_AUTHORIZED)
+        self.assertEqual(captured.status, cielo.ST_CAPTURED)
+        self.assertIs(self.client.query_by_tid(transaction.tid), captured)
+        self.assertEqual(self.simulator.stats['requisicao-consulta'], 1)
+
+    def test_invalidations_are_bounded(self):
+        generation = self.cache.generation()
+        for tid in '12345':
+            self.cache.invalidate('1006993069', tid=tid)
+        # the invalidation of '1' was forgotten, so older puts are ignored
+        self.cache.put(self.transaction('6', cielo.ST_CAPTURED), generation)
+        self.assertEqual(len(self.cache), 0)
+        self.cache.put(self.transaction('6', cielo.ST_CAPTURED), self.cache.generation())
+        self.assertEqual(len(self.cache), 2)
+
+    def test_failed_captures_invalidate(self):
+        transaction = create_transaction(self.client)
+        self.client.capture_transaction(transaction.tid)
+        self.assertRaises(cielo.CaptureNotAllowedError,
+                          self.client.capture_transaction, transaction.tid)
+        self.assertIsNone(self.cache.get_by_tid('1006993069', transaction.tid))
+        self.assertIsNone(self.cache.get_by_order_number('1006993069', transaction.order))
+
+    def test_async_client(self):
+        client = cielo.AsyncClient('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                                   cache=self.cache, transport=self.client.transport)
+        transaction = self.transaction('1', cielo.ST_CAPTURED)
+        self.cache.put(transaction)
+        future = client.query_by_tid('1')
+        self.assertTrue(future.done())
+        self.assertIs(future.result(), transaction)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.response = TRANSACTION_RESPONSE
+
+        def respond(request):
+            self.release.wait(10)
+            return self.response
+
+        self.transport = cielo.transport.LoopbackTransport(respond)
+
+    def client(self, cls=cielo.Client, coalesce=True, **kwargs):
+        return cls('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                   transport=self.transport, coalesce=coalesce, **kwargs)
+
+    def test_concurrent_queries_share_a_call(self):
+        client = self.client(cielo.AsyncClient)
+        futures = [client.query_by_tid('1') for i in range(5)]
+        other = client.query_by_order_number('1')
+        self.release.set()
+        transactions = [future.result(timeout=10) for future in futures]
+        other.result(timeout=10)
+        self.assertEqual(self.transport.requests, 2)
+        self.assertEqual(len(set(map(id, transactions))), 1)
+        self.assertEqual(client.single_flight.calls, 2)
+        self.assertEqual(client.single_flight.saved, 4)
+
+        # later queries make their own calls
+        client.query_by_tid('1').result(timeout=10)
+        self.assertEqual(self.transport.requests, 3)
+
+    def test_errors_are_shared(self):
+        self.response = ERROR_RESPONSE
+        client = self.client()
+        results = []
+
+        def query():
+            try:
+                client.query_by_tid('1')
+            except cielo.Error, e:
+                results.append(e)
+
+        threads = [threading.Thread(target=query) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        while client.single_flight.saved < 2:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([e.code for e in results], [32] * 3)
+        self.assertEqual(self.transport.requests, 1)
+
+    def test_captures_are_not_coalesced(self):
+        client = self.client(cielo.AsyncClient)
+        futures = [client.capture_transaction('1') for i in range(2)]
+        self.release.set()
+        for future in futures:
+            future.result(timeout=10)
+        self.assertEqual(self.transport.requests, 2)
+        self.assertEqual(client.single_flight.calls, 0)
+
+    def test_disabled(self):
+        client = cielo.AsyncClient('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                                   transport=self.transport)
+        self.assertIsNone(client.single_flight)
+        futures = [client.query_by_tid('1') for i in range(2)]
+        self.release.set()
+        for future in futures:
+            future.result(timeout=10)
+        self.assertEqual(self.transport.requests, 2)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_token_bucket(self):
+        now = [0.0]
+        slept = []
+        limiter = ratelimit.RateLimiter(2, clock=lambda: now[0], sleep=slept.append)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(slept, [])
+        self.assertFalse(limiter.try_acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(slept, [0.5])
+        # the caller that waited already took the next token
+        now[0] = 0.5
+        self.assertFalse(limiter.try_acquire())
+        now[0] = 1.0
+        self.assertTrue(limiter.try_acquire())
+
+    def test_keyed(self):
+        now = [0.0]
+        limiter = ratelimit.KeyedRateLimiter(1, clock=lambda: now[0])
+        self.assertIs(limiter.get('a'), limiter.get('a'))
+        self.assertTrue(limiter.acquire('a', 0))
+        self.assertFalse(limiter.acquire('a', 0))
+        # other keys have budgets of their own
+        self.assertTrue(limiter.acquire('b', 0))
+
+
+class RegistryTestCase(unittest.TestCase):
+    stores = {'1006993069': 'key-a', '1001734898': 'key-b'}
+
+    def setUp(self):
+        self.simulator = simulator.Simulator(seed=1, stores=self.stores)
+        self.registry = registry.ClientRegistry(
+            cielo.PARCELADO_ADMINISTRADORA, cache=cache.StatusCache(), rate=1000,
+            coalesce=True, transport=simulator.SimulatorTransport(self.simulator))
+        for store_id, store_key in self.stores.iteritems():
+            self.registry.register(store_id, store_key)
+
+    def test_shared_clients(self):
+        a, b = self.registry.get('1006993069'), self.registry['1001734898']
+        self.assertIs(a, self.registry.get('1006993069'))
+        self.assertEqual((a.store_id, a.store_key), ('1006993069', 'key-a'))
+        for attr in ('transport', 'cache', 'single_flight', '_request_schema_map',
+                     '_response_decoder_map'):
+            self.assertIs(getattr(a, attr), getattr(b, attr))
+        self.assertIsNot(a.limiter, b.limiter)
+        self.assertIs(a.limiter, self.registry.limiter.get('1006993069'))
+        self.assertEqual(len(self.registry), 2)
+        self.assertIn('1001734898', self.registry)
+        self.assertRaises(KeyError, self.registry.get, '1234567890')
+
+        self.registry.unregister('1001734898')
+        self.assertNotIn('1001734898', self.registry)
+        self.assertRaises(KeyError, self.registry.get, '1001734898')
+
+    def test_partitioned_by_store(self):
+        a, b = self.registry.get('1006993069'), self.registry.get('1001734898')
+        transaction = create_transaction(a, authorize=1)
+        self.assertEqual(a.query_by_tid(transaction.tid).tid, transaction.tid)
+        # b can't see the transactions of a, cached or not
+        self.assertRaises(cielo.TransactionNotFoundError, b.query_by_tid, transaction.tid)
+
+        usage = self.registry.usage('1006993069')
+        self.assertEqual(sorted(usage), ['requisicao-transacao'])
+        self.assertEqual(usage['requisicao-transacao']['requests'], 1)
+        self.assertEqual(usage['requisicao-transacao']['errors'], 0)
+        self.assertTrue(usage['requisicao-transacao']['request_bytes'] > 0)
+        usage = self.registry.usage('1001734898')
+        self.assertEqual(usage['requisicao-consulta']['requests'], 1)
+        self.assertEqual(usage['requisicao-consulta']['errors'], 1)
+
+    def test_rate(self):
+        now = [0.0]
+        self.registry.limiter = ratelimit.KeyedRateLimiter(1, clock=lambda: now[0])
+        self.registry.register('1006993069', 'key-a')
+        client = self.registry.get('1006993069')
+        transaction = create_transaction(client, authorize=1)
+        # the second request would have to wait past its deadline
+        self.assertRaises(cielo.CommunicationError, client.query_by_tid,
+                          transaction.tid + '0', timeout=0.1)
+        now[0] = 1.0
+        self.assertRaises(cielo.TransactionNotFoundError, client.query_by_tid,
+                          transaction.tid + '0', timeout=0.1)
+
+
+class WatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.simulator = simulator.Simulator(seed=1, auto_advance=0)
+        self.client = cielo.Client(
+            '1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+            transport=simulator.SimulatorTransport(self.simulator))
+        self.watcher = watcher.Watcher(self.client, rate=1000, min_interval=0.005,
+                                       max_interval=0.02, seed=1)
+
+    def tearDown(self):
+        self.watcher.close()
+
+    def test_until_final_status(self):
+        done = []
+        tids = [create_transaction(self.client, authorize=1).tid for i in range(3)]
+        futures = [self.watcher.watch(tid, callback=done.append) for tid in tids]
+        self.assertIs(self.watcher.watch(tids[0]), futures[0])
+        for tid, future in zip(tids, futures):
+            transaction = future.result(timeout=10)
+            self.assertEqual(transaction.tid, tid)
+            self.assertEqual(transaction.status, cielo.ST_AUTHORIZED)
+        # created -> authenticating -> authorized
+        self.assertEqual(self.watcher.queries, 6)
+        self.assertEqual(len(self.watcher), 0)
+        while len(done) < 3:
+            time.sleep(0.001)
+        self.assertEqual(sorted(map(id, done)), sorted(map(id, futures)))
+
+    def test_authenticated_transactions_are_reported(self):
+        # they wait for an authorization request
+        future = self.watcher.watch(create_transaction(self.client, authorize=0).tid)
+        self.assertEqual(future.result(timeout=10).status, cielo.ST_AUTHENTICATED)
+
+    def test_backoff_and_timeout(self):
+        self.simulator.auto_advance = None
+        tid = create_transaction(self.client, authorize=1).tid
+        future = self.watcher.watch(tid, timeout=0.1)
+        self.assertRaises(cielo.executor.Timeout, future.result, 10)
+        # 5ms, 10ms, then every 20ms or so
+        self.assertTrue(3 <= self.watcher.queries <= 8, self.watcher.queries)
+
+    def test_retryable_errors(self):
+        tid = create_transaction(self.client, authorize=1).tid
+        self.simulator.error_rate = 1
+        self.simulator.error_codes = (97,)
+        future = self.watcher.watch(tid)
+        while self.watcher.errors < 2:
+            time.sleep(0.001)
+        self.simulator.error_rate = 0
+        self.assertEqual(future.result(timeout=10).status, cielo.ST_AUTHORIZED)
+
+    def test_unwatch_and_close(self):
+        self.simulator.auto_advance = None
+        tids = [create_transaction(self.client, authorize=1).tid for i in range(2)]
+        done = []
+        futures = [self.watcher.watch(tid, callback=done.append) for tid in tids]
+        self.watcher.unwatch(tids[0])
+        self.assertRaises(cielo.executor.Cancelled, futures[0].result, 1)
+        self.watcher.close()
+        self.assertRaises(cielo.executor.Cancelled, futures[1].result, 1)
+        self.assertEqual(len(done), 2)
+
+    def test_other_errors_end_the_watch(self):
+        future = self.watcher.watch('unknown')
+        self.assertRaises(cielo.TransactionNotFoundError, future.result, 10)
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.simulator = simulator.Simulator(seed=1)
+        self.client = cielo.Client(
+            '1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+            transport=simulator.SimulatorTransport(self.simulator))
+        fd, self.checkpoint = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def test_capture_many(self):
+        tids = [create_transaction(self.client).tid for i in range(5)]
+        captures = tids[:3] + [(tids[3], Decimal('150.00'), u'parcial'),
+                               (tids[4], Decimal('300.00'), None)]
+        summary = batch.capture_many(self.client, captures + ['unknown'], max_workers=3)
+        self.assertEqual(summary.succeeded, 4)
+        self.assertEqual(summary.failures, {32: 1, 3: 1})
+        self.assertEqual(summary.errors[tids[4]].code, 32)
+        self.assertEqual(self.client.query_by_tid(tids[3]).capture.value, Decimal('150.00'))
+        self.assertIn('error 32 (Valor de captura', str(summary))
+
+    def test_checkpoint(self):
+        tids = [create_transaction(self.client).tid for i in range(4)]
+        self.simulator.error_rate = 1
+        self.simulator.error_codes = (97,)
+        summary = batch.capture_many(self.client, tids, checkpoint=self.checkpoint)
+        self.assertEqual(summary.failures, {97: 4})
+
+        # retryable failures are not recorded
+        self.simulator.error_rate = 0
+        summary = batch.capture_many(self.client, tids[:2], checkpoint=self.checkpoint)
+        self.assertEqual((summary.succeeded, summary.skipped), (2, 0))
+        # a line cut short by a crash
+        with open(self.checkpoint, 'ab') as f:
+            f.write(tids[2])
+
+        summary = batch.capture_many(self.client, tids, checkpoint=self.checkpoint, rate=1000)
+        self.assertEqual((summary.succeeded, summary.skipped), (2, 2))
+        self.assertEqual(self.simulator.stats['requisicao-captura'], 4)
+        self.assertEqual(batch.Checkpoint(self.checkpoint).done,
+                         dict((tid, 'ok') for tid in tids))
+
+    def test_lost_responses(self):
+        tids = [create_transaction(self.client).tid for i in range(3)]
+        handle = self.client.transport.handler
+
+        def drop_captures(request):
+            response = handle(request)
+            if 'requisicao-captura' in request:
+                raise simulator.Dropped()
+            return response
+
+        # the captures are checked right away
+        self.client.transport.handler = drop_captures
+        summary = batch.capture_many(self.client, tids[:1], checkpoint=self.checkpoint)
+        self.assertEqual((summary.succeeded, summary.failed), (1, 0))
+
+        # and, if that fails too, by the next run
+        self.simulator.drop_rate = 1
+        summary = batch.capture_many(self.client, tids, checkpoint=self.checkpoint)
+        self.assertEqual((summary.skipped, summary.failures), (1, {None: 2}))
+        self.assertEqual(batch.Checkpoint(self.checkpoint).ambiguous, set(tids[1:]))
+
+        self.client.transport.handler = handle
+        self.simulator.drop_rate = 0
+        summary = batch.capture_many(self.client, tids, checkpoint=self.checkpoint)
+        self.assertEqual((summary.succeeded, summary.skipped, summary.failed), (2, 1, 0))
+        checkpoint = batch.Checkpoint(self.checkpoint)
+        self.assertEqual(checkpoint.done, dict((tid, 'ok') for tid in tids))
+        self.assertEqual(checkpoint.ambiguous, set())
+
+    def test_unexpected_errors(self):
+        tids = [create_transaction(self.client).tid for i in range(2)]
+        # too many arguments for capture_transaction
+        captures = [tids[0], (tids[1], None, None, None, None)]
+        summary = batch.capture_many(self.client, captures, checkpoint=self.checkpoint)
+        self.assertEqual((summary.succeeded, summary.failures), (1, {'TypeError': 1}))
+        self.assertIsInstance(summary.errors[tids[1]], TypeError)
+        self.assertIn('TypeError errors: 1', str(summary))
+        self.assertEqual(batch.Checkpoint(self.checkpoint).done, {tids[0]: 'ok'})
+
+    def test_cancel_many(self):
+        tids = [create_transaction(self.client).tid for i in range(3)]
+        self.client.cancel_transaction(tids[0])
+        summary = batch.cancel_many(self.client, tids, checkpoint=self.checkpoint)
+        self.assertEqual((summary.succeeded, summary.failures), (2, {41: 1}))
+        summary = batch.cancel_many(self.client, tids, checkpoint=self.checkpoint)
+        self.assertEqual(summary.skipped, 3)
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.simulator = simulator.Simulator(seed=1)
+        self.timings = []
+        observer = metrics.Observer()
+        observer.observe = self.timings.append
+        self.client = cielo.Client(
+            '1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA, observer=observer,
+            transport=simulator.SimulatorTransport(self.simulator))
+
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        for i in range(1, 10001):
+            histogram.record(i / 1000.0)
+        self.assertEqual((histogram.count, histogram.min, histogram.max), (10000, 0.001, 10))
+        self.assertAlmostEqual(histogram.mean, 5.0005)
+        for percent in (1, 50, 90, 99, 99.9):
+            self.assertAlmostEqual(histogram.percentile(percent) / (percent / 10.0), 1, delta=0.016)
+        self.assertEqual(histogram.percentile(100), 10)
+        for index in range(2000):
+            self.assertEqual(histogram._bounds(index)[1], histogram._bounds(index + 1)[0])
+            low, high = histogram._bounds(index)
+            self.assertEqual(histogram._index(low), index)
+            self.assertEqual(histogram._index(high - 1), index)
+
+    def test_phases(self):
+        tid = create_transaction(self.client).tid
+        self.client.query_by_tid(tid)
+        self.assertRaises(cielo.TransactionNotFoundError, self.client.query_by_tid, 'unknown')
+
+        self.assertEqual([t.tag for t in self.timings],
+                         ['requisicao-transacao', 'requisicao-consulta', 'requisicao-consulta'])
+        self.assertEqual([t.root_tag for t in self.timings], ['transacao', 'transacao', 'erro'])
+        self.assertEqual([t.error_code for t in self.timings], [None, None, 3])
+        for timings in self.timings:
+            self.assertEqual(timings.store, '1006993069')
+            for phase in metrics.PHASES:
+                self.assertTrue(getattr(timings, phase) >= 0)
+            self.assertTrue(timings.request_size > 0 and timings.response_size > 0)
+        self.assertTrue(self.timings[0].request_size > self.timings[1].request_size)
+
+    def test_communication_errors(self):
+        self.simulator.drop_rate = 1
+        self.assertRaises(cielo.CommunicationError, self.client.query_by_tid, '1')
+        timings, = self.timings
+        self.assertIsInstance(timings.error, cielo.CommunicationError)
+        self.assertTrue(timings.network >= 0)
+        self.assertIsNone(timings.parse)
+        self.assertIsNone(timings.response_size)
+
+    def test_async_client(self):
+        client = cielo.AsyncClient('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                                   observer=self.client.observer,
+                                   transport=self.client.transport)
+        tid = create_transaction(client).result(timeout=10).tid
+        client.query_by_tid(tid).result(timeout=10)
+        self.assertEqual([t.tag for t in self.timings],
+                         ['requisicao-transacao', 'requisicao-consulta'])
+        self.assertTrue(all(t.build is not None for t in self.timings))
+
+    def test_histogram_observer(self):
+        observer = self.client.observer = metrics.HistogramObserver()
+        tid = create_transaction(self.client).tid
+        for i in range(3):
+            self.client.query_by_tid(tid)
+        self.assertRaises(cielo.Error, self.client.query_by_tid, 'unknown')
+        snapshot = observer.snapshot()
+        query = snapshot['requisicao-consulta']
+        self.assertEqual(query['total']['count'], 4)
+        self.assertEqual(query['errors'], {3: 1})
+        self.assertTrue(query['network']['p50'] <= query['network']['max'])
+        self.assertTrue(query['response_bytes'] > 0)
+        self.assertEqual(snapshot['requisicao-transacao']['decode']['count'], 1)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_fixtures_cover_every_request(self):
+        from bbe.cielo import benchmark
+        self.assertEqual(sorted(benchmark.request_fixtures()),
+                         sorted(cielo.schema._compile_request_schemas()))
+
+    def test_baseline(self):
+        from bbe.cielo import benchmark
+        out = StringIO.StringIO()
+        results = benchmark.run('money: serialize', out, repeat=1, min_time=0.001)
+        self.assertEqual(results.keys(), ['money: serialize'])
+        self.assertEqual(benchmark.compare(results, results, out=out), [])
+
+        baseline = {'money: serialize': dict(results['money: serialize'])}
+        baseline['money: serialize']['optimized'] *= 2
+        self.assertEqual(benchmark.compare(results, baseline, 0.6, out=out), [])
+        self.assertEqual(benchmark.compare(results, baseline, 0.4, out=out),
+                         ['money: serialize'])
+        baseline['money: serialize']['optimized'] /= 2
+        baseline['money: serialize']['optimized_retained'] -= 1
+        self.assertEqual(benchmark.compare(results, baseline, out=out),
+                         ['money: serialize'])
+        self.assertIn('REGRESSION money: serialize', out.getvalue())
+
+
+class TimeoutsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.timeouts = []
+        self.handler = lambda request: TRANSACTION_RESPONSE
+        test = self
+
+        class Transport(cielo.transport.LoopbackTransport):
+            def send(self, data, timeout=None):
+                test.timeouts.append(timeout)
+                return super(Transport, self).send(data, timeout)
+
+        self.transport = Transport(lambda request: self.handler(request))
+
+    def client(self, cls=cielo.Client, **kwargs):
+        return cls('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                   transport=self.transport, coalesce=False, **kwargs)
+
+    def test_adaptive_timeouts(self):
+        adaptive = timeouts.AdaptiveTimeouts(min_timeout=0.5, max_timeout=10,
+                                             min_samples=10, refresh=1)
+        for i in range(9):
+            t = metrics.Timings('requisicao-consulta', '1')
+            t.network = i / 10.0
+            adaptive.observe(t)
+        self.assertEqual(adaptive.timeout('requisicao-consulta'), 10)
+        t.network, t.error = 100, cielo.CommunicationError('timed out')
+        adaptive.observe(t)
+        self.assertEqual(adaptive.timeout('requisicao-consulta'), 10)
+        t.network, t.error = 1.2, None
+        adaptive.observe(t)
+        self.assertEqual(adaptive.latency('requisicao-consulta', 50), 0.4)
+        self.assertEqual(adaptive.timeout('requisicao-consulta'), 2.4)
+        self.assertEqual(adaptive.timeout('requisicao-captura'), 10)
+
+    def test_deadlines_reach_the_transport(self):
+        client = self.client()
+        client.query_by_tid('1')
+        client.query_by_tid('1', timeout=2)
+        client = self.client(timeout=5)
+        client.query_by_tid('1')
+        client.capture_transaction('1', timeout=1)
+        create_transaction(client)
+        self.assertIsNone(self.timeouts[0])
+        for timeout, expected in zip(self.timeouts[1:], [2, 5, 1, 5]):
+            self.assertTrue(expected - 0.5 < timeout <= expected, (timeout, expected))
+        self.assertRaises(cielo.CommunicationError, client.query_by_tid, '1', timeout=0)
+        self.assertEqual(len(self.timeouts), 5)
+
+    def test_adaptive_client(self):
+        client = self.client(timeout=5, timeouts=timeouts.AdaptiveTimeouts(
+            min_samples=2, min_timeout=0.5))
+        for i in range(3):
+            client.query_by_tid('1')
+        self.assertTrue(self.timeouts[0] > 4)
+        self.assertTrue(self.timeouts[2] <= 0.5)
+        # other tags have their own timeouts
+        client.cancel_transaction('1')
+        self.assertTrue(self.timeouts[3] > 4)
+
+    def test_hedging(self):
+        release = threading.Event()
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            if len(calls) == 1:
+                release.wait(10)
+            return TRANSACTION_RESPONSE
+
+        self.handler = handler
+        client = self.client(hedge=0.01)
+        try:
+            self.assertEqual(client.query_by_order_number('1').tid, '100699306905227C1001')
+            self.assertEqual((len(calls), client.hedged), (2, 1))
+        finally:
+            release.set()
+
+        future = self.client(cielo.AsyncClient, hedge=0.01).query_by_tid('1')
+        self.assertEqual(future.result(timeout=10).tid, '100699306905227C1001')
+
+    def test_hedging_executor(self):
+        self.assertIs(self.client(hedge=0.01)._hedges, cielo.client.default_hedge_executor)
+        self.assertIs(self.client(hedge=True)._hedges, cielo.client.default_hedge_executor)
+
+        executor = cielo.executor.Executor(2)
+        self.handler = lambda request: TRANSACTION_RESPONSE
+        client = self.client(hedge=0.01, hedge_executor=executor)
+        self.assertIs(client._hedges, executor)
+        self.assertEqual(client.query_by_tid('1').tid, '100699306905227C1001')
+        executor.shutdown()
+
+    def test_hedged_errors(self):
+        self.handler = lambda request: (time.sleep(0.05), ERROR_RESPONSE)[1]
+        client = self.client(hedge=0.01)
+        self.assertRaises(cielo.InvalidCaptureValueError, client.query_by_tid, '1')
+        self.assertEqual(client.hedged, 1)
+        self.assertRaises(cielo.CommunicationError, client.query_by_tid, '1', timeout=0.02)
+
+    def test_only_queries_are_hedged(self):
+        self.handler = lambda request: (time.sleep(0.03), TRANSACTION_RESPONSE)[1]
+        client = self.client(hedge=0.01)
+        create_transaction(client)
+        client.capture_transaction('1')
+        self.assertEqual((self.transport.requests, client.hedged), (2, 0))
+
+    def test_adaptive_hedging(self):
+        client = self.client(hedge=True, timeouts=timeouts.AdaptiveTimeouts(min_samples=1))
+        client.query_by_tid('1')
+        self.assertEqual(client.hedged, 0)
+        self.handler = lambda request: (time.sleep(0.05), TRANSACTION_RESPONSE)[1]
+        client.query_by_tid('1')
+        self.assertEqual(client.hedged, 1)
+
+
+class ReconciliationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.simulator = simulator.Simulator(seed=1)
+        self.transport = simulator.SimulatorTransport(self.simulator)
+        self.client = cielo.Client(
+            '1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA, transport=self.transport,
+            reconcile=True, reconcile_delays=(0, 0.001, 0.002))
+
+    def fail_first(self, before=False, after=False):
+        calls = []
+
+        def handle(request):
+            calls.append(request)
+            if len(calls) == 1 and before:
+                raise simulator.Dropped()
+            response = self.simulator.handle(request)
+            if len(calls) == 1 and after:
+                raise simulator.Dropped()
+            return response
+
+        self.transport.handler = handle
+
+    def create_transaction(self, client=None, **kwargs):
+        return create_transaction(client or self.client, order_number='pedido-1', **kwargs)
+
+    def test_lost_response(self):
+        self.fail_first(after=True)
+        transaction = self.create_transaction()
+        self.assertEqual(transaction.status, cielo.ST_AUTHORIZED)
+        self.assertEqual(transaction.order, 'pedido-1')
+        self.assertEqual(self.simulator.stats['requisicao-transacao'], 1)
+        self.assertEqual(self.simulator.stats['requisicao-consulta-chsec'], 1)
+
+    def test_lost_request(self):
+        self.fail_first(before=True)
+        try:
+            self.create_transaction()
+        except cielo.TransactionNotCreatedError, e:
+            self.assertEqual(e.order_number, 'pedido-1')
+            self.assertIsInstance(e.reason, cielo.CommunicationError)
+            self.assertTrue(e.idempotent_safe)
+        else:
+            self.fail('no error raised')
+        self.assertEqual(self.simulator.stats['requisicao-transacao'], 0)
+        self.assertEqual(self.simulator.stats['requisicao-consulta-chsec'], 3)
+
+    def test_unresolved(self):
+        self.simulator.drop_rate = 1
+        try:
+            self.create_transaction()
+        except cielo.UnresolvedTransactionError, e:
+            self.assertEqual(e.order_number, 'pedido-1')
+            self.assertFalse(e.idempotent_safe)
+        else:
+            self.fail('no error raised')
+        # never sent twice
+        self.assertEqual(self.simulator.stats['requisicao-transacao'], 1)
+
+    def test_client_fault_while_querying(self):
+        self.fail_first(after=True)
+        handle = self.transport.handler
+
+        def refuse_queries(request):
+            if 'requisicao-consulta-chsec' in request:
+                return ERROR_RESPONSE.replace('<codigo>032<', '<codigo>002<')
+            return handle(request)
+
+        self.transport.handler = refuse_queries
+        try:
+            self.create_transaction()
+        except cielo.UnresolvedTransactionError, e:
+            self.assertEqual(e.order_number, 'pedido-1')
+            self.assertIsInstance(e.reason, cielo.CommunicationError)
+            self.assertIsInstance(e.query_error, cielo.InvalidCredentialsError)
+        else:
+            self.fail('no error raised')
+
+    def test_ambiguous_service_errors(self):
+        self.simulator.error_rate = 1
+        self.simulator.error_codes = (99,)
+        self.assertRaises(cielo.UnresolvedTransactionError, self.create_transaction)
+        self.simulator.error_codes = (97,)
+        self.assertRaises(cielo.UnavailableError, self.create_transaction)
+        self.assertEqual(self.simulator.stats['requisicao-consulta-chsec'], 0)
+
+    def test_async_client(self):
+        self.fail_first(after=True)
+        client = cielo.AsyncClient('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                                   transport=self.transport, reconcile=True,
+                                   reconcile_delays=(0,))
+        transaction = self.create_transaction(client).result(timeout=10)
+        self.assertEqual(transaction.status, cielo.ST_AUTHORIZED)
+
+    def test_unsent_requests(self):
+        self.client.limiter = ratelimit.RateLimiter(1)
+        self.client.limiter.acquire()
+        try:
+            self.create_transaction(timeout=0.05)
+        except cielo.DeadlineExceededError, e:
+            self.assertFalse(e.sent)
+            self.assertEqual(e.order_number, 'pedido-1')
+        else:
+            self.fail('no error raised')
+        self.assertEqual(self.simulator.stats['requisicao-transacao'], 0)
+        self.assertEqual(self.simulator.stats['requisicao-consulta-chsec'], 0)
+
+    def test_deadline(self):
+        self.simulator.drop_rate = 1
+        self.client.reconcile_delays = (0, 0.01, 5)
+        started = time.time()
+        self.assertRaises(cielo.UnresolvedTransactionError, self.create_transaction,
+                          timeout=0.5)
+        self.assertLess(time.time() - started, 0.5)
+
+    def test_disabled(self):
+        self.fail_first(after=True)
+        self.client.reconcile = False
+        self.assertRaises(cielo.CommunicationError, self.create_transaction)
+        self.assertEqual(self.simulator.stats['requisicao-consulta-chsec'], 0)
+
+
+class CentsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.node = colander.SchemaNode(cielo.CentsMoney())
+
+    def test_conversions(self):
+        self.assertEqual(cielo.Cents.from_decimal(Decimal('200.5')), 20050)
+        self.assertEqual(cielo.Cents.from_decimal(Decimal('1.00000')), 100)
+        self.assertEqual(cielo.Cents.from_decimal(333.11), 33311)
+        self.assertEqual(cielo.Cents.from_decimal(188), 18800)
+        self.assertRaises(ValueError, cielo.Cents.from_decimal, Decimal('1.234'))
+        self.assertEqual(cielo.Cents(5).to_decimal(), Decimal('0.05'))
+        self.assertEqual(str(cielo.Cents(-5)), '-0.05')
+
+    def test_serialization(self):
+        self.assertEqual(self.node.serialize(cielo.Cents(20050)), '20050')
+        self.assertEqual(self.node.serialize(Decimal('200.5')), '20050')
+        self.assertEqual(colander.SchemaNode(cielo.Money()).serialize(cielo.Cents(7)), '7')
+
+    def test_deserialization(self):
+        value = self.node.deserialize('20050')
+        self.assertIsInstance(value, cielo.Cents)
+        self.assertEqual(value, 20050)
+        self.assertRaises(colander.Invalid, self.node.deserialize, '200.50')
+        self.assertRaises(colander.Invalid, self.node.deserialize, '-1')
+        self.assertRaises(colander.Invalid, self.node.deserialize, None)
+
+    def test_ranges_are_scaled(self):
+        schema = cielo.schema._cents_schema(cielo.schema.OrderSchema())
+        self.assertIsInstance(schema['value'].typ, cielo.CentsMoney)
+        self.assertIsInstance(cielo.schema.OrderSchema()['value'].typ, cielo.Money)
+        self.assertEqual(schema['value'].validator.max, 999999999999)
+        self.assertRaises(colander.Invalid, schema['value'].deserialize, '0')
+        self.assertEqual(schema['value'].deserialize('999999999999'), 999999999999)
+
+    def test_client(self):
+        transport = cielo.transport.LoopbackTransport(lambda request: TRANSACTION_RESPONSE)
+        client = cielo.Client('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                              transport=transport, cents=True)
+        transaction = client.query_by_tid('100699306905227C1001')
+        self.assertIsInstance(transaction.value, cielo.Cents)
+        self.assertEqual(transaction.value, 20000)
+        self.assertEqual(transaction.authorization.value, 20000)
+        transaction = client.capture_transaction('100699306905227C1001')
+        self.assertEqual(transaction.value.to_decimal(), Decimal('200.00'))
+
     def test_invalid_monetary_values(self):
         "Values with more than two decimal places are invalid"
         self.assertRaises(colander.Invalid, self.node.serialize, 100.123)
         self.assertRaises(colander.Invalid, self.node.serialize, Decimal('200.543'))
 
 
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class LocalServer(object):
+    """A keep-alive HTTP server running in a thread, that answers every
+    POST with ``response`` and records the connections it accepted.
+
+    ``response`` may also be a callable taking the request body."""
+
+    def __init__(self, response, close=False):
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                server.connections.append(self.client_address)
+                server.sockets.append(self.connection)
+
+            def do_POST(self):
+                length = int(self.headers.getheader('Content-Length'))
+                request = self.rfile.read(length)
+                server.requests.append(request)
+                response = server.response
+                if callable(response):
+                    response = response(request)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(response)))
+                if close:
+                    self.send_header('Connection', 'close')
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        self.response = response
+        self.connections = []
+        self.sockets = []
+        self.requests = []
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/servicos/ecommwsec.do' % self.httpd.server_port
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        # wake up the handlers waiting on keep-alive connections
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def test_connection_reuse(self):
+        pool = cielo.pool.ConnectionPool()
+        with LocalServer('ok') as server:
+            self.assertEqual(pool.urlopen(server.url, 'a'), 'ok')
+            self.assertEqual(pool.urlopen(server.url, 'b'), 'ok')
+            self.assertEqual(server.requests, ['a', 'b'])
+            self.assertEqual(len(server.connections), 1)
+
+    def test_timeouts(self):
+        pool = cielo.pool.ConnectionPool(timeout=7)
+        with LocalServer('ok') as server:
+            pool.urlopen(server.url, 'a', timeout=3)
+            (conn, released_at), = pool._idle.values()[0]
+            self.assertEqual(conn.sock.gettimeout(), 3)
+            pool.urlopen(server.url, 'b')
+            self.assertEqual(conn.sock.gettimeout(), 7)
+            self.assertEqual(len(server.connections), 1)
+
+    def test_default_timeout(self):
+        pool = cielo.pool.ConnectionPool()
+        default = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(5)
+        try:
+            with LocalServer('ok') as server:
+                pool.urlopen(server.url, 'a')
+                (conn, released_at), = pool._idle.values()[0]
+                self.assertEqual(conn.sock.gettimeout(), 5)
+                pool.urlopen(server.url, 'b', timeout=3)
+                self.assertEqual(conn.sock.gettimeout(), 3)
+                pool.urlopen(server.url, 'c')
+                self.assertEqual(conn.sock.gettimeout(), 5)
+        finally:
+            socket.setdefaulttimeout(default)
+
+    def test_idle_eviction(self):
+        pool = cielo.pool.ConnectionPool(idle_timeout=-1)
+        with LocalServer('ok') as server:
+            pool.urlopen(server.url, 'a')
+            pool.urlopen(server.url, 'b')
+            self.assertEqual(len(server.connections), 2)
+
+    def test_closed_connections_are_not_reused(self):
+        pool = cielo.pool.ConnectionPool()
+        with LocalServer('ok', close=True) as server:
+            pool.urlopen(server.url, 'a')
+            pool.urlopen(server.url, 'b')
+            self.assertEqual(len(server.connections), 2)
+
+    def test_maxsize(self):
+        pool = cielo.pool.ConnectionPool(maxsize=0)
+        with LocalServer('ok') as server:
+            pool.urlopen(server.url, 'a')
+            pool.urlopen(server.url, 'b')
+            self.assertEqual(len(server.connections), 2)
+
+    def test_client_communication_error(self):
+        with LocalServer('ok') as server:
+            url = server.url
+        client = cielo.Client('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                              service_url=url, pool=cielo.pool.ConnectionPool())
+        self.assertRaises(cielo.CommunicationError, client.query_by_tid, '1')
+
+    def test_client_shares_default_pool(self):
+        a = cielo.Client('1', 'key', cielo.PARCELADO_ADMINISTRADORA)
+        b = cielo.Client('2', 'key', cielo.PARCELADO_ADMINISTRADORA)
+        self.assertIs(a.transport.pool, cielo.pool.default_pool)
+        self.assertIs(a.transport.pool, b.transport.pool)
+
+
+class TransportTestCase(unittest.TestCase):
+    def client(self, transport):
+        return cielo.Client('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                            transport=transport)
+
+    def test_loopback(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return TRANSACTION_RESPONSE
+
+        transport = cielo.transport.LoopbackTransport(handler)
+        transaction = self.client(transport).query_by_tid('100699306905227C1001')
+        self.assertEqual(transaction.tid, '100699306905227C1001')
+        self.assertEqual(transport.requests, 1)
+        self.assertTrue(requests[0].startswith('<?xml'))
+        self.assertIn('<tid>100699306905227C1001</tid>', requests[0])
+
+    def test_escaping(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return TRANSACTION_RESPONSE
+
+        transport = cielo.transport.LoopbackTransport(handler)
+        client = cielo.Client('1006993069', 'a&b +c%', cielo.PARCELADO_ADMINISTRADORA,
+                              transport=transport)
+        client.query_by_tid('100699306905227C1001')
+        client.capture_transaction('100699306905227C1001')
+        for request in requests:
+            self.assertIn('<chave>a&amp;b +c%</chave>', request)
+        request = client._build_message('requisicao-consulta', {'tid': '1'})
+        self.assertNotIn('&', request)
+        self.assertEqual(cielo.message.loads(cielo.transport.decode_message(request))
+                         .findtext('dados-ec/chave'), 'a&b +c%')
+
+    def test_urllib(self):
+        with LocalServer(ERROR_RESPONSE) as server:
+            transport = cielo.transport.UrllibTransport(server.url)
+            self.assertRaises(cielo.Error, self.client(transport).query_by_tid, '1')
+        self.assertTrue(server.requests[0].startswith('mensagem=%3C%3Fxml'))
+
+    def test_communication_errors(self):
+        with LocalServer(ERROR_RESPONSE) as server:
+            url = server.url
+        for transport in (cielo.transport.UrllibTransport(url),
+                          cielo.transport.PooledTransport(url, cielo.pool.ConnectionPool())):
+            self.assertRaises(cielo.CommunicationError, self.client(transport).query_by_tid, '1')
+
+    def test_default_timeout(self):
+        def respond(request):
+            time.sleep(0.5)
+            return ERROR_RESPONSE
+
+        default = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(0.1)
+        try:
+            with LocalServer(respond) as server:
+                for transport in (cielo.transport.UrllibTransport(server.url),
+                                  cielo.transport.PooledTransport(
+                                      server.url, cielo.pool.ConnectionPool())):
+                    self.assertRaises(cielo.CommunicationError,
+                                      self.client(transport).query_by_tid, '1')
+        finally:
+            socket.setdefaulttimeout(default)
+
+
+class AsyncClientTestCase(unittest.TestCase):
+    def client(self, url):
+        return cielo.AsyncClient('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                                 service_url=url, pool=cielo.pool.ConnectionPool())
+
+    def test_query(self):
+        with LocalServer(TRANSACTION_RESPONSE) as server:
+            future = self.client(server.url).query_by_tid('100699306905227C1001')
+            transaction = future.result(timeout=10)
+        self.assertIsInstance(transaction, cielo.Transaction)
+        self.assertEqual(transaction.tid, '100699306905227C1001')
+        self.assertEqual(transaction.authorization.arp, '123456')
+
+    def test_many_requests_in_flight(self):
+        with LocalServer(TRANSACTION_RESPONSE) as server:
+            client = self.client(server.url)
+            futures = [client.query_by_tid(str(i)) for i in range(20)]
+            for future in futures:
+                self.assertEqual(future.result(timeout=10).status, cielo.ST_AUTHORIZED)
+        self.assertEqual(len(server.requests), 20)
+
+    def test_error(self):
+        with LocalServer(ERROR_RESPONSE) as server:
+            future = self.client(server.url).capture_transaction('1')
+            self.assertRaises(cielo.Error, future.result, 10)
+            self.assertEqual(future.exception().code, 32)
+
+    def test_create_transaction_error_has_order_number(self):
+        with LocalServer(ERROR_RESPONSE) as server:
+            card = cielo.Card(
+                brand=cielo.VISA,
+                number='4551870000000183',
+                expiration_date=nextmonth(),
+                security_code='123',
+                holder_name='Joao da Silva',
+            )
+            future = self.client(server.url).create_transaction(
+                value=Decimal('200.0'),
+                card=card,
+                installments=1,
+                authorize=3,
+                capture=False,
+                order_number='123',
+            )
+            self.assertEqual(future.exception(timeout=10).order_number, '123')
+
+    def test_invalid_request_raises_right_away(self):
+        client = self.client('http://127.0.0.1:1/')
+        self.assertRaises(ValueError, client._do_request, 'requisicao-invalida', {})
+
+    def test_shutdown(self):
+        executor = cielo.executor.Executor(2)
+        future = executor.submit(lambda: 1)
+        self.assertEqual(future.result(timeout=10), 1)
+        executor.shutdown()
+        self.assertRaises(RuntimeError, executor.submit, lambda: 2)
+
+
+class QueryManyTestCase(unittest.TestCase):
+    def setUp(self):
+        def respond(request):
+            request = cielo.transport.decode_message(request)
+            if '<tid>2</tid>' in request or '<numero-pedido>2</numero-pedido>' in request:
+                return ERROR_RESPONSE
+            if '<tid>3</tid>' in request:
+                return '<html><body>Bad Gateway</body></html>'
+            return TRANSACTION_RESPONSE
+
+        self.server = LocalServer(respond).__enter__()
+        self.client = cielo.Client('1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+                                   service_url=self.server.url,
+                                   pool=cielo.pool.ConnectionPool())
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def test_query_many(self):
+        results = dict(self.client.query_many(str(i) for i in range(10)))
+        self.assertEqual(sorted(results), sorted(str(i) for i in range(10)))
+        self.assertIsInstance(results.pop('2'), cielo.Error)
+        # not a document of the service
+        self.assertIsInstance(results.pop('3'), ValueError)
+        for transaction in results.values():
+            self.assertIsInstance(transaction, cielo.Transaction)
+
+    def test_query_many_by_order_number(self):
+        results = dict(self.client.query_many_by_order_number(['1', '2', '3'], max_workers=2))
+        self.assertIsInstance(results['1'], cielo.Transaction)
+        self.assertIsInstance(results['2'], cielo.Error)
+        self.assertIsInstance(results['3'], cielo.Transaction)
+
+    def test_communication_errors_are_yielded(self):
+        self.server.__exit__()
+        results = list(self.client.query_many(['1', '2']))
+        self.assertEqual(len(results), 2)
+        for tid, error in results:
+            self.assertIsInstance(error, cielo.CommunicationError)
+
+    def test_bounded_concurrency(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def send(data, *args):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            try:
+                return cielo.Client._send(self.client, data, *args)
+            finally:
+                with lock:
+                    running.pop()
+
+        self.client._send = send
+        self.assertEqual(len(list(self.client.query_many(map(str, range(30)), 3))), 30)
+        self.assertTrue(max(peak) <= 3)
+
+
+class SimulatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.simulator = simulator.Simulator(seed=1)
+        self.client = cielo.Client(
+            '1006993069', 'key', cielo.PARCELADO_ADMINISTRADORA,
+            transport=simulator.SimulatorTransport(self.simulator))
+
+    def test_authorization(self):
+        transaction = create_transaction(self.client)
+        self.assertEqual(transaction.status, cielo.ST_AUTHORIZED)
+        self.assertEqual(transaction.value, Decimal('200.00'))
+        self.assertEqual(transaction.authorization.value, Decimal('200.00'))
+        self.assertTrue(transaction.pan)
+
+    def test_denied_authorization(self):
+        transaction = create_transaction(self.client, Decimal('200.01'))
+        self.assertEqual(transaction.status, cielo.ST_NOT_AUTHORIZED)
+
+    def test_queries(self):
+        created = create_transaction(self.client)
+        transaction = self.client.query_by_tid(created.tid)
+        self.assertEqual(transaction.tid, created.tid)
+        transaction = self.client.query_by_order_number(created.order)
+        self.assertEqual(transaction.tid, created.tid)
+        self.assertRaises(cielo.Error, self.client.query_by_tid, 'unknown')
+
+    def test_capture_and_cancel(self):
+        tid = create_transaction(self.client).tid
+        self.assertEqual(self.client.capture_transaction(tid).status, cielo.ST_CAPTURED)
+        try:
+            self.client.capture_transaction(tid)
+        except cielo.Error, e:
+            self.assertEqual(e.code, 30)
+        else:
+            self.fail('captured twice')
+        transaction = self.client.cancel_transaction(tid)
+        self.assertEqual(transaction.status, cielo.ST_CANCELLED)
+        self.assertEqual(transaction.cancel.value, Decimal('200.00'))
+
+    def test_autocapture(self):
+        transaction = create_transaction(self.client, capture=True)
+        self.assertEqual(transaction.status, cielo.ST_CAPTURED)
+
+    def test_authentication(self):
+        transaction = create_transaction(self.client, authorize=1)
+        self.assertEqual(transaction.status, cielo.ST_CREATED)
+        self.assertTrue(transaction.authentication_url)
+        self.simulator.advance(transaction.tid)
+        self.simulator.advance(transaction.tid)
+        transaction = self.client.query_by_tid(transaction.tid)
+        self.assertEqual(transaction.status, cielo.ST_AUTHORIZED)
+        self.assertEqual(transaction.authentication.eci, 5)
+
+    def test_error_injection(self):
+        self.simulator.error_rate = 1
+        self.assertRaises(cielo.Error, self.client.query_by_tid, '1')
+        self.assertEqual(self.simulator.stats['failed'], 1)
+
+    def test_dropped_responses(self):
+        self.simulator.drop_rate = 1
+        self.assertRaises(cielo.CommunicationError, create_transaction, self.client)
+        self.assertEqual(len(self.simulator.transactions), 1)
+
+    def test_throughput_limit(self):
+        self.simulator = simulator.Simulator(max_rps=2, clock=lambda: 0)
+        self.client.transport = simulator.SimulatorTransport(self.simulator)
+        create_transaction(self.client)
+        create_transaction(self.client)
+        try:
+            create_transaction(self.client)
+        except cielo.Error, e:
+            self.assertEqual(e.code, 97)
+        else:
+            self.fail('throughput limit not enforced')
+
+    def test_latency(self):
+        slept = []
+        self.simulator.latency = simulator.constant(0.25)
+        self.simulator.sleep = slept.append
+        create_transaction(self.client)
+        self.assertEqual(slept, [0.25])
+
+    def test_http_server(self):
+        server = simulator.serve(self.simulator)
+        pool = cielo.pool.ConnectionPool()
+        try:
+            self.client.transport = cielo.transport.PooledTransport(
+                'http://127.0.0.1:%d/' % server.server_port, pool)
+            tid = create_transaction(self.client).tid
+            self.assertEqual(self.client.query_by_tid(tid).tid, tid)
+        finally:
+            pool.clear()
+            server.shutdown()
+            server.server_close()
+
+
 # do not trust these
 
 class TestCase(unittest.TestCase):
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import math
+import threading
+import collections
+from bbe.cielo import metrics
+
+
+class AdaptiveTimeouts(metrics.Observer):
+    """Derives the timeout of each request tag from the latencies
+    observed for it.
+
+    The timeout of a tag is its ``percentile`` latency times
+    ``multiplier``, within ``min_timeout`` and ``max_timeout``
+    seconds. Until ``min_samples`` requests of a tag succeed, its
+    timeout is ``max_timeout``.
+
+    Latencies are the network times of the last ``window`` successful
+    requests of each tag, so the timeouts follow the service as it
+    gets faster or slower. Percentiles are computed again every
+    ``refresh`` requests.
+
+    Give it to a client as its ``timeouts``, and the client feeds it.
+    """
+    def __init__(self, percentile=99, multiplier=2, min_timeout=1,
+                 max_timeout=30, window=1000, min_samples=20, refresh=50):
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.window = window
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        # the latencies of each tag, and how many were added since
+        # they were last sorted
+        self._latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=window))
+        self._added = collections.Counter()
+        self._sorted = {}
+
+    def observe(self, timings):
+        if timings.error is not None or timings.network is None:
+            return
+        with self._lock:
+            self._latencies[timings.tag].append(timings.network)
+            self._added[timings.tag] += 1
+
+    def latency(self, tag, percent):
+        """Return the ``percent`` percentile of the latency of ``tag``,
+        or ``None`` if there are too few samples."""
+        with self._lock:
+            latencies = self._sorted.get(tag)
+            if latencies is None or self._added[tag] >= self.refresh:
+                samples = self._latencies.get(tag)
+                if not samples or len(samples) < self.min_samples:
+                    return None
+                latencies = self._sorted[tag] = sorted(samples)
+                self._added[tag] = 0
+        # nearest rank
+        rank = int(math.ceil(percent * len(latencies) / 100.0))
+        return latencies[min(max(rank, 1), len(latencies)) - 1]
+
+    def timeout(self, tag):
+        """Return the timeout of ``tag``, in seconds."""
+        latency = self.latency(tag, self.percentile)
+        if latency is None:
+            return self.max_timeout
+        return min(max(latency * self.multiplier, self.min_timeout), self.max_timeout)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import socket
+import httplib
+import urllib
+import urllib2
+import contextlib
+from bbe.cielo import pool as pools
+from bbe.cielo.errors import CommunicationError
+
+
+#: Escapes a message, or a piece of one, for the form body.
+quote = urllib.quote_plus
+
+
+def encode_message(request, quoted=False):
+    """Encode a serialized request as the form body the service
+    expects. Pass ``quoted=True`` if ``request`` was already escaped
+    with :func:`quote`."""
+    if not quoted:
+        request = quote(request)
+    return 'mensagem=' + request
+
+
+def decode_message(data):
+    """The inverse of :func:`encode_message`."""
+    if not data.startswith('mensagem='):
+        raise ValueError("not a `mensagem' form body")
+    return urllib.unquote_plus(data[len('mensagem='):])
+
+
+class Transport(object):
+    """Sends requests to the service.
+
+    Transports receive the form body built by :func:`encode_message`
+    and return the raw response body. Communication failures must be
+    raised as :class:`~bbe.cielo.errors.CommunicationError`.
+
+    Clients pass a ``timeout``, in seconds, only to the calls that
+    have one, so transports written without it keep working while
+    no timeout is used.
+    """
+    def send(self, data, timeout=None):
+        raise NotImplementedError
+
+
+class UrllibTransport(Transport):
+    """Posts each request with ``urllib2.urlopen``, in a new
+    connection. Without a ``timeout``, the one set by
+    :func:`socket.setdefaulttimeout` is used."""
+
+    def __init__(self, service_url, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        self.service_url = service_url
+        self.timeout = timeout
+
+    def send(self, data, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            request = urllib2.urlopen(self.service_url, data, timeout)
+            with contextlib.closing(request) as response:
+                return response.read()
+        except urllib2.URLError, e:
+            raise CommunicationError(e.reason)
+        except (socket.error, httplib.HTTPException), e:
+            raise CommunicationError(e)
+
+
+class PooledTransport(Transport):
+    """Posts requests through a :class:`~bbe.cielo.pool.ConnectionPool`,
+    reusing keep-alive connections. By default, the pool shared by
+    the whole process is used."""
+
+    def __init__(self, service_url, pool=None):
+        self.service_url = service_url
+        self.pool = pool or pools.default_pool
+
+    def send(self, data, timeout=None):
+        try:
+            return self.pool.urlopen(self.service_url, data, {
+                'Content-Type': 'application/x-www-form-urlencoded',
+            }, timeout)
+        except (socket.error, httplib.HTTPException), e:
+            raise CommunicationError(e)
+
+
+class LoopbackTransport(Transport):
+    """Hands requests to a function in the same process.
+
+    ``handler`` is called with the serialized request (the
+    ``mensagem`` itself, not the form body) and must return the
+    raw response body. Useful for tests and simulators. Timeouts are
+    ignored, as the handler can't be interrupted.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = 0
+
+    def send(self, data, timeout=None):
+        self.requests += 1
+        return self.handler(decode_message(data))
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""Tracks pending transactions until they are done being created
+and authenticated.
+
+::
+
+    >>> watcher = Watcher(client, rate=20)
+    >>> transaction = client.create_transaction(...)
+    >>> future = watcher.watch(transaction.tid, callback=notify)
+    >>> # ... the card holder goes through the authentication url
+    >>> future.result().status
+    4
+"""
+import time
+import heapq
+import random
+import itertools
+import threading
+from bbe.cielo import schema as schemas
+from bbe.cielo.errors import CommunicationError, Error
+from bbe.cielo.executor import Cancelled, Executor, Future, Timeout
+from bbe.cielo.ratelimit import RateLimiter
+
+#: The statuses a watched transaction is polled in: until the card
+#: holder is done with it. Authenticated transactions wait for an
+#: authorization request, so they are not pending.
+PENDING_STATUS = (
+    schemas.ST_CREATED,
+    schemas.ST_PROCESSING,
+    schemas.ST_AUTHENTICATING,
+)
+
+
+class _Watch(object):
+    __slots__ = ('tid', 'future', 'deadline', 'status', 'interval')
+
+    def __init__(self, tid, deadline, interval):
+        self.tid = tid
+        self.future = Future()
+        self.deadline = deadline
+        self.status = None
+        self.interval = interval
+
+
+class Watcher(object):
+    """Polls the transactions it watches with ``query_by_tid`` until
+    their status is no longer ``pending`` (by default, one of
+    :data:`PENDING_STATUS`).
+
+    Each transaction is first queried ``min_interval`` seconds after
+    it is watched. While its status doesn't change, the interval is
+    multiplied by ``backoff``, up to ``max_interval``; once it
+    changes (e.g. the card holder started authenticating), it goes
+    back to ``min_interval``. Every interval is spread by up to
+    ``jitter`` (a fraction of it), so transactions watched together
+    are not queried together.
+
+    All the queries share a :class:`~bbe.cielo.ratelimit.RateLimiter`
+    of ``rate`` queries per second (or ``limiter``, to share a budget
+    with other code), and run in the ``executor`` threads. Service
+    errors that may go away (see :attr:`Error.retryable`) and
+    communication errors are retried, backing off like unchanged
+    statuses do; other errors end the watch.
+
+    ``client`` must be a blocking :class:`~bbe.cielo.client.Client`.
+    A :class:`~bbe.cielo.cache.StatusCache` whose transitional TTL
+    is shorter than ``min_interval`` may be used with it.
+
+    .. attribute:: queries
+
+        How many queries were made.
+
+    .. attribute:: errors
+
+        How many of them failed and were retried.
+    """
+    def __init__(self, client, rate=10, limiter=None, min_interval=1,
+                 max_interval=60, backoff=2, jitter=0.2,
+                 pending=PENDING_STATUS, executor=None,
+                 max_workers=10, clock=time.time, seed=None):
+        self.client = client
+        self.limiter = limiter or RateLimiter(rate)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.pending = frozenset(pending)
+        self.executor = executor or Executor(max_workers)
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.queries = 0
+        self.errors = 0
+        self._condition = threading.Condition()
+        self._watches = {}
+        # (due, sequence, watch), the next poll first
+        self._schedule = []
+        self._sequence = itertools.count()
+        self._thread = None
+        self._closed = False
+
+    def watch(self, tid, callback=None, timeout=None):
+        """Start watching ``tid`` and return a
+        :class:`~bbe.cielo.executor.Future` of its transaction once
+        it is no longer pending. If given, ``callback(future)`` is
+        called then, in one of the executor threads.
+
+        Watching a tid already watched returns the same future. If
+        ``timeout`` seconds pass first, the future raises
+        :class:`~bbe.cielo.executor.Timeout`.
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("watcher is closed")
+            watch = self._watches.get(tid)
+            if watch is None:
+                deadline = None if timeout is None else self.clock() + timeout
+                watch = self._watches[tid] = _Watch(tid, deadline, self.min_interval)
+                self._schedule_poll(watch)
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run)
+                    self._thread.daemon = True
+                    self._thread.start()
+        if callback is not None:
+            watch.future.add_done_callback(callback)
+        return watch.future
+
+    def unwatch(self, tid):
+        """Stop watching ``tid``. Its future raises
+        :class:`~bbe.cielo.executor.Cancelled`."""
+        with self._condition:
+            watch = self._watches.pop(tid, None)
+        if watch is not None:
+            watch.future.set_exception(Cancelled(tid))
+
+    def close(self, wait=True):
+        """Stop polling. Pending futures raise
+        :class:`~bbe.cielo.executor.Cancelled`."""
+        with self._condition:
+            self._closed = True
+            watches, self._watches = self._watches, {}
+            self._condition.notify()
+            thread = self._thread
+        for watch in watches.itervalues():
+            watch.future.set_exception(Cancelled(watch.tid))
+        if wait and thread is not None:
+            thread.join()
+
+    def __len__(self):
+        return len(self._watches)
+
+    def _schedule_poll(self, watch):
+        # must hold the condition
+        delay = watch.interval * (1 + self.jitter * self.random.uniform(-1, 1))
+        due = self.clock() + delay
+        if watch.deadline is not None:
+            due = min(due, watch.deadline)
+        heapq.heappush(self._schedule, (due, next(self._sequence), watch))
+        self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        return
+                    if self._schedule:
+                        due, sequence, watch = self._schedule[0]
+                        delay = due - self.clock()
+                        if delay <= 0:
+                            heapq.heappop(self._schedule)
+                            break
+                        self._condition.wait(delay)
+                    else:
+                        self._condition.wait()
+                if self._watches.get(watch.tid) is not watch:
+                    # unwatched
+                    continue
+                if watch.deadline is not None and watch.deadline <= self.clock():
+                    del self._watches[watch.tid]
+                    self.executor.submit(watch.future.set_exception, Timeout())
+                    continue
+                self.queries += 1
+
+            # waiting here holds every later poll back, which is what
+            # keeps the queries within the budget
+            self.limiter.acquire()
+            self.executor.submit(self._poll, watch)
+
+    def _poll(self, watch):
+        try:
+            transaction = self.client.query_by_tid(watch.tid)
+        except (CommunicationError, Error), e:
+            if isinstance(e, Error) and not e.retryable:
+                self._finish(watch, error=e)
+                return
+            watch.interval = min(watch.interval * self.backoff, self.max_interval)
+            self._reschedule(watch, failed=True)
+            return
+        except Exception, e:
+            self._finish(watch, error=e)
+            return
+
+        if transaction.status not in self.pending:
+            self._finish(watch, transaction)
+            return
+
+        if transaction.status != watch.status:
+            watch.status = transaction.status
+            watch.interval = self.min_interval
+        else:
+            watch.interval = min(watch.interval * self.backoff, self.max_interval)
+        self._reschedule(watch)
+
+    def _reschedule(self, watch, failed=False):
+        with self._condition:
+            if failed:
+                self.errors += 1
+            if self._watches.get(watch.tid) is watch:
+                self._schedule_poll(watch)
+
+    def _finish(self, watch, transaction=None, error=None):
+        with self._condition:
+            if self._watches.get(watch.tid) is not watch:
+                return
+            del self._watches[watch.tid]
+        if error is not None:
+            watch.future.set_exception(error)
+        else:
+            watch.future.set_result(transaction)
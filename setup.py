@@ -32,6 +32,7 @@ setup(name='bbe.cielo',
       include_package_data=True,
       zip_safe=False,
       install_requires=['setuptools'] + requires,
+      extras_require={'lxml': ['lxml']},
       test_suite='bbe.cielo',
       test_require=requires,
       )